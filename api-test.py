@@ -1,52 +1,327 @@
-from fastapi import FastAPI
+import asyncio
+import base64
+import binascii
+import itertools
+import json
+import logging as log
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from coalescing import Coalescer, canonical_hash
+from job_queue import FAILED, Job, JobQueue, QueueFull
+from lcia import ImpactFactors, LCIACache
+from matrix_engine import MatrixEngine
+from metrics import REGISTRY, start_trace
+from monte_carlo import PERCENTILES, MonteCarloModel, WorkerPool, background_uncertainties, build_ventum_model
 from olca_client import OLCAClient
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, ValidationError
 from VentumACVOutput import VentumACVOutput
+from background_vectors import BackgroundVectorCache
+from catalog_cache import CatalogCache
+from impact_cache import ImpactCache
+from result_manager import TooManyResults
+from sensitivity import VentumJacobian, build_jacobian
+from ventum_flows import CONFIG_PATH, CompiledMapping, CropMapping, load_mappings
+from typing import Annotated, Literal
+import numpy as np
 import olca_schema as o
 
-app = FastAPI()
-client = OLCAClient(port=8080)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # El precalentamiento corre en segundo plano: la API ya responde, pero /ready
+    # devuelve 503 hasta que termina
+    if WARMUP:
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    yield
+    drop_monte_carlo_models()
+    monte_carlo_pool.close()
+    # Los sistemas de producto del pool son temporales: no se dejan en la base de datos
+    try:
+        await run_in_threadpool(client.product_systems.clear)
+    except Exception as e:
+        log.warning("pooled product systems not removed: %s", e)
+
+app = FastAPI(lifespan=lifespan)
+# OLCA_IPC_ENDPOINTS=3000,3001,3002 reparte las llamadas entre réplicas del servidor IPC
+client = OLCAClient(
+    endpoints=os.getenv("OLCA_IPC_ENDPOINTS", "8080").split(","),
+    max_results=int(os.getenv("OLCA_MAX_RESULTS", "64"))
+)
+# OLCA_ENGINE=matrix resuelve los impactos en memoria en lugar de en el servidor IPC
+matrix_engine = MatrixEngine(client)
+# OLCA_MATRIX_SNAPSHOT=dir abre con mmap las matrices exportadas con snapshot.py: los
+# workers comparten las páginas y no esperan a la exportación IPC. Un hilo comprueba
+# después que la base de datos no haya cambiado (OLCA_MATRIX_SNAPSHOT_VERIFY=0 lo evita)
+if os.getenv("OLCA_MATRIX_SNAPSHOT"):
+    try:
+        matrix_engine.load_snapshot(
+            os.getenv("OLCA_MATRIX_SNAPSHOT"),
+            verify=os.getenv("OLCA_MATRIX_SNAPSHOT_VERIFY", "1") != "0"
+        )
+    except (OSError, ValueError) as e:
+        log.warning("matrix snapshot not loaded: %s", e)
+engine = matrix_engine if os.getenv("OLCA_ENGINE") == "matrix" else client
+catalog = CatalogCache()
+client.on_change(catalog.invalidate)
+# IMPACT_CACHE_DIR guarda los impactos en disco, compartidos entre workers, hasta
+# IMPACT_CACHE_MAX_FILES entradas
+impact_cache = ImpactCache(
+    directory=os.getenv("IMPACT_CACHE_DIR"),
+    max_disk_entries=int(os.getenv("IMPACT_CACHE_MAX_FILES", "16384"))
+)
+client.on_change(impact_cache.invalidate)
+# Varios métodos de impacto sobre un único inventario por proceso o sistema de producto
+lcia = LCIACache(client)
+# Las peticiones idénticas que llegan mientras se calcula una comparten su cálculo. La
+# revisión forma parte de la clave: tras una escritura no se reutiliza un cálculo anterior
+coalescer = Coalescer()
+
+VENTUM_IMPACT_METHOD_UID = "2f995579-06bd-4681-b07c-cee3b1805b0d"
+# precomputed: vectores de fondo precalculados; parameters: cálculo IPC con ParameterRedef
+# (requiere haber ejecutado migrate_ventum_parameters.py)
+VENTUM_ACV_MODE = os.getenv("VENTUM_ACV_MODE", "precomputed")
+# WARMUP=0 omite el precalentamiento (/ready responde en cuanto arranca);
+# WARMUP_CALCULATION=1 lanza además un cálculo de prueba por réplica IPC
+WARMUP = os.getenv("WARMUP", "1") != "0"
+WARMUP_CALCULATION = os.getenv("WARMUP_CALCULATION", "0") == "1"
+warmup = {"ready": not WARMUP, "attempts": 0, "error": None, "seconds": {}}
+# Parcelas evaluadas por cada producto matricial en /ventum-acv/batch y /ventum-acv/sweep
+VENTUM_BATCH_SIZE = 1000
+# Puntos como máximo de una rejilla de /ventum-acv/sweep
+VENTUM_SWEEP_MAX_POINTS = int(os.getenv("VENTUM_SWEEP_MAX_POINTS", "10000000"))
+# Campos de VentumACVOutput -> intercambios de los procesos de cada cultivo; las rutas de
+# campo y las claves repetidas se validan aquí, al arrancar
+ventum_mappings = load_mappings(os.getenv("VENTUM_FLOWS_CONFIG", CONFIG_PATH))
+backgrounds = {
+    crop: BackgroundVectorCache(
+        client=client,
+        engine=matrix_engine,
+        product_system_name=mapping.product_system,
+        stage_names=list(mapping.stages.values()),
+        directory=os.getenv("BACKGROUND_VECTORS_DIR")
+    ) for crop, mapping in ventum_mappings.items()
+}
+
+# Una lista de métodos calcula el inventario una vez y aplica los factores de cada uno
+ImpactMethods = str | Annotated[list[str], Field(min_length=1)]
 
 class PostProcessImpact(BaseModel):
-    impact_method_uid: str
+    impact_method_uid: ImpactMethods
     amount: int = 1
 
+@app.exception_handler(TooManyResults)
+def too_many_results(request: Request, e: TooManyResults):
+    # Todos los huecos de resultados siguen ocupados tras la espera: el cliente reintenta
+    return JSONResponse(status_code=503, content={"detail": str(e)}, headers={"Retry-After": "5"})
+
+HTTP_SECONDS = REGISTRY.histogram(
+    "http_request_seconds", "API requests until the response headers are sent", ("route", "method", "status")
+)
+# Las peticiones más lentas que esto se registran en el log con su desglose
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "2"))
+
+if REGISTRY.enabled:
+    @app.middleware("http")
+    async def trace_request(request: Request, call_next):
+        # Desglose por método del cliente y llamada IPC en la cabecera Server-Timing
+        trace = start_trace()
+        response = await call_next(request)
+        seconds = time.perf_counter() - trace.started
+        timing = trace.server_timing()
+        response.headers["Server-Timing"] = timing
+        route = request.scope.get("route")
+        HTTP_SECONDS.observe((route.path if route else "unmatched", request.method, str(response.status_code)), seconds)
+        if seconds >= SLOW_REQUEST_SECONDS:
+            log.warning("%s %s took %.3f s: %s", request.method, request.url.path, seconds, timing)
+        return response
+
+@app.get("/metrics")
+def get_metrics():
+    if not REGISTRY.enabled:
+        raise HTTPException(status_code=404, detail="metrics are disabled (OLCA_METRICS=0)")
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/unit-group")
-def get_all_unit_groups():
-    return client.get_all_unit_groups()
+def get_all_unit_groups(request: Request):
+    return catalog.response(request, lambda: jsonable_encoder(client.get_all_unit_groups()))
+
+def encode_cursor(ref: o.Ref) -> str:
+    return base64.urlsafe_b64encode(json.dumps([ref.name or "", ref.id]).encode()).decode()
+
+def decode_cursor(cursor: str | None) -> tuple[str, str] | None:
+    if not cursor:
+        return None
+    try:
+        after = json.loads(base64.urlsafe_b64decode(cursor))
+    except (binascii.Error, ValueError):
+        after = None
+    if not (isinstance(after, list) and len(after) == 2 and all(isinstance(v, str) for v in after)):
+        raise HTTPException(status_code=400, detail="invalid cursor")
+    return tuple(after)
+
+def descriptor_response(
+    request: Request,
+    model_type: type,
+    flow_type: o.FlowType | None,
+    category: str | None,
+    name_prefix: str | None,
+    cursor: str | None,
+    limit: int,
+    format: str
+):
+    # Descriptores ligeros desde el índice en memoria, paginados con cursor (nombre, uuid)
+    refs = client.iter_descriptors(
+        model_type,
+        after=decode_cursor(cursor),
+        flow_type=flow_type,
+        category=category,
+        name_prefix=name_prefix
+    )
+
+    if format == "ndjson":
+        lines = (json.dumps(r.to_dict()) + "\n" for r in refs)
+        return StreamingResponse(lines, media_type="application/x-ndjson")
+
+    def build_page() -> dict:
+        page = list(itertools.islice(refs, limit + 1))
+        next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+        return {
+            "data": [r.to_dict() for r in page[:limit]],
+            "next_cursor": next_cursor
+        }
+
+    return catalog.response(request, build_page)
 
 @app.get("/flow")
-def get_all_flows():
-    return client.get_all_flows()
+def get_all_flows(
+    request: Request,
+    flow_type: o.FlowType | None = None,
+    category: str | None = None,
+    name_prefix: str | None = None,
+    cursor: str | None = None,
+    limit: int = Query(100, ge=1, le=10000),
+    format: str = Query("json", pattern="^(json|ndjson)$")
+):
+    return descriptor_response(request, o.Flow, flow_type, category, name_prefix, cursor, limit, format)
 
 @app.get("/product-flow")
-def get_all_product_flows():
-    return client.get_all_product_flows()
+def get_all_product_flows(
+    request: Request,
+    category: str | None = None,
+    name_prefix: str | None = None,
+    cursor: str | None = None,
+    limit: int = Query(100, ge=1, le=10000),
+    format: str = Query("json", pattern="^(json|ndjson)$")
+):
+    return descriptor_response(request, o.Flow, o.FlowType.PRODUCT_FLOW, category, name_prefix, cursor, limit, format)
 
 @app.get("/elementary-flow")
-def get_all_elementary_flows():
-    return client.get_all_elementary_flows()
+def get_all_elementary_flows(
+    request: Request,
+    category: str | None = None,
+    name_prefix: str | None = None,
+    cursor: str | None = None,
+    limit: int = Query(100, ge=1, le=10000),
+    format: str = Query("json", pattern="^(json|ndjson)$")
+):
+    return descriptor_response(request, o.Flow, o.FlowType.ELEMENTARY_FLOW, category, name_prefix, cursor, limit, format)
 
 @app.get("/waste-flow")
-def get_all_waste_flows():
-    return client.get_all_waste_flows()
+def get_all_waste_flows(
+    request: Request,
+    category: str | None = None,
+    name_prefix: str | None = None,
+    cursor: str | None = None,
+    limit: int = Query(100, ge=1, le=10000),
+    format: str = Query("json", pattern="^(json|ndjson)$")
+):
+    return descriptor_response(request, o.Flow, o.FlowType.WASTE_FLOW, category, name_prefix, cursor, limit, format)
 
 @app.get("/process")
-def get_all_processes():
-    return client.get_all_processes()
+def get_all_processes(
+    request: Request,
+    category: str | None = None,
+    name_prefix: str | None = None,
+    cursor: str | None = None,
+    limit: int = Query(100, ge=1, le=10000),
+    format: str = Query("json", pattern="^(json|ndjson)$")
+):
+    return descriptor_response(request, o.Process, None, category, name_prefix, cursor, limit, format)
+
+@app.get("/product-system-pool")
+def get_product_system_pool():
+    return client.product_systems.stats()
+
+@app.get("/ready")
+def get_ready():
+    # Para el balanceador: 200 solo con el precalentamiento terminado y alguna réplica sana
+    ready = warmup["ready"] and any(e.healthy for e in client.client.endpoints)
+    return JSONResponse(status_code=200 if ready else 503, content={**warmup, "seconds": dict(warmup["seconds"]), "ready": ready})
+
+@app.get("/ipc-endpoints")
+def get_ipc_endpoints():
+    return client.client.stats()
+
+@app.get("/results")
+def get_results():
+    return client.results.stats()
+
+@app.get("/impact-cache")
+def get_impact_cache():
+    return {**impact_cache.stats(), "lcia": lcia.stats(), "coalescing": coalescer.stats()}
+
+def method_results(results: list[tuple[ImpactFactors, np.ndarray]]) -> list[dict]:
+    return [
+        {
+            "impact_method_uid": factors.impact_method_uid,
+            "impact_result": impact_list(factors.impact_categories, amounts)
+        } for factors, amounts in results
+    ]
 
 @app.post("/process/{uid}/impact")
 def post_process_impact(uid: str, params: PostProcessImpact):
     process = client.get_process(uid=uid)
-    result = client.calculate_process_impact(process_uid=uid, impact_method_uid=params.impact_method_uid, amount=params.amount)
-    impacts = result.get_total_impacts()
+    data = {
+        "process": {
+            "name": process.name,
+            "category": process.category,
+            "description": process.description
+        }
+    }
+
+    if isinstance(params.impact_method_uid, list):
+        def inventory() -> list[o.EnviFlowValue]:
+            with engine.calculate_process_impact(process_uid=uid, impact_method_uid=None, amount=1) as result:
+                return result.get_total_flows()
+
+        def shared_inventory() -> list[o.EnviFlowValue]:
+            return coalescer.run(("process-inventory", uid, client.revision), inventory)
+
+        try:
+            results = lcia.impacts(("process", uid), shared_inventory, params.impact_method_uid, params.amount)
+        except ValueError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        return {"data": {**data, "impact_results": method_results(results)}}
+
+    def per_unit_impacts() -> list[o.ImpactValue]:
+        with engine.calculate_process_impact(process_uid=uid, impact_method_uid=params.impact_method_uid, amount=1) as result:
+            return result.get_total_impacts()
+
+    # Los impactos se piden por unidad y se escalan: cuerpos con otra cantidad también se
+    # agrupan. La versión del proceso descarta las entradas en disco de antes de editarlo
+    key = ("process", uid, params.impact_method_uid, process.version, process.last_change)
+    impacts = impact_cache.impacts(
+        key, params.amount, lambda: coalescer.run(("process-impact", *key[1:3], client.revision), per_unit_impacts)
+    )
     return {
         "data": {
-            "process": {
-                "name": process.name,
-                "category": process.category,
-                "description": process.description
-            },
+            **data,
             "impact_result": [
                 {
                     "category": i.impact_category.name,
@@ -57,182 +332,628 @@ def post_process_impact(uid: str, params: PostProcessImpact):
         }
     }
 
-class FlowDict():
-    inputs: dict[str, float]
-    outputs: dict[str, float]
+class PreviewProcessImpact(BaseModel):
+    impact_method_uid: str
+    amount: int = 1
+    # El proceso editado en el formato JSON de openLCA, tal y como se guardaría
+    process: dict
+    # Sistema de producto en el que se evalúa; sin él, el del propio proceso
+    product_system_uid: str | None = None
 
-@app.post("/ventum-acv")
-def post_ventum_acv(output: VentumACVOutput):
-    fertilizantes = FlowDict()
-    fertilizantes.inputs = {
-        "Ammonium nitrate phosphate, as N, at regional storehouse {RER}": output.fertilizantes.kg_N,
-        "Ammonium nitrate phosphate, as P2O5, at regional storehouse {RER}": output.fertilizantes.kg_P2O5,
-        "Diesel, burned in agricultural machine {CH}": output.fertilizantes.transporte_fert_UF_1,
-        "Potassium nitrate, as K2O, at regional storehouse {RER}": output.fertilizantes.kg_K2O
-    }
-    fertilizantes.outputs = {
-        "Fertilizantes T": 1,
-        "Ammonia": output.fertilizantes.kg_NH3,
-        "Dinitrogen monoxide": output.fertilizantes.kg_N2O,
-        "Nitrate": output.fertilizantes.kg_NO3,
-        "Nitrogen oxides, ES": output.fertilizantes.kg_NOX
+@app.post("/process/{uid}/impact/preview")
+def post_process_impact_preview(uid: str, params: PreviewProcessImpact):
+    # Impactos con la edición aplicada como cambio de columna sobre las matrices en
+    # memoria, antes de guardarla
+    try:
+        process = o.Process.from_dict(params.process)
+    except (ValueError, TypeError, AttributeError) as e:
+        raise HTTPException(status_code=422, detail=f"invalid process: {e}")
+    if process.id not in (None, uid):
+        raise HTTPException(status_code=422, detail=f"the process id {process.id} does not match {uid}")
+    process.id = uid
+    try:
+        current, preview = matrix_engine.preview_process(
+            process,
+            impact_method_uid=params.impact_method_uid,
+            amount=params.amount,
+            product_system_uid=params.product_system_uid
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return {
+        "data": {
+            "process": {
+                "name": process.name,
+                "category": process.category,
+                "description": process.description
+            },
+            "impact_result": [
+                {
+                    "category": c.name,
+                    "amount": float(a),
+                    "current": float(b),
+                    "unit": c.ref_unit
+                } for c, a, b in zip(
+                    preview.get_impact_categories(),
+                    preview.matrices.impacts_of(preview.scaling),
+                    current.matrices.impacts_of(current.scaling)
+                )
+            ]
+        }
     }
 
-    manejo_de_cultivo = FlowDict()
-    manejo_de_cultivo.inputs = {
-        "Agricultural machinery, general, production {CH}": output.manejo_cultivo.application_of_plant_protection_product.UF_1_kg_produccion,
-        "Agricultural machinery, tillage, production {CH}": 0,
-        "Application of plant protection products, by field sprayer {CH}": output.manejo_cultivo.application_of_plant_protection_product.rendimiento_h_ha,
-        "Combine harvesting {CH}": 0,
-        "Diesel, burned in agricultural machine {CH}": output.maquinaria.cosechadora.UF_kg, # Algunos podrían ser arrays puesto que hay elementos con mismo nombre
-        "Harvester, production {CH}": output.maquinaria.cosechadora.UF_kg_fabricacion,
-        "Planting {CH}": 0,
-        "Tillage, cultivating, chiselling {CH}": 0,
-        "Tillage, harrowing, by rotary harrow {CH}": 0,
-        "Tractor, production {CH}": output.maquinaria.cosechadora.UF_kg_fabricacion_produccion,
-        "xx Tillage, rotary cultivator {CH}": 0,
-        "Occupation, annual crop, irrigated": output.manejo_cultivo.ocupacion_suelo,
-        "Transformation, to annual crop, irrigated": 0,
-        "Water, unspecified natural origin, ES": output.manejo_cultivo.uso_de_agua
-    }
-    manejo_de_cultivo.outputs = {
-        "Manejo de cultivo T": 1
-    }
+def impact_list(impact_categories: list[o.Ref], amounts) -> list[dict]:
+    return [
+        {
+            "category": c.name,
+            "amount": float(a),
+            "unit": c.ref_unit
+        } for c, a in zip(impact_categories, amounts)
+    ]
 
-    pesticidas = FlowDict()
-    pesticidas.inputs = {
-        "Acetamide-anillide-compounds, at regional storehouse {RER}": output.fitosanitarios["Acetamide-anillide-compound, unspecified {RER}| production"],
-        "Cyclic N-compounds, at regional storehouse {RER}": 0,
-        "Dinitroaniline-compounds, at regional storehouse {RER}": 0,
-        "Glyphosate, at regional storehouse {RER}": 0,
-        "Metolachlor, at regional storehouse {RER}": 0,
-        "Nitrile-compounds, at regional storehouse {RER}": 0,
-        "Organophosphorus-compounds, at regional storehouse {RER}": 0,
-        "Pendimethalin, at regional storage {RER}": 0,
-        "Pesticide unspecified, at regional storehouse {RER}": output.fitosanitarios["Pesticice, unspecified {RER}| pesticice, unspecified production"],
-        "Phenoxy-compounds, at regional storehouse {RER}": 0,
-        "Pyretroid-compounds, at regional storehouse {RER}": 0,
-        "Triazine-compounds, at regional storehouse {RER}": 0,
-        "xx Captan, at regional storage {RER}": 0,
-        "xx Diazole-compounds, at regional storehouse {RER}": 0,
-        "xx Folpet, at regional storage {RER}": 0,
-        "xx Pyridine-compounds, at regional storehouse {RER}": output.fitosanitarios[" Pyridine-compound {RER}|  pyridine-compound production"]
-    }
-    pesticidas.outputs = {
-        "Pesticidas T": 1,
-        "Pendimethalin, at regional storage {RER}": 0,
-        "Chlorpyrifos": 0,
-        "Metalaxyl-M": 0,
-        "Imidacloprid": 0,
-        "Alpha-cypermethrin": 0,
-        "Abamectin": 0,
-        "Folpet": 0,
-        "PYRIDINE": 0,
-        "Pesticides, unspecified": 0,
-        "Tebuconazole": 0,
-        "Metribuzin": 0,
-        "Lambda-cyhalothrin": 0,
-        "Pesticides, unspecified": 0,
-        "Tebuconazole": 0,
-        "Pendimethalin": 0,
-        "Metribuzin": 0,
-        "Lambda-cyhalothrin": 0
+compiled_mappings: dict[str, CompiledMapping] = {}
+
+def get_ventum_mapping(crop: str) -> CompiledMapping:
+    # El mapeo se compila contra los intercambios de los procesos y se rehace
+    # solo cuando cambia la revisión de la base de datos
+    if crop not in ventum_mappings:
+        raise HTTPException(status_code=404, detail=f"unknown crop {crop!r}")
+    compiled = compiled_mappings.get(crop)
+    if compiled is None or compiled.revision != client.revision:
+        mapping = ventum_mappings[crop]
+        revision = client.revision
+        processes = {name: client.get_process(name=name) for name in mapping.stages.values()}
+        product_system = client.find(o.ProductSystem, name=mapping.product_system)
+        if product_system is None:
+            raise ValueError(f"product system {mapping.product_system!r} not found")
+        compiled = compiled_mappings[crop] = mapping.compile(processes, revision, product_system)
+    return compiled
+
+def warm_up() -> None:
+    # Carga los índices de nombres, el método de impacto y, por cultivo, el mapeo
+    # compilado (procesos y sistema de producto) y los vectores de fondo, para que la
+    # primera petición no los pague. Si el servidor IPC aún no responde, se reintenta
+    delay = 1
+    while True:
+        warmup["attempts"] += 1
+        try:
+            def step(name: str, f) -> None:
+                started = time.perf_counter()
+                f()
+                warmup["seconds"][name] = round(time.perf_counter() - started, 3)
+
+            step("indexes", client.refresh_index)
+            step("impact_method", lambda: client.get_impact_method(VENTUM_IMPACT_METHOD_UID))
+            for crop in ventum_mappings:
+                step(f"{crop}.mapping", lambda: get_ventum_mapping(crop))
+                if VENTUM_ACV_MODE == "precomputed":
+                    step(f"{crop}.background_vectors", lambda: backgrounds[crop].get(VENTUM_IMPACT_METHOD_UID))
+                if WARMUP_CALCULATION:
+                    step(f"{crop}.calculation", lambda: warm_up_calculation(get_ventum_mapping(crop)))
+        except Exception as e:
+            warmup["error"] = f"{type(e).__name__}: {e}"
+            log.warning("warm-up attempt %i failed, retrying in %i s: %s", warmup["attempts"], delay, warmup["error"])
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+            continue
+        warmup["error"] = None
+        warmup["ready"] = True
+        log.info("warm-up finished: %s", warmup["seconds"])
+        return
+
+def warm_up_calculation(mapping: CompiledMapping) -> None:
+    # Un cálculo por réplica para que cada JVM compile el solver antes de recibir tráfico;
+    # el reparto por menos peticiones en curso las lleva a réplicas distintas
+    for _ in client.client.endpoints:
+        with client.calculate_product_system_impact(
+            product_system_uid=mapping.product_system.id,
+            impact_method_uid=VENTUM_IMPACT_METHOD_UID,
+            amount=0.001
+        ) as result:
+            result.get_total_impacts()
+
+def ventum_acv_parameters(mapping: CompiledMapping, output: VentumACVOutput) -> dict:
+    # Cada petición redefine los parámetros en su propio CalculationSetup: los procesos
+    # compartidos no se modifican y las peticiones pueden ejecutarse en paralelo
+    with client.calculate_product_system_impact(
+        product_system_uid=mapping.product_system.id,
+        impact_method_uid=VENTUM_IMPACT_METHOD_UID,
+        amount=0.001,
+        parameters=mapping.parameter_redefs(output)
+    ) as result:
+        contributions = client.get_stage_contributions(result, list(mapping.crop.stages.values()))
+
+    response = {
+        key: impact_list(contributions.impact_categories, contributions.of(name))
+        for key, name in mapping.crop.stages.items()
     }
+    response["impacto_total"] = impact_list(contributions.impact_categories, contributions.total)
+    return response
+
+def check_ventum_output(crop: CropMapping, output: VentumACVOutput) -> None:
+    missing = crop.missing(output)
+    if missing:
+        raise HTTPException(status_code=422, detail=f"keys required by the {crop.name} mapping are missing: {missing}")
+
+@app.post("/ventum-acv")
+def post_ventum_acv(output: VentumACVOutput, cultivo: str = "TOMATE"):
+    mapping = get_ventum_mapping(cultivo)
+    check_ventum_output(mapping.crop, output)
+    if VENTUM_ACV_MODE == "parameters":
+        key = ("ventum-acv", cultivo, canonical_hash(output.model_dump(mode="json")), client.revision)
+        return coalescer.run(key, lambda: ventum_acv_parameters(mapping, output))
 
-    sistema_de_riego = FlowDict()
-    sistema_de_riego.inputs = {
-        "Water, well, RER": output.manejo_cultivo.uso_de_agua,
-        "Steel, low alloyed, secondary production (100% Rec.) {CH}": 0,
-        "Steel product manufacturing, average metal working {RER}": output.bombeo.kg_acero_ha_produccion,
-        "Polypropylene, granulate, at plant {RER}": output.riegos.kg_PP_produccion,
-        "Stretch blow moulding {RER}": 0,
-        "Extrusion, plastic pipes {RER}": 0,
-        "Polystyrene, expandable, at plant {RER}": output.riegos.kg_PE_produccion,
-        "Polyvinylchloride, emulsion polymerised, at plant {RER}": output.riegos.kg_PVC_produccion,
-        "Tractor, production {CH}": 0,
-        "Diesel, burned in agricultural machine {CH}": 0,
-        "Transport, freight, lorry, 7.5t-16t gross weight, fleet average {RER}": 0,
-        "Polyethylene, HDPE, granulate, at plant {RER}": 0,
-        "Electricity, low voltage, production from oil, at grid {CH}": 0
+    # Producto matriz-vector sobre los vectores precalculados: no se escribe en la base de datos
+    vectors = backgrounds[cultivo].get(VENTUM_IMPACT_METHOD_UID)
+    stages, total = vectors.evaluate(mapping.amounts(output), amount=0.001)
+
+    response = {
+        key: impact_list(vectors.impact_categories, stages[name])
+        for key, name in mapping.crop.stages.items()
     }
-    sistema_de_riego.outputs = {
-        "Sistema de riego T": 1,
-        "xx Recycling PVC {RER}": output.riegos.kg_PVC_ha_anio,
-        "xx Recycling PP {RER}": output.riegos.kg_PP_ha_anio,
-        "xx Recycling PE {RER}": output.riegos.kg_PE_ha_anio,
-        "Recycling steel and iron {RER}": 0
+    response["impacto_total"] = impact_list(vectors.impact_categories, total)
+    return response
+
+async def ventum_batch_items(request: Request):
+    # Acepta un array JSON o un stream NDJSON (una parcela por línea), en bloques
+    if "ndjson" not in request.headers.get("content-type", ""):
+        items = json.loads(await request.body())
+        if not isinstance(items, list):
+            raise ValueError("the body must be a JSON array or NDJSON")
+        for start in range(0, len(items), VENTUM_BATCH_SIZE):
+            yield items[start:start + VENTUM_BATCH_SIZE]
+        return
+
+    buffer, chunk, number = b"", [], 0
+    async for data in request.stream():
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            number += 1
+            if line.strip():
+                chunk.append(ndjson_item(line, number))
+        if len(chunk) >= VENTUM_BATCH_SIZE:
+            yield chunk
+            chunk = []
+    if buffer.strip():
+        chunk.append(ndjson_item(buffer, number + 1))
+    if chunk:
+        yield chunk
+
+class InvalidLine:
+    # Línea NDJSON que no se puede leer; se responde con su error y el lote sigue
+    def __init__(self, number: int, error: ValueError):
+        self.number = number
+        self.error = error
+
+def ndjson_item(line: bytes, number: int):
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return InvalidLine(number, e)
+
+def ventum_batch_responses(mapping: CompiledMapping, vectors, items: list, offset: int) -> list[dict]:
+    responses, valid, outputs = [], [], []
+    for i, item in enumerate(items):
+        if isinstance(item, InvalidLine):
+            responses.append({
+                "index": offset + i,
+                "line": item.number,
+                "error": [{"type": "json_invalid", "loc": [], "msg": f"Invalid JSON: {item.error}"}]
+            })
+            continue
+        try:
+            output = VentumACVOutput.model_validate(item)
+        except ValidationError as e:
+            responses.append({"index": offset + i, "error": e.errors(include_url=False)})
+            continue
+        # Válida para el modelo pero sin alguna clave que usa el mapeo del cultivo
+        missing = mapping.crop.missing(output)
+        if missing:
+            responses.append({
+                "index": offset + i,
+                "error": [
+                    {"type": "missing", "loc": [path], "msg": f"Required by the {mapping.crop.name} mapping"}
+                    for path in missing
+                ]
+            })
+            continue
+        outputs.append(output)
+        valid.append(len(responses))
+        responses.append({"index": offset + i})
+
+    if outputs:
+        stages, total = vectors.evaluate_batch(mapping.amounts_batch(outputs), amount=0.001)
+        for column, position in enumerate(valid):
+            response = responses[position]
+            for key, name in mapping.crop.stages.items():
+                response[key] = impact_list(vectors.impact_categories, stages[name][:, column])
+            response["impacto_total"] = impact_list(vectors.impact_categories, total[:, column])
+    return responses
+
+@app.post("/ventum-acv/batch")
+async def post_ventum_acv_batch(request: Request, cultivo: str = "TOMATE"):
+    mapping = await run_in_threadpool(get_ventum_mapping, cultivo)
+    vectors = await run_in_threadpool(backgrounds[cultivo].get, VENTUM_IMPACT_METHOD_UID)
+    # El cuerpo se lee antes de empezar a responder: Starlette no permite leer la
+    # petición mientras una StreamingResponse escucha la desconexión del cliente
+    try:
+        chunks = [items async for items in ventum_batch_items(request)]
+    except ValueError as e:
+        # json.JSONDecodeError y UnicodeDecodeError son ValueError
+        raise HTTPException(status_code=400, detail=f"invalid batch body: {e}")
+
+    def results():
+        offset = 0
+        for items in chunks:
+            for response in ventum_batch_responses(mapping, vectors, items, offset):
+                yield json.dumps(response, default=str) + "\n"
+            offset += len(items)
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+ventum_jacobians: dict[str, VentumJacobian] = {}
+
+def get_ventum_jacobian(crop: str) -> VentumJacobian:
+    # Se calcula a partir de los vectores de fondo, también con VENTUM_ACV_MODE=parameters,
+    # y se rehace con ellos cuando cambia la revisión
+    mapping = get_ventum_mapping(crop)
+    vectors = backgrounds[crop].get(VENTUM_IMPACT_METHOD_UID)
+    jacobian = ventum_jacobians.get(crop)
+    if jacobian is None or jacobian.revision != vectors.revision:
+        jacobian = ventum_jacobians[crop] = build_jacobian(mapping, vectors, amount=0.001)
+    return jacobian
+
+def derivative_list(jacobian: VentumJacobian, matrix: np.ndarray) -> list[dict]:
+    return [
+        {
+            "category": c.name,
+            "unit": c.ref_unit,
+            "derivatives": dict(zip(jacobian.fields, map(float, row)))
+        } for c, row in zip(jacobian.impact_categories, matrix)
+    ]
+
+@app.get("/ventum-acv/sensitivity")
+def get_ventum_acv_sensitivity(cultivo: str = "TOMATE"):
+    # ∂impacto/∂campo por categoría: cuánto cambia cada impacto de /ventum-acv por
+    # unidad de cada campo del mapeo
+    mapping = get_ventum_mapping(cultivo)
+    jacobian = get_ventum_jacobian(cultivo)
+    response = {"fields": jacobian.fields}
+    for key, name in mapping.crop.stages.items():
+        response[key] = derivative_list(jacobian, jacobian.stages[name])
+    response["impacto_total"] = derivative_list(jacobian, jacobian.total)
+    return response
+
+class SweepRange(BaseModel):
+    start: float
+    stop: float
+    steps: int = Field(ge=1)
+
+class VentumSweep(BaseModel):
+    output: VentumACVOutput
+    # Ruta de campo -> valores (lista o rango con extremos incluidos); se evalúa el
+    # producto cartesiano de todos, con el resto de campos como en output
+    grid: Annotated[dict[str, Annotated[list[float], Field(min_length=1)] | SweepRange], Field(min_length=1)]
+
+@app.post("/ventum-acv/sweep")
+def post_ventum_acv_sweep(params: VentumSweep, cultivo: str = "TOMATE"):
+    mapping = get_ventum_mapping(cultivo)
+    unknown = [path for path in params.grid if path not in mapping.crop.field_index]
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"fields not used by the {cultivo} mapping: {unknown}")
+    check_ventum_output(mapping.crop, params.output)
+    paths = list(params.grid)
+    axes = [
+        np.linspace(g.start, g.stop, g.steps) if isinstance(g, SweepRange) else np.array(g, dtype=float)
+        for g in params.grid.values()
+    ]
+    shape = tuple(len(axis) for axis in axes)
+    points = int(np.prod(shape, dtype=object))
+    if points > VENTUM_SWEEP_MAX_POINTS:
+        raise HTTPException(status_code=422, detail=f"the grid has {points} points, the limit is {VENTUM_SWEEP_MAX_POINTS}")
+
+    # Sin openLCA: impactos de la parcela de output más el jacobiano por el cambio de
+    # los campos barridos
+    jacobian = get_ventum_jacobian(cultivo)
+    vectors = backgrounds[cultivo].get(VENTUM_IMPACT_METHOD_UID)
+    impacts, total = vectors.evaluate(mapping.amounts(params.output), amount=0.001)
+    columns = np.array([mapping.crop.field_index[path] for path in paths], dtype=int)
+    center = mapping.values([params.output])[columns, 0]
+
+    def results():
+        for start in range(0, points, VENTUM_BATCH_SIZE):
+            index = np.unravel_index(np.arange(start, min(start + VENTUM_BATCH_SIZE, points)), shape)
+            values = np.array([axis[i] for axis, i in zip(axes, index)]).reshape(len(axes), -1)
+            stages, totals = jacobian.sweep(columns, values - center[:, None], impacts, total)
+            # Una lista de floats por punto: convertir el bloque entero es mucho más
+            # rápido que elemento a elemento
+            stages = {key: stages[name].T.tolist() for key, name in mapping.crop.stages.items()}
+            stages["impacto_total"] = totals.T.tolist()
+            lines = []
+            for column, point in enumerate(values.T.tolist()):
+                response = {"index": start + column, "values": dict(zip(paths, point))}
+                for key, rows in stages.items():
+                    response[key] = impact_list(jacobian.impact_categories, rows[column])
+                lines.append(json.dumps(response) + "\n")
+            # Un bloque por iteración: Starlette pasa cada elemento por un hilo
+            yield "".join(lines)
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+# Monte Carlo: un pool de procesos compartido que reparte los bloques de iteraciones y
+# modelos guardados; un modelo vale mientras no cambie la revisión. Los modelos se
+# construyen como trabajos (descargan los procesos de fondo): la petición espera como
+# mucho MONTE_CARLO_BUILD_WAIT segundos y si no, responde 202 para que se repita
+MONTE_CARLO_WORKERS = int(os.getenv("MONTE_CARLO_WORKERS", str(os.cpu_count() or 1)))
+MONTE_CARLO_MAX_ITERATIONS = int(os.getenv("MONTE_CARLO_MAX_ITERATIONS", "100000"))
+MONTE_CARLO_BUILD_WAIT = float(os.getenv("MONTE_CARLO_BUILD_WAIT", "2"))
+MONTE_CARLO_MODELS = 8
+monte_carlo_pool = WorkerPool(MONTE_CARLO_WORKERS, models=MONTE_CARLO_MODELS)
+monte_carlo_models: OrderedDict[tuple, MonteCarloModel] = OrderedDict()
+monte_carlo_builds: dict[tuple, Job] = {}
+monte_carlo_lock = threading.Lock()
+
+def drop_monte_carlo_models(*_) -> None:
+    # Las construcciones en curso terminan, pero ya no se guardan
+    with monte_carlo_lock:
+        monte_carlo_models.clear()
+        monte_carlo_builds.clear()
+
+client.on_change(drop_monte_carlo_models)
+
+class MonteCarloParams(BaseModel):
+    iterations: int = Field(1000, ge=2, le=MONTE_CARLO_MAX_ITERATIONS)
+    # Con semilla el resultado es reproducible; sin ella se devuelve la usada
+    seed: int | None = Field(None, ge=0)
+    percentiles: list[Annotated[float, Field(ge=0, le=100)]] = list(PERCENTILES)
+
+class VentumMonteCarlo(MonteCarloParams):
+    output: VentumACVOutput
+    # Ruta de campo de ventum_flows.yaml (p. ej. fertilizantes.kg_N) -> incertidumbre en
+    # el formato de openLCA, centrada en el valor del campo:
+    # {"distributionType": "LOG_NORMAL_DISTRIBUTION", "geomSd": 1.2}
+    uncertainty: dict[str, dict] = {}
+    # Muestrear también las incertidumbres de los intercambios de los procesos de fondo
+    background: bool = True
+
+class ProcessMonteCarlo(MonteCarloParams):
+    impact_method_uid: str
+    amount: float = 1
+
+def monte_carlo_model(key: tuple, build) -> MonteCarloModel:
+    # Un trabajo por modelo aunque lo pidan varias peticiones. Un modelo construido
+    # mientras cambiaba la base de datos no se guarda y se vuelve a construir
+    revision = client.revision
+    key = key + (revision,)
+
+    def build_and_store() -> dict:
+        model = build()
+        with monte_carlo_lock:
+            if client.revision == revision:
+                monte_carlo_models[key] = model
+                while len(monte_carlo_models) > MONTE_CARLO_MODELS:
+                    monte_carlo_models.popitem(last=False)
+        return {"model": list(key)}
+
+    with monte_carlo_lock:
+        job = monte_carlo_builds.get(key)
+        if job is None or job.is_finished:
+            model = monte_carlo_models.get(key)
+            if model is not None:
+                monte_carlo_models.move_to_end(key)
+                monte_carlo_builds.pop(key, None)
+                return model
+        if job is not None and job.state == FAILED:
+            # El error se devuelve una vez; la siguiente petición lo vuelve a intentar
+            del monte_carlo_builds[key]
+            raise HTTPException(status_code=422, detail=f"Monte Carlo model cannot be built: {job.error}")
+        if job is None or job.is_finished:
+            try:
+                job = monte_carlo_builds[key] = jobs.submit("monte-carlo-model", "ipc", build_and_store)
+            except QueueFull as e:
+                raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
+
+    deadline = time.monotonic() + MONTE_CARLO_BUILD_WAIT
+    while not job.is_finished and time.monotonic() < deadline:
+        time.sleep(0.05)
+    if job.is_finished:
+        return monte_carlo_model(key[:-1], build)
+    raise HTTPException(
+        status_code=202,
+        detail=f"the Monte Carlo model is being built by job {job.id}, retry the request",
+        headers={"Retry-After": "5", "Location": f"/jobs/{job.id}"}
+    )
+
+def uncertainty_list(impact_categories: list[o.Ref], samples, percentiles: list[float]) -> list[dict]:
+    # samples: una fila por categoría y una columna por iteración
+    values = np.percentile(samples, percentiles, axis=1)
+    return [
+        {
+            "category": c.name,
+            "unit": c.ref_unit,
+            "mean": float(samples[k].mean()),
+            "sd": float(samples[k].std(ddof=1)),
+            "percentiles": {str(p): float(values[i, k]) for i, p in enumerate(percentiles)}
+        } for k, c in enumerate(impact_categories)
+    ]
+
+def monte_carlo_response(model: MonteCarloModel, result, percentiles: list[float]) -> dict:
+    return {
+        "iterations": result.iterations,
+        "seed": result.seed,
+        "exact_solves": result.exact_solves,
+        "impacto_total": uncertainty_list(model.impact_categories, result.totals, percentiles)
     }
 
-    product_system = client.get_product_system(name="TOMATE")
-    fertilizantes_process = client.get_process(name="Fertilizantes T")
-    manejo_de_cultivo_process = client.get_process(name="Manejo de cultivo T")
-    pesticidas_process = client.get_process(name="Pesticidas T")
-    sistema_de_riego_process = client.get_process(name="Sistema de riego T")
-
-    def update_process_exchanges(process, flow_dict: FlowDict) -> None:
-        for exchange in process.exchanges:
-            if exchange.is_input:
-                exchange.amount = flow_dict.inputs[exchange.flow.name]
-            else:
-                exchange.amount = flow_dict.outputs[exchange.flow.name]
-        client.update_process(process)
-
-    update_process_exchanges(fertilizantes_process, fertilizantes)
-    update_process_exchanges(manejo_de_cultivo_process, manejo_de_cultivo)
-    update_process_exchanges(pesticidas_process, pesticidas)
-    update_process_exchanges(sistema_de_riego_process, sistema_de_riego)
-
-    result = client.calculate_product_system_impact(product_system_uid=product_system.id, impact_method_uid="2f995579-06bd-4681-b07c-cee3b1805b0d", amount=0.001)
-    impacts = result.get_total_impacts()
-
-    tech_flows = result.get_total_requirements()
-    
-    fertilizantes_tech_flow = next((tf.tech_flow for tf in tech_flows if tf.tech_flow.flow.name == "Fertilizantes T"), None)
-    manejo_cultivo_tech_flow = next((tf.tech_flow for tf in tech_flows if tf.tech_flow.flow.name == "Manejo de cultivo T"), None)
-    pesticidas_tech_flow = next((tf.tech_flow for tf in tech_flows if tf.tech_flow.flow.name == "Pesticidas T"), None)
-    sistema_riego_tech_flow = next((tf.tech_flow for tf in tech_flows if tf.tech_flow.flow.name == "Sistema de riego T"), None)
-    
-    impact_fertilizantes = result.get_total_impacts_of(tech_flow=fertilizantes_tech_flow)
-    impact_manejo_cultivo = result.get_total_impacts_of(tech_flow=manejo_cultivo_tech_flow)
-    impact_pesticidas = result.get_total_impacts_of(tech_flow=pesticidas_tech_flow)
-    impact_sistema_riego = result.get_total_impacts_of(tech_flow=sistema_riego_tech_flow)
-
-    result.dispose()
+@app.post("/ventum-acv/monte-carlo")
+def post_ventum_acv_monte_carlo(params: VentumMonteCarlo, cultivo: str = "TOMATE"):
+    mapping = get_ventum_mapping(cultivo)
+    unknown = [path for path in params.uncertainty if path not in mapping.crop.field_index]
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"fields not used by the {cultivo} mapping: {unknown}")
+    check_ventum_output(mapping.crop, params.output)
+    try:
+        uncertainty = {mapping.crop.field_index[path]: o.Uncertainty.from_dict(u) for path, u in params.uncertainty.items()}
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f"invalid uncertainty: {e}")
+
+    def build() -> MonteCarloModel:
+        matrices = matrix_engine.get_matrices(mapping.product_system.id, VENTUM_IMPACT_METHOD_UID)
+        return build_ventum_model(client, matrices, mapping, params.background, monte_carlo_pool)
+
+    model = monte_carlo_model(("ventum", cultivo, params.background), build)
+    try:
+        result = model.run(
+            params.iterations,
+            seed=params.seed,
+            amount=0.001,
+            values=mapping.values([params.output])[:, 0],
+            uncertainty=uncertainty
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    response = monte_carlo_response(model, result, params.percentiles)
+    for key, name in mapping.crop.stages.items():
+        response[key] = uncertainty_list(model.impact_categories, result.stages[name], params.percentiles)
+    return response
+
+@app.post("/process/{uid}/impact/monte-carlo")
+def post_process_impact_monte_carlo(uid: str, params: ProcessMonteCarlo):
+    def build() -> MonteCarloModel:
+        matrices = matrix_engine.get_process_matrices(uid, params.impact_method_uid)
+        return MonteCarloModel(matrices, background_uncertainties(client, matrices), pool=monte_carlo_pool)
+
+    model = monte_carlo_model(("process", uid, params.impact_method_uid), build)
+    try:
+        result = model.run(params.iterations, seed=params.seed, amount=params.amount)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return monte_carlo_response(model, result, params.percentiles)
+
+# Trabajos en segundo plano: hilos por backend (JOB_WORKERS_IPC llamadas simultáneas al
+# servidor openLCA, JOB_WORKERS_MATRIX al motor en memoria) y colas de JOB_QUEUE_SIZE
+jobs = JobQueue(
+    concurrency={
+        "ipc": int(os.getenv("JOB_WORKERS_IPC", "2")),
+        "matrix": int(os.getenv("JOB_WORKERS_MATRIX", str(os.cpu_count() or 4)))
+    },
+    max_queued=int(os.getenv("JOB_QUEUE_SIZE", "100")),
+    max_results=int(os.getenv("JOB_RESULTS", "1000"))
+)
+ENGINE_BACKEND = "matrix" if engine is matrix_engine else "ipc"
+
+class ProcessImpactJob(BaseModel):
+    type: Literal["process-impact"]
+    process_uid: str
+    impact_method_uid: ImpactMethods
+    amount: int = 1
 
+class ProductSystemImpactJob(BaseModel):
+    type: Literal["product-system-impact"]
+    product_system_uid: str
+    impact_method_uid: ImpactMethods
+    amount: int = 1
+
+class VentumACVJob(BaseModel):
+    type: Literal["ventum-acv"]
+    cultivo: str = "TOMATE"
+    output: VentumACVOutput
+
+PostJob = Annotated[ProcessImpactJob | ProductSystemImpactJob | VentumACVJob, Field(discriminator="type")]
+
+def product_system_impact(params: ProductSystemImpactJob) -> dict:
+    if isinstance(params.impact_method_uid, list):
+        def inventory() -> list[o.EnviFlowValue]:
+            with engine.calculate_product_system_impact(
+                product_system_uid=params.product_system_uid,
+                impact_method_uid=None,
+                amount=1
+            ) as result:
+                return result.get_total_flows()
+
+        def shared_inventory() -> list[o.EnviFlowValue]:
+            return coalescer.run(("product-system-inventory", params.product_system_uid, client.revision), inventory)
+
+        key = ("product-system", params.product_system_uid)
+        return {"impact_results": method_results(lcia.impacts(key, shared_inventory, params.impact_method_uid, params.amount))}
+
+    def total_impacts() -> list[o.ImpactValue]:
+        with engine.calculate_product_system_impact(
+            product_system_uid=params.product_system_uid,
+            impact_method_uid=params.impact_method_uid,
+            amount=params.amount
+        ) as result:
+            return result.get_total_impacts()
+
+    impacts = coalescer.run(
+        ("product-system-impact", params.product_system_uid, params.impact_method_uid, params.amount, client.revision),
+        total_impacts
+    )
     return {
-        "impacto_fertilizantes": [
-            {
-                "category": i.impact_category.name,
-                "amount": i.amount,
-                "unit": i.impact_category.ref_unit
-            } for i in impact_fertilizantes
-        ],
-        "impacto_manejo_cultivo": [
-            {
-                "category": i.impact_category.name,
-                "amount": i.amount,
-                "unit": i.impact_category.ref_unit
-            } for i in impact_manejo_cultivo
-        ],
-        "impacto_pesticidas": [
-            {
-                "category": i.impact_category.name,
-                "amount": i.amount,
-                "unit": i.impact_category.ref_unit
-            } for i in impact_pesticidas
-        ],
-        "impacto_sistema_riego": [
-            {
-                "category": i.impact_category.name,
-                "amount": i.amount,
-                "unit": i.impact_category.ref_unit
-            } for i in impact_sistema_riego
-        ],
-        "impacto_total": [
+        "impact_result": [
             {
                 "category": i.impact_category.name,
                 "amount": i.amount,
                 "unit": i.impact_category.ref_unit
             } for i in impacts
         ]
-    }
\ No newline at end of file
+    }
+
+@app.post("/jobs", status_code=202)
+def post_job(params: PostJob):
+    if isinstance(params, ProcessImpactJob):
+        request = PostProcessImpact(impact_method_uid=params.impact_method_uid, amount=params.amount)
+        run, backend = (lambda: post_process_impact(params.process_uid, request)), ENGINE_BACKEND
+    elif isinstance(params, ProductSystemImpactJob):
+        run, backend = (lambda: product_system_impact(params)), ENGINE_BACKEND
+    else:
+        if params.cultivo not in ventum_mappings:
+            raise HTTPException(status_code=404, detail=f"unknown crop {params.cultivo!r}")
+        check_ventum_output(ventum_mappings[params.cultivo], params.output)
+        run = lambda: post_ventum_acv(params.output, params.cultivo)
+        backend = "ipc" if VENTUM_ACV_MODE == "parameters" else "matrix"
+
+    try:
+        job = jobs.submit(params.type, backend, run)
+    except QueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
+    return {"id": job.id, "state": job.state}
+
+@app.get("/jobs")
+def get_jobs():
+    return jobs.stats()
+
+def find_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"unknown or expired job {job_id!r}")
+    return job
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    return jsonable_encoder(find_job(job_id).to_dict())
+
+@app.get("/jobs/{job_id}/events")
+async def get_job_events(job_id: str):
+    job = find_job(job_id)
+
+    async def events():
+        # Se consulta la versión del trabajo en el bucle de eventos en lugar de bloquear un
+        # hilo del threadpool por cada cliente conectado
+        version, idle = -1, 0.0
+        while True:
+            if job.version != version:
+                version, idle = job.version, 0.0
+                data = json.dumps(jsonable_encoder(job.to_dict()))
+                yield f"event: {job.state}\ndata: {data}\n\n"
+                if job.is_finished:
+                    return
+            elif idle >= 15:
+                idle = 0.0
+                yield ": keep-alive\n\n"
+            await asyncio.sleep(0.2)
+            idle += 0.2
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
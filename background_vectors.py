@@ -0,0 +1,272 @@
+import json
+import logging as log
+import os
+import tempfile
+import threading
+
+import numpy as np
+import olca_schema as o
+
+from matrix_engine import MatrixEngine, exchange_rows
+from olca_client import OLCAClient
+
+
+class StageVectors:
+    # Vector LCIA por unidad de cada intercambio de un proceso de primer plano.
+    # Los intercambios siguen el orden de process.exchanges
+    def __init__(
+        self,
+        name: str,
+        exchanges: list[tuple[str, bool]],
+        vectors: np.ndarray,
+        reference: int,
+        requirement: float
+    ):
+        self.name = name
+        self.exchanges = exchanges
+        self.vectors = vectors
+        self.reference = reference
+        self.requirement = requirement
+
+    def impacts(self, amounts: np.ndarray) -> np.ndarray:
+        return self.requirement * (self.vectors @ amounts) / amounts[self.reference]
+
+
+class BackgroundVectors:
+    def __init__(
+        self,
+        impact_method_uid: str,
+        revision: int,
+        impact_categories: list[o.Ref],
+        stages: dict[str, StageVectors],
+        base: np.ndarray,
+        fingerprint: str | None = None
+    ):
+        self.impact_method_uid = impact_method_uid
+        self.revision = revision
+        self.impact_categories = impact_categories
+        self.stages = stages
+        self.base = base
+        # Huella de la base de datos con la que se calcularon (OLCAClient.fingerprint)
+        self.fingerprint = fingerprint
+
+    def evaluate(self, amounts: dict[str, np.ndarray], amount: float) -> tuple[dict[str, np.ndarray], np.ndarray]:
+        # amounts: cantidades de los intercambios de cada etapa (CompiledMapping.amounts)
+        impacts = {
+            name: amount * stage.impacts(amounts[name])
+            for name, stage in self.stages.items()
+        }
+        total = amount * self.base + sum(impacts.values())
+        return impacts, total
+
+    def evaluate_batch(self, amounts: dict[str, np.ndarray], amount: float) -> tuple[dict[str, np.ndarray], np.ndarray]:
+        # Una columna por parcela: cada etapa es un único producto matriz-matriz
+        impacts = {
+            name: amount * stage.impacts(amounts[name])
+            for name, stage in self.stages.items()
+        }
+        total = amount * self.base[:, None] + sum(impacts.values())
+        return impacts, total
+
+    def save(self, path: str) -> None:
+        meta = {
+            "impact_method_uid": self.impact_method_uid,
+            "revision": self.revision,
+            "fingerprint": self.fingerprint,
+            "impact_categories": [c.to_dict() for c in self.impact_categories],
+            "stages": [
+                {
+                    "name": s.name,
+                    "exchanges": s.exchanges,
+                    "reference": s.reference,
+                    "requirement": s.requirement
+                } for s in self.stages.values()
+            ]
+        }
+        arrays = {f"stage_{i}": s.vectors for i, s in enumerate(self.stages.values())}
+        # Fichero temporal propio y rename: otros workers pueden estar leyendo o guardando
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, meta=json.dumps(meta), base=self.base, **arrays)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load(path: str) -> "BackgroundVectors":
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            stages = {
+                s["name"]: StageVectors(
+                    name=s["name"],
+                    exchanges=[tuple(e) for e in s["exchanges"]],
+                    vectors=data[f"stage_{i}"],
+                    reference=s["reference"],
+                    requirement=s["requirement"]
+                ) for i, s in enumerate(meta["stages"])
+            }
+            return BackgroundVectors(
+                impact_method_uid=meta["impact_method_uid"],
+                revision=meta["revision"],
+                impact_categories=[o.Ref.from_dict(c) for c in meta["impact_categories"]],
+                stages=stages,
+                base=data["base"],
+                fingerprint=meta.get("fingerprint")
+            )
+
+
+def build_background_vectors(
+    client: OLCAClient,
+    engine: MatrixEngine,
+    product_system_name: str,
+    impact_method_uid: str,
+    stage_names: list[str]
+) -> BackgroundVectors:
+    revision = client.revision
+    product_system = client.get_product_system(name=product_system_name)
+    matrices = engine.get_matrices(product_system.id, impact_method_uid)
+    n, k = len(matrices.tech_flows), len(matrices.impact_categories)
+
+    processes = {name: client.get_process(name=name) for name in stage_names}
+    stage_index, stage_rows = {}, {}
+    for name, process in processes.items():
+        stage_index[name], stage_rows[name] = exchange_rows(matrices, process)
+    providers = {i for rows in stage_rows.values() for kind, i, _ in filter(None, rows) if kind == "A"}
+
+    # Intensidades por unidad de todos los proveedores y etapas en un único solve
+    columns = sorted(providers | set(stage_index.values()))
+    unit = np.zeros((n, len(columns)))
+    unit[columns, range(len(columns))] = 1
+    intensities = matrices.characterization @ (matrices.interventions @ matrices.solve(unit))
+    intensity = {j: intensities[:, c] for c, j in enumerate(columns)}
+
+    scaling = matrices.solve(matrices.demand(1))
+    total = matrices.impacts_of(scaling)
+    diagonal = matrices.technosphere.diagonal()
+
+    stages = {}
+    base = total.copy()
+    for name, process in processes.items():
+        j = stage_index[name]
+        requirement = scaling[j] * diagonal[j]
+        base -= requirement * intensity[j]
+
+        exchanges, vectors, reference = [], [], 0
+        for position, (e, row) in enumerate(zip(process.exchanges, stage_rows[name])):
+            exchanges.append((e.flow.name, bool(e.is_input)))
+            if e.is_quantitative_reference:
+                reference = position
+                vectors.append(np.zeros(k))
+            elif row is None:
+                vectors.append(np.zeros(k))
+            elif row[0] == "B":
+                kind, i, sign = row
+                vectors.append(sign * matrices.characterization[:, [i]].toarray().ravel())
+            else:
+                # Una celda -a de A es una demanda de a al proveedor de esa fila
+                kind, i, sign = row
+                vectors.append(-sign * intensity[i])
+
+        stages[name] = StageVectors(
+            name=name,
+            exchanges=exchanges,
+            vectors=np.column_stack(vectors),
+            reference=reference,
+            requirement=float(requirement)
+        )
+
+    return BackgroundVectors(
+        impact_method_uid=impact_method_uid,
+        revision=revision,
+        impact_categories=matrices.impact_categories,
+        stages=stages,
+        base=base
+    )
+
+
+class BackgroundVectorCache:
+    # Guarda un BackgroundVectors por método de impacto y lo recalcula solo cuando
+    # cambia la revisión de la base de datos (o al llamar a refresh)
+    def __init__(
+        self,
+        client: OLCAClient,
+        engine: MatrixEngine,
+        product_system_name: str,
+        stage_names: list[str],
+        directory: str | None = None
+    ):
+        self.client = client
+        self.engine = engine
+        self.product_system_name = product_system_name
+        self.stage_names = stage_names
+        self.directory = directory
+        self._vectors: dict[str, BackgroundVectors] = {}
+        # Huella por método y revisión: descargar el sistema y sus procesos cuesta casi
+        # tanto como lo que se ahorra, así que solo se repite tras una escritura o refresh
+        self._fingerprints: dict[str, tuple[int, str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, impact_method_uid: str) -> BackgroundVectors:
+        vectors = self._vectors.get(impact_method_uid)
+        if vectors is not None and vectors.revision == self.client.revision:
+            return vectors
+        with self._lock:
+            vectors = self._vectors.get(impact_method_uid)
+            if vectors is None and self.directory:
+                path = self._path(impact_method_uid)
+                if os.path.exists(path):
+                    saved = BackgroundVectors.load(path)
+                    # El fichero vale mientras no cambien el sistema, sus procesos o el
+                    # método, aunque los cambie otro worker o la aplicación de escritorio
+                    if saved.fingerprint is not None and saved.fingerprint == self._fingerprint(impact_method_uid):
+                        saved.revision = self.client.revision
+                        vectors = saved
+                    else:
+                        log.info("%s is out of date, rebuilding it", path)
+            if vectors is None or vectors.revision != self.client.revision:
+                vectors = self._build(impact_method_uid)
+            self._vectors[impact_method_uid] = vectors
+        return vectors
+
+    def refresh(self, impact_method_uid: str | None = None) -> None:
+        with self._lock:
+            methods = [impact_method_uid] if impact_method_uid else list(self._vectors)
+            for method in methods:
+                self._vectors.pop(method, None)
+                self._fingerprints.pop(method, None)
+                if self.directory and os.path.exists(self._path(method)):
+                    os.remove(self._path(method))
+        self.engine.invalidate()
+
+    def _fingerprint(self, impact_method_uid: str) -> str:
+        revision = self.client.revision
+        cached = self._fingerprints.get(impact_method_uid)
+        if cached is not None and cached[0] == revision:
+            return cached[1]
+        system = self.client.get_product_system(name=self.product_system_name)
+        method = self.client.get_impact_method(impact_method_uid)
+        refs = [o.Ref(ref_type=o.RefType.ProductSystem, id=system.id)]
+        refs.extend(o.Ref(ref_type=p.ref_type or o.RefType.Process, id=p.id) for p in system.processes or [])
+        if method is not None:
+            refs.append(o.Ref(ref_type=o.RefType.ImpactMethod, id=method.id))
+            refs.extend(o.Ref(ref_type=o.RefType.ImpactCategory, id=c.id) for c in method.impact_categories or [])
+        fingerprint = self.client.fingerprint(refs)
+        self._fingerprints[impact_method_uid] = (revision, fingerprint)
+        return fingerprint
+
+    def _build(self, impact_method_uid: str) -> BackgroundVectors:
+        # La huella se toma antes de calcular: un cambio durante el cálculo la invalida
+        fingerprint = self._fingerprint(impact_method_uid) if self.directory else None
+        vectors = build_background_vectors(
+            client=self.client,
+            engine=self.engine,
+            product_system_name=self.product_system_name,
+            impact_method_uid=impact_method_uid,
+            stage_names=self.stage_names
+        )
+        vectors.fingerprint = fingerprint
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            vectors.save(self._path(impact_method_uid))
+        return vectors
+
+    def _path(self, impact_method_uid: str) -> str:
+        return os.path.join(self.directory, f"{self.product_system_name}-{impact_method_uid}.npz")
@@ -0,0 +1,167 @@
+import argparse
+import importlib.util
+import json
+import os
+import re
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import httpx
+import numpy as np
+import uvicorn
+
+from fake_ipc_server import DEFAULT_IMPACT_METHOD_UID, FakeIPCServer, SyntheticDatabase
+
+# Mide la API de api-test.py de extremo a extremo contra fake_ipc_server: arranca el
+# servidor falso y uvicorn en este proceso, lanza cada escenario con varios hilos y
+# muestra p50/p99 y peticiones por segundo. Con --baseline compara con una ejecución
+# anterior guardada con --output y termina con error si algún escenario empeora
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def ventum_body() -> dict:
+    # salida_ventum_acv.json lleva comentarios // que JSON no admite
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "salida_ventum_acv.json")
+    with open(path) as f:
+        return json.loads(re.sub(r"//[^\n]*", "", f.read()))
+
+
+def start_api(ipc_port: int, engine: str) -> tuple[uvicorn.Server, threading.Thread, str]:
+    os.environ["OLCA_IPC_ENDPOINTS"] = f"http://127.0.0.1:{ipc_port}"
+    if engine == "matrix":
+        os.environ["OLCA_ENGINE"] = "matrix"
+    spec = importlib.util.spec_from_file_location("api_test", os.path.join(os.path.dirname(os.path.abspath(__file__)), "api-test.py"))
+    api = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(api)
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(api.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, name="benchmark-api", daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    # Se mide con la API ya precalentada
+    while httpx.get(f"http://127.0.0.1:{port}/ready").status_code != 200:
+        time.sleep(0.2)
+    return server, thread, f"http://127.0.0.1:{port}"
+
+
+def run_scenario(name: str, request: Callable[[httpx.Client, int], httpx.Response], requests: int, concurrency: int, warmup: int) -> dict:
+    local = threading.local()
+
+    def timed(i: int) -> tuple[float, bool]:
+        if not hasattr(local, "http"):
+            local.http = httpx.Client(base_url=base_url, timeout=120)
+        started = time.perf_counter()
+        response = request(local.http, i)
+        return time.perf_counter() - started, response.status_code < 400
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(timed, range(warmup)))
+        started = time.perf_counter()
+        timings = list(pool.map(timed, range(requests)))
+        elapsed = time.perf_counter() - started
+
+    latencies = np.array([t for t, _ in timings]) * 1000
+    return {
+        "scenario": name,
+        "requests": requests,
+        "errors": sum(1 for _, ok in timings if not ok),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "mean_ms": float(latencies.mean()),
+        "throughput_rps": requests / elapsed
+    }
+
+
+def scenarios(database: SyntheticDatabase, processes: int) -> dict[str, Callable[[httpx.Client, int], httpx.Response]]:
+    uids = [p["@id"] for p in database.background[:processes]]
+    body = ventum_body()
+    return {
+        "catalog-unit-group": lambda http, i: http.get("/unit-group"),
+        "catalog-flow": lambda http, i: http.get("/flow", params={"limit": 100}),
+        "catalog-process": lambda http, i: http.get("/process", params={"limit": 100}),
+        "process-impact": lambda http, i: http.post(
+            f"/process/{uids[i % len(uids)]}/impact",
+            json={"impact_method_uid": DEFAULT_IMPACT_METHOD_UID, "amount": 1 + i % 7}
+        ),
+        # Todos los métodos de la base de datos sobre un único inventario
+        "process-impact-methods": lambda http, i: http.post(
+            f"/process/{uids[i % len(uids)]}/impact",
+            json={"impact_method_uid": database.impact_methods, "amount": 1 + i % 7}
+        ),
+        "ventum-acv": lambda http, i: http.post("/ventum-acv", json=body)
+    }
+
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    previous = {r["scenario"]: r for r in baseline}
+    regressions = []
+    for r in results:
+        before = previous.get(r["scenario"])
+        if before is None:
+            continue
+        for metric in ("p50_ms", "p99_ms"):
+            if r[metric] > before[metric] * (1 + tolerance):
+                regressions.append(f"{r['scenario']} {metric}: {before[metric]:.2f} -> {r[metric]:.2f}")
+        if r["throughput_rps"] < before["throughput_rps"] / (1 + tolerance):
+            regressions.append(f"{r['scenario']} throughput: {before['throughput_rps']:.1f} -> {r['throughput_rps']:.1f}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark de la API contra un servidor IPC falso")
+    parser.add_argument("--processes", type=int, default=2000, help="procesos de fondo sintéticos (ecoinvent: ~20000)")
+    parser.add_argument("--elementary-flows", type=int, default=1000)
+    parser.add_argument("--impact-methods", type=int, default=3, help="métodos de impacto para process-impact-methods")
+    parser.add_argument("--latency", type=float, default=0.0, help="segundos añadidos a cada llamada IPC")
+    parser.add_argument("--calculation-latency", type=float, default=0.0, help="segundos añadidos a cada cálculo")
+    parser.add_argument("--engine", choices=["ipc", "matrix"], default="ipc")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--impact-processes", type=int, default=20, help="procesos distintos en process-impact")
+    parser.add_argument("--scenario", action="append", help="solo estos escenarios (se puede repetir)")
+    parser.add_argument("--output", help="guarda los resultados en JSON")
+    parser.add_argument("--baseline", help="resultados JSON de una ejecución anterior")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="empeoramiento admitido frente a --baseline")
+    args = parser.parse_args()
+
+    database = SyntheticDatabase(
+        processes=args.processes,
+        elementary_flows=args.elementary_flows,
+        impact_methods=args.impact_methods
+    )
+    ipc_port = free_port()
+    FakeIPCServer(database, args.latency, args.calculation_latency).serve(ipc_port)
+    api_server, api_thread, base_url = start_api(ipc_port, args.engine)
+
+    results = []
+    print(f"{'escenario':<24} {'p50 ms':>10} {'p99 ms':>10} {'media ms':>10} {'req/s':>10} {'errores':>8}")
+    for name, request in scenarios(database, args.impact_processes).items():
+        if args.scenario and name not in args.scenario:
+            continue
+        r = run_scenario(name, request, args.requests, args.concurrency, args.warmup)
+        results.append(r)
+        print(f"{name:<24} {r['p50_ms']:>10.2f} {r['p99_ms']:>10.2f} {r['mean_ms']:>10.2f} {r['throughput_rps']:>10.1f} {r['errors']:>8}", flush=True)
+
+    api_server.should_exit = True
+    api_thread.join(timeout=10)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"regresión: {regression}")
+        sys.exit(1 if regressions else 0)
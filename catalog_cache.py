@@ -0,0 +1,71 @@
+import gzip
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Callable
+
+from fastapi import Request, Response
+
+
+class CatalogEntry:
+    def __init__(self, body: bytes):
+        self.body = body
+        self.gzipped = gzip.compress(body)
+        self.etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+class CatalogCache:
+    # JSON ya serializado (y comprimido) por endpoint y query. Se vacía entero con
+    # cualquier put/delete del cliente, así que nunca sirve datos anteriores a una escritura
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, CatalogEntry] = OrderedDict()
+        self._lock = threading.Lock()
+        # Cambia con cada invalidate: lo construido antes de una escritura no se guarda
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self, *_) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def get(self, key: str, build: Callable[[], Any]) -> CatalogEntry:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            generation = self._generation
+
+        entry = CatalogEntry(json.dumps(build(), separators=(",", ":")).encode())
+        with self._lock:
+            if self._generation == generation:
+                self._entries[key] = entry
+                if len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return entry
+
+    def response(self, request: Request, build: Callable[[], Any]) -> Response:
+        key = request.url.path + "?" + "&".join(sorted(f"{k}={v}" for k, v in request.query_params.multi_items()))
+        entry = self.get(key, build)
+        headers = {"ETag": entry.etag, "Vary": "Accept-Encoding"}
+
+        if _matches(request.headers.get("if-none-match"), entry.etag):
+            return Response(status_code=304, headers=headers)
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+            return Response(content=entry.gzipped, media_type="application/json", headers=headers)
+        return Response(content=entry.body, media_type="application/json", headers=headers)
+
+
+def _matches(header: str | None, etag: str) -> bool:
+    # If-None-Match admite "*" y una lista de etiquetas; la comparación es débil (W/)
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in [tag.removeprefix("W/") for tag in tags]
@@ -0,0 +1,56 @@
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable
+
+from metrics import REGISTRY
+
+COALESCED = REGISTRY.counter(
+    "olca_coalesced_requests_total", "Calculations answered by an identical one already in flight", ("kind",)
+)
+
+
+def canonical_hash(data) -> str:
+    # Hash de datos JSON que no depende del orden de las claves
+    return hashlib.sha256(json.dumps(data, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+class Coalescer:
+    # Agrupa las llamadas idénticas simultáneas: la primera calcula y las que llegan
+    # mientras tanto esperan su resultado (o su excepción). No guarda nada al terminar;
+    # key[0] es el tipo de cálculo para los contadores
+    def __init__(self):
+        self._flights: dict[tuple, Future] = {}
+        self._lock = threading.Lock()
+        self.computed: dict[str, int] = {}
+        self.coalesced: dict[str, int] = {}
+
+    def run(self, key: tuple, compute: Callable[[], Any]) -> Any:
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Future()
+            counts = self.computed if leader else self.coalesced
+            counts[key[0]] = counts.get(key[0], 0) + 1
+        if not leader:
+            COALESCED.inc((key[0],))
+            return flight.result()
+
+        try:
+            flight.set_result(compute())
+        except BaseException as e:
+            flight.set_exception(e)
+        finally:
+            with self._lock:
+                del self._flights[key]
+        return flight.result()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": len(self._flights),
+                "computed": dict(self.computed),
+                "coalesced": dict(self.coalesced)
+            }
@@ -0,0 +1,148 @@
+import bisect
+import logging as log
+import threading
+from typing import Iterator, Type
+
+import olca_ipc as ipc
+import olca_schema as o
+
+
+class DescriptorIndex:
+    # Índice en memoria de descriptores (o.Ref) por UUID, nombre y tipo de flujo.
+    # Cada tipo se carga de una vez con get_descriptors la primera vez que se consulta
+    def __init__(self, client: ipc.Client, model_types: tuple[Type[o.RootEntity], ...]):
+        self.client = client
+        self.model_types = model_types
+        self._by_id: dict[type, dict[str, o.Ref]] = {}
+        self._by_name: dict[type, dict[str, list[o.Ref]]] = {}
+        # Claves (nombre, uuid) ordenadas para paginar con cursor; se rehacen tras cada cambio
+        self._sorted: dict[type, list[tuple[str, str]]] = {}
+        self._lock = threading.RLock()
+
+    def indexes(self, model_type: type) -> bool:
+        return model_type in self.model_types
+
+    def load(self, model_type: Type[o.RootEntity]) -> None:
+        descriptors = self.client.get_descriptors(model_type)
+        with self._lock:
+            self._by_id[model_type] = {}
+            self._by_name[model_type] = {}
+            for ref in descriptors:
+                self._add(model_type, ref)
+        duplicates = self.duplicates(model_type)
+        if duplicates:
+            log.warning("%i %s names are used by more than one entity", len(duplicates), model_type.__name__)
+
+    def refresh(self, model_type: Type[o.RootEntity] | None = None) -> None:
+        for t in [model_type] if model_type else self.model_types:
+            self.load(t)
+
+    def invalidate(self, model_type: Type[o.RootEntity] | None = None) -> None:
+        # Se vuelve a cargar de forma perezosa en la siguiente consulta
+        with self._lock:
+            for t in [model_type] if model_type else self.model_types:
+                self._by_id.pop(t, None)
+                self._by_name.pop(t, None)
+                self._sorted.pop(t, None)
+
+    def get(self, model_type: Type[o.RootEntity], uid: str | None = None, name: str | None = None) -> o.Ref | None:
+        self._ensure(model_type)
+        if uid is not None:
+            return self._by_id[model_type].get(uid)
+        refs = self._by_name[model_type].get(name)
+        if not refs:
+            return None
+        if len(refs) > 1:
+            log.warning("ambiguous %s name %r: %s", model_type.__name__, name, [r.id for r in refs])
+        return refs[0]
+
+    def get_named(self, model_type: Type[o.RootEntity], name: str) -> list[o.Ref]:
+        self._ensure(model_type)
+        return list(self._by_name[model_type].get(name, []))
+
+    def get_all(self, model_type: Type[o.RootEntity]) -> list[o.Ref]:
+        self._ensure(model_type)
+        return list(self._by_id[model_type].values())
+
+    def iter(
+        self,
+        model_type: Type[o.RootEntity],
+        after: tuple[str, str] | None = None,
+        flow_type: o.FlowType | None = None,
+        category: str | None = None,
+        name_prefix: str | None = None
+    ) -> Iterator[o.Ref]:
+        # Recorre los descriptores en orden (nombre, uuid) a partir del cursor "after"
+        keys = self._sorted_keys(model_type)
+        by_id = self._by_id[model_type]
+        start = bisect.bisect_right(keys, tuple(after)) if after else 0
+        if name_prefix:
+            start = max(start, bisect.bisect_left(keys, (name_prefix, "")))
+
+        for i in range(start, len(keys)):
+            name, uid = keys[i]
+            if name_prefix and not name.startswith(name_prefix):
+                break
+            ref = by_id.get(uid)
+            if ref is None:
+                continue
+            if flow_type is not None and ref.flow_type != flow_type:
+                continue
+            if category is not None and not (ref.category or "").startswith(category):
+                continue
+            yield ref
+
+    def get_flows(self, flow_type: o.FlowType) -> list[o.Ref]:
+        return [r for r in self.get_all(o.Flow) if r.flow_type == flow_type]
+
+    def duplicates(self, model_type: Type[o.RootEntity]) -> dict[str, list[o.Ref]]:
+        self._ensure(model_type)
+        return {name: refs for name, refs in self._by_name[model_type].items() if len(refs) > 1}
+
+    def put(self, model: o.RootEntity) -> None:
+        model_type = type(model)
+        if model_type not in self._by_id:
+            return
+        ref = model.to_ref()
+        if isinstance(model, o.Flow):
+            ref.flow_type = model.flow_type
+        with self._lock:
+            self._remove(model_type, ref.id)
+            self._add(model_type, ref)
+
+    def delete(self, model: o.RootEntity | o.Ref) -> None:
+        ref = o.as_ref(model)
+        with self._lock:
+            for model_type in self._by_id:
+                if ref.ref_type is None or model_type.__name__ == ref.ref_type.value:
+                    self._remove(model_type, ref.id)
+
+    def _ensure(self, model_type: Type[o.RootEntity]) -> None:
+        if model_type not in self._by_id:
+            with self._lock:
+                if model_type not in self._by_id:
+                    self.load(model_type)
+
+    def _sorted_keys(self, model_type: type) -> list[tuple[str, str]]:
+        self._ensure(model_type)
+        keys = self._sorted.get(model_type)
+        if keys is None:
+            with self._lock:
+                keys = sorted((r.name or "", r.id) for r in self._by_id[model_type].values())
+                self._sorted[model_type] = keys
+        return keys
+
+    def _add(self, model_type: type, ref: o.Ref) -> None:
+        self._sorted.pop(model_type, None)
+        self._by_id[model_type][ref.id] = ref
+        self._by_name[model_type].setdefault(ref.name, []).append(ref)
+
+    def _remove(self, model_type: type, uid: str) -> None:
+        old = self._by_id[model_type].pop(uid, None)
+        if old is None:
+            return
+        self._sorted.pop(model_type, None)
+        refs = self._by_name[model_type][old.name]
+        refs[:] = [r for r in refs if r.id != uid]
+        if not refs:
+            del self._by_name[model_type][old.name]
@@ -0,0 +1,219 @@
+import json
+import logging as log
+import os
+import sys
+import uuid
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+from typing import Callable
+
+import olca_schema as o
+
+from olca_client import OLCAClient
+
+# inputGroup 4 / outputGroup 4: desde/hacia la naturaleza; outputGroup 3: residuo a tratamiento
+ELEMENTARY_GROUPS = {("input", "4"), ("output", "4")}
+WASTE_GROUPS = {("output", "3")}
+
+
+@dataclass
+class ImportProgress:
+    datasets: int = 0
+    processes: int = 0
+    flows: int = 0
+    skipped_exchanges: int = 0
+    skipped_datasets: int = 0
+    bytes_read: int = 0
+    total_bytes: int = 0
+
+
+def _local(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+class EcoSpoldImporter:
+    # Importa ficheros EcoSpold01 dataset a dataset con iterparse, de modo que la
+    # memoria no depende del tamaño del fichero. Los procesos se envían por lotes
+    # y, con checkpoint, una importación interrumpida continúa en el último lote. Los
+    # identificadores salen del fichero y la posición del dataset: si se repite un lote
+    # ya enviado se sobrescriben los mismos procesos y flujos, no se duplican
+    def __init__(
+        self,
+        client: OLCAClient,
+        batch_size: int = 100,
+        workers: int = 4,
+        checkpoint: str | None = None,
+        progress: Callable[[ImportProgress], None] | None = None
+    ):
+        self.client = client
+        self.batch_size = batch_size
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.progress = progress
+        self._units: dict[str, tuple[o.Ref, o.Ref]] | None = None
+        self._new_flows: dict[tuple[str, str, str], o.Flow] = {}
+
+    def run(self, path: str) -> ImportProgress:
+        state = ImportProgress(total_bytes=os.path.getsize(path))
+        done = self._load_checkpoint(path)
+        processes: list[o.Process] = []
+
+        with open(path, "rb") as f:
+            root = None
+            for event, element in ET.iterparse(f, events=("start", "end")):
+                if root is None:
+                    root = element
+                if event != "end" or _local(element.tag) != "dataset":
+                    continue
+
+                state.datasets += 1
+                if state.datasets > done:
+                    process = self._process(path, element, state)
+                    if process is not None:
+                        processes.append(process)
+                # Se descarta el dataset ya procesado para mantener la memoria constante
+                root.clear()
+
+                if len(processes) >= self.batch_size:
+                    self._flush(path, processes, state, f.tell())
+                    processes = []
+
+            self._flush(path, processes, state, f.tell())
+
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        return state
+
+    def _flush(self, path: str, processes: list[o.Process], state: ImportProgress, position: int) -> None:
+        if not processes and not self._new_flows:
+            return
+        flows = list(self._new_flows.values())
+        self.client.put_all(flows, self.workers)
+        self.client.put_all(processes, self.workers)
+        self._new_flows.clear()
+
+        state.flows += len(flows)
+        state.processes += len(processes)
+        state.bytes_read = position
+        if self.checkpoint:
+            with open(self.checkpoint, "w") as f:
+                json.dump({"path": os.path.abspath(path), "datasets": state.datasets}, f)
+        if self.progress:
+            self.progress(state)
+
+    def _load_checkpoint(self, path: str) -> int:
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return 0
+        with open(self.checkpoint) as f:
+            data = json.load(f)
+        return data["datasets"] if data["path"] == os.path.abspath(path) else 0
+
+    def _process(self, path: str, dataset: ET.Element, state: ImportProgress) -> o.Process | None:
+        reference = next((e for e in dataset.iter() if _local(e.tag) == "referenceFunction"), None)
+        if reference is None:
+            log.warning("skipping dataset %i (number %s): no referenceFunction", state.datasets, dataset.get("number"))
+            state.skipped_datasets += 1
+            return None
+        process = o.new_process(reference.get("name"))
+        process.id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{os.path.abspath(path)}#{state.datasets}"))
+        process.category = "/".join(c for c in (reference.get("category"), reference.get("subCategory")) if c)
+        process.description = reference.get("generalComment") or None
+
+        reference_set = False
+        new_flows = len(self._new_flows)
+        for exchange in dataset.iter():
+            if _local(exchange.tag) != "exchange":
+                continue
+            group = next(((_local(g.tag)[:-5], (g.text or "").strip()) for g in exchange), None)
+            if group is not None and not group[1]:
+                group = None
+            try:
+                amount = float(exchange.get("meanValue"))
+            except (TypeError, ValueError):
+                log.warning("skipping exchange %r: invalid meanValue %r", exchange.get("name"), exchange.get("meanValue"))
+                state.skipped_exchanges += 1
+                continue
+            flow = self._flow(exchange, group)
+            if flow is None:
+                state.skipped_exchanges += 1
+                continue
+
+            if group[0] == "input":
+                e = o.new_input(process, flow, amount)
+            else:
+                e = o.new_output(process, flow, amount)
+            e.unit = self._units[exchange.get("unit")][1]
+            e.flow_property = self._units[exchange.get("unit")][0]
+            if group == ("output", "0") and not reference_set and exchange.get("name") == reference.get("name"):
+                e.is_quantitative_reference = True
+                reference_set = True
+            if group == ("output", "1"):
+                e.is_avoided_product = True
+
+        if not reference_set:
+            log.warning("skipping dataset %i (number %s): no reference product named %r",
+                        state.datasets, dataset.get("number"), reference.get("name"))
+            state.skipped_datasets += 1
+            # Los flujos nuevos que solo usaba este dataset no se envían
+            for key in list(self._new_flows)[new_flows:]:
+                del self._new_flows[key]
+            return None
+        return process
+
+    def _flow(self, exchange: ET.Element, group: tuple[str, str] | None) -> o.Ref | o.Flow | None:
+        name, unit = exchange.get("name"), exchange.get("unit")
+        units = self._unit_map()
+        if group is None or unit not in units:
+            log.warning("skipping exchange %r: unknown unit %r or group", name, unit)
+            return None
+
+        if group in ELEMENTARY_GROUPS:
+            flow_type = o.FlowType.ELEMENTARY_FLOW
+        elif group in WASTE_GROUPS:
+            flow_type = o.FlowType.WASTE_FLOW
+        else:
+            flow_type = o.FlowType.PRODUCT_FLOW
+        category = "/".join(c for c in (exchange.get("category"), exchange.get("subCategory")) if c)
+
+        key = (name, flow_type.value, category)
+        if key in self._new_flows:
+            return self._new_flows[key]
+
+        candidates = [r for r in self.client.index.get_named(o.Flow, name) if r.flow_type == flow_type]
+        if flow_type == o.FlowType.ELEMENTARY_FLOW and len(candidates) > 1:
+            # "Ammonia" existe en aire, agua y suelo: se desempata por la categoría
+            parts = [p.lower() for p in (exchange.get("category"), exchange.get("subCategory")) if p]
+            matching = [r for r in candidates if r.category and all(p in r.category.lower() for p in parts)]
+            candidates = matching or candidates
+        if candidates:
+            return candidates[0]
+
+        flow = o.new_flow(name, flow_type, units[unit][0])
+        flow.id = str(uuid.uuid5(uuid.NAMESPACE_URL, repr(key)))
+        flow.category = category
+        flow.cas = exchange.get("CASNumber")
+        flow.formula = exchange.get("formula") or None
+        self._new_flows[key] = flow
+        return flow
+
+    def _unit_map(self) -> dict[str, tuple[o.Ref, o.Ref]]:
+        # Nombre de unidad -> (propiedad de flujo por defecto de su grupo, unidad)
+        if self._units is None:
+            self._units = {}
+            for unit_group in self.client.get_all_unit_groups():
+                for unit in unit_group.units or []:
+                    self._units.setdefault(unit.name, (unit_group.default_flow_property, unit.to_ref()))
+        return self._units
+
+
+if __name__ == "__main__":
+    def print_progress(state: ImportProgress) -> None:
+        print(f"{state.datasets} datasets ({state.skipped_datasets} omitidos), {state.processes} procesos, {state.flows} flujos nuevos "
+              f"({100 * state.bytes_read / max(state.total_bytes, 1):.1f} %)")
+
+    importer = EcoSpoldImporter(
+        OLCAClient(port=8080),
+        checkpoint=sys.argv[1] + ".checkpoint",
+        progress=print_progress
+    )
+    importer.run(sys.argv[1])
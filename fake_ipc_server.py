@@ -0,0 +1,650 @@
+import argparse
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable
+
+import numpy as np
+import olca_schema as o
+import scipy.sparse as sp
+
+from matrix_engine import LCAMatrices, MatrixResult, tech_key
+from ventum_flows import load_mappings
+
+# Método de impacto sintético con el UUID que usa /ventum-acv
+DEFAULT_IMPACT_METHOD_UID = "2f995579-06bd-4681-b07c-cee3b1805b0d"
+
+UNIT_GROUPS = [
+    ("Mass", "Mass units", "kg"),
+    ("Energy", "Energy units", "MJ"),
+    ("Number of items", "Counting units", "Item(s)"),
+    ("Volume", "Volume units", "m3"),
+    ("Area*time", "Area*time units", "m2*a")
+]
+
+
+class RPCError(Exception):
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+
+
+def _ref(entity: dict) -> dict:
+    ref = {"@type": entity["@type"], "@id": entity["@id"], "name": entity.get("name")}
+    if entity.get("category"):
+        ref["category"] = entity["category"]
+    if entity["@type"] == "Flow":
+        ref["flowType"] = entity["flowType"]
+        ref["refUnit"] = "kg"
+    if entity["@type"] == "ImpactCategory":
+        ref["refUnit"] = entity.get("refUnit")
+    return ref
+
+
+def _sign(exchange: dict) -> float:
+    # Convenio de openLCA: entradas en negativo; residuos y evitados cambian de lado
+    sign = -1.0 if exchange.get("isInput", False) else 1.0
+    if exchange["flow"].get("flowType") == "WASTE_FLOW":
+        sign = -sign
+    if exchange.get("isAvoidedProduct"):
+        sign = -sign
+    return sign
+
+
+def _adopt(envi_flow: o.EnviFlow, amount: float) -> float:
+    # Como openLCA, los resultados dan las entradas (recursos) en positivo
+    return -amount if envi_flow.is_input and amount else amount
+
+
+class SyntheticDatabase:
+    # Base de datos openLCA generada al azar (con semilla): procesos de fondo que se
+    # consumen unos a otros, flujos elementales y métodos con factores aleatorios.
+    # Con ventum=True añade los procesos de primer plano de ventum_flows.yaml y el
+    # sistema de producto de cada cultivo, con los mismos nombres de flujo
+    def __init__(
+        self,
+        processes: int = 2000,
+        elementary_flows: int = 1000,
+        impact_categories: int = 16,
+        inputs: int = 5,
+        emissions: int = 10,
+        seed: int = 0,
+        impact_method_uid: str = DEFAULT_IMPACT_METHOD_UID,
+        impact_methods: int = 1,
+        ventum: bool = True
+    ):
+        self.rng = np.random.default_rng(seed)
+        self.entities: dict[str, dict[str, dict]] = {}
+        # revision cambia con cada escritura que afecta a las matrices; los sistemas de
+        # producto tienen su propia versión para que crear uno no invalide los demás
+        self.revision = 0
+        self.system_versions: dict[str, int] = {}
+        self._lock = threading.RLock()
+
+        self.units = {}
+        for property_name, group_name, unit_name in UNIT_GROUPS:
+            unit = {"@type": "Unit", "@id": self._uid(), "name": unit_name, "isRefUnit": True, "conversionFactor": 1.0}
+            group = self._add({"@type": "UnitGroup", "@id": self._uid(), "name": group_name, "units": [unit]})
+            flow_property = self._add({
+                "@type": "FlowProperty",
+                "@id": self._uid(),
+                "name": property_name,
+                "flowPropertyType": "PHYSICAL_QUANTITY",
+                "unitGroup": _ref(group)
+            })
+            group["defaultFlowProperty"] = _ref(flow_property)
+            self.units[unit_name] = (_ref(flow_property), {"@type": "Unit", "@id": unit["@id"], "name": unit_name})
+
+        self.elementary = []
+        for i in range(elementary_flows):
+            resource = i % 10 == 0
+            category = "Elementary flows/Resource/in ground" if resource else "Elementary flows/Emission to air/unspecified"
+            self.elementary.append(self._flow(f"Synthetic substance {i}", "ELEMENTARY_FLOW", category))
+
+        self.providers: dict[str, list[str]] = {}
+        self.background = []
+        for i in range(processes):
+            flow = self._flow(f"Synthetic product {i}", "PRODUCT_FLOW", "Synthetic products")
+            self.background.append(self._background_process(f"Synthetic process {i}", flow, inputs, emissions, i))
+
+        # El primer método usa impact_method_uid; los demás, para probar varios métodos
+        # sobre el mismo inventario, tienen sus propias categorías
+        self.impact_methods = []
+        for m in range(impact_methods):
+            prefix = f"Synthetic impact {m}." if m else "Synthetic impact "
+            categories = []
+            for i in range(impact_categories):
+                factors = [
+                    {"@type": "ImpactFactor", "flow": _ref(f), "value": float(self.rng.lognormal())}
+                    for f in self.elementary if self.rng.random() < 0.3
+                ]
+                categories.append(self._add({
+                    "@type": "ImpactCategory",
+                    "@id": self._uid(),
+                    "name": f"{prefix}{i}",
+                    "refUnit": "kg eq",
+                    "impactFactors": factors
+                }))
+            method = self._add({
+                "@type": "ImpactMethod",
+                "@id": impact_method_uid if m == 0 else self._uid(),
+                "name": f"Synthetic method {m}" if m else "Synthetic method",
+                "impactCategories": [_ref(c) for c in categories]
+            })
+            self.impact_methods.append(method["@id"])
+            if m == 0:
+                self.impact_categories = categories
+
+        if ventum:
+            for mapping in load_mappings().values():
+                self._ventum_crop(mapping)
+
+    # Generación
+    def _uid(self) -> str:
+        return str(uuid.UUID(bytes=self.rng.bytes(16), version=4))
+
+    def _add(self, entity: dict) -> dict:
+        self.entities.setdefault(entity["@type"], {})[entity["@id"]] = entity
+        return entity
+
+    def _flow(self, name: str, flow_type: str, category: str) -> dict:
+        flow_property = self.units["kg"][0]
+        return self._add({
+            "@type": "Flow",
+            "@id": self._uid(),
+            "name": name,
+            "category": category,
+            "flowType": flow_type,
+            "flowProperties": [{"flowProperty": flow_property, "conversionFactor": 1.0, "isRefFlowProperty": True}]
+        })
+
+    def _exchange(self, process: dict, flow: dict, amount: float, is_input: bool, reference: bool = False, gsd: float | None = None) -> dict:
+        process["lastInternalId"] = process.get("lastInternalId", 0) + 1
+        flow_property, unit = self.units["kg"]
+        exchange = {
+            "@type": "Exchange",
+            "internalId": process["lastInternalId"],
+            "flow": _ref(flow),
+            "amount": amount,
+            "isInput": is_input,
+            "isQuantitativeReference": reference,
+            "flowProperty": flow_property,
+            "unit": unit
+        }
+        if gsd is not None:
+            exchange["uncertainty"] = {"distributionType": "LOG_NORMAL_DISTRIBUTION", "geomMean": amount, "geomSd": gsd}
+        process.setdefault("exchanges", []).append(exchange)
+        return exchange
+
+    def conversion(self, exchange: dict) -> float:
+        # Factor a la unidad de referencia del flujo (unidad / propiedad del flujo)
+        flow = self.entities["Flow"].get(exchange["flow"]["@id"], {})
+        property_id = exchange.get("flowProperty", {}).get("@id")
+        factor = next((
+            f for f in flow.get("flowProperties", [])
+            if (f["flowProperty"]["@id"] == property_id if property_id else f.get("isRefFlowProperty"))
+        ), None)
+        if factor is None:
+            return 1.0
+        group_id = self.entities["FlowProperty"][factor["flowProperty"]["@id"]]["unitGroup"]["@id"]
+        unit_id = exchange.get("unit", {}).get("@id")
+        unit = next((u for u in self.entities["UnitGroup"][group_id]["units"] if u["@id"] == unit_id), None)
+        return (unit["conversionFactor"] if unit else 1.0) / factor["conversionFactor"]
+
+    def factor_conversion(self, factor: dict) -> float:
+        # Los factores son por unidad de factor["unit"]: el inverso que en los intercambios
+        if "unit" not in factor and "flowProperty" not in factor:
+            return 1.0
+        return 1.0 / self.conversion(factor)
+
+    def _process(self, name: str, category: str) -> dict:
+        return self._add({
+            "@type": "Process",
+            "@id": self._uid(),
+            "name": name,
+            "category": category,
+            "processType": "UNIT_PROCESS",
+            "exchanges": []
+        })
+
+    def _background_process(self, name: str, flow: dict, inputs: int, emissions: int, upstream: int) -> dict:
+        # Solo consume procesos anteriores y como mucho media unidad en total: A es
+        # diagonalmente dominante y siempre invertible
+        process = self._process(name, "Synthetic processes")
+        is_waste = flow["flowType"] == "WASTE_FLOW"
+        self._exchange(process, flow, 1.0, is_input=is_waste, reference=True)
+        if upstream > 0:
+            for j in self.rng.choice(upstream, size=min(inputs, upstream), replace=False):
+                provider = self.background[j]
+                amount = float(self.rng.uniform(0, 0.5 / inputs))
+                self._exchange(process, self._reference_flow(provider), amount, True, gsd=float(self.rng.uniform(1.05, 1.3)))
+        for k in self.rng.choice(len(self.elementary), size=min(emissions, len(self.elementary)), replace=False):
+            substance = self.elementary[k]
+            is_input = "Resource" in substance["category"]
+            self._exchange(process, substance, float(self.rng.lognormal(-2)), is_input, gsd=float(self.rng.uniform(1.05, 1.5)))
+        self.providers.setdefault(flow["@id"], []).append(process["@id"])
+        return process
+
+    def _reference_flow(self, process: dict) -> dict:
+        exchange = next(e for e in process["exchanges"] if e.get("isQuantitativeReference"))
+        return self.entities["Flow"][exchange["flow"]["@id"]]
+
+    def _named_flow(self, name: str, flow_type: str, is_input: bool) -> dict:
+        existing = next((f for f in self.entities["Flow"].values() if f["name"] == name), None)
+        if existing is not None:
+            return existing
+        if flow_type == "ELEMENTARY_FLOW":
+            category = "Elementary flows/Resource/land" if is_input else "Elementary flows/Emission to soil/agricultural"
+            flow = self._flow(name, flow_type, category)
+            self.elementary.append(flow)
+            for category_entity in self.impact_categories:
+                if self.rng.random() < 0.5:
+                    category_entity["impactFactors"].append(
+                        {"@type": "ImpactFactor", "flow": _ref(flow), "value": float(self.rng.lognormal())}
+                    )
+            return flow
+        flow = self._flow(name, flow_type, "Ventum")
+        upstream = len(self.background)
+        self.background.append(self._background_process(name, flow, 5, 5, upstream))
+        return flow
+
+    def _ventum_crop(self, mapping) -> None:
+        stage_flows = []
+        for process_name in mapping.stages.values():
+            process = self._process(process_name, "Ventum")
+            reference = self._flow(process_name, "PRODUCT_FLOW", "Ventum")
+            self._exchange(process, reference, 1.0, is_input=False, reference=True)
+            self.providers[reference["@id"]] = [process["@id"]]
+            stage_flows.append(reference)
+            for (flow_name, is_input), values in mapping.sources[process_name].items():
+                if flow_name == process_name:
+                    continue
+                # Los nombres de ecoinvent llevan la región entre llaves; el resto son elementales
+                if "{" not in flow_name:
+                    flow_type = "ELEMENTARY_FLOW"
+                else:
+                    flow_type = "PRODUCT_FLOW" if is_input else "WASTE_FLOW"
+                flow = self._named_flow(flow_name, flow_type, is_input)
+                for _ in values:
+                    self._exchange(process, flow, 0.1, is_input)
+
+        root = self._process(mapping.product_system, "Ventum")
+        self._exchange(root, self._flow(mapping.product_system, "PRODUCT_FLOW", "Ventum"), 1.0, False, True)
+        for flow in stage_flows:
+            self._exchange(root, flow, 1.0, is_input=True)
+        system = self.create_product_system(root["@id"])
+        system["name"] = mapping.product_system
+
+    # Consultas y escrituras
+    def get(self, model_type: str, uid: str | None = None, name: str | None = None) -> dict:
+        entities = self.entities.get(model_type, {})
+        if uid is not None:
+            entity = entities.get(uid)
+        else:
+            entity = next((e for e in entities.values() if e.get("name") == name), None)
+        if entity is None:
+            raise RPCError(404, f"{model_type} {uid or name} not found")
+        return entity
+
+    def put(self, entity: dict) -> dict:
+        with self._lock:
+            self._add(entity)
+            self._changed(entity)
+        return _ref(entity)
+
+    def delete(self, ref: dict) -> dict:
+        with self._lock:
+            entity = self.entities.get(ref["@type"], {}).pop(ref["@id"], None)
+            if entity is None:
+                raise RPCError(404, f"{ref['@type']} {ref['@id']} not found")
+            self._changed(entity)
+        return _ref(entity)
+
+    def _changed(self, entity: dict) -> None:
+        if entity["@type"] == "ProductSystem":
+            self.system_versions[entity["@id"]] = self.system_versions.get(entity["@id"], 0) + 1
+        else:
+            self.revision += 1
+
+    def provider_of(self, exchange: dict) -> str | None:
+        if exchange.get("defaultProvider"):
+            return exchange["defaultProvider"]["@id"]
+        providers = self.providers.get(exchange["flow"]["@id"])
+        return providers[0] if providers else None
+
+    def create_product_system(self, process_uid: str) -> dict:
+        # Enlaza las entradas de producto y las salidas de residuo con su proveedor, en anchura
+        processes = self.entities["Process"]
+        root = processes[process_uid]
+        visited, queue, links = {process_uid}, [process_uid], []
+        while queue:
+            process = processes[queue.pop()]
+            for e in process["exchanges"]:
+                if e.get("isQuantitativeReference") or not self._linkable(e):
+                    continue
+                provider = self.provider_of(e)
+                if provider is None or provider not in processes:
+                    continue
+                links.append({
+                    "provider": _ref(processes[provider]),
+                    "flow": e["flow"],
+                    "process": _ref(process),
+                    "exchange": {"@type": "Exchange", "internalId": e["internalId"]}
+                })
+                if provider not in visited:
+                    visited.add(provider)
+                    queue.append(provider)
+
+        reference = next(e for e in root["exchanges"] if e.get("isQuantitativeReference"))
+        system = {
+            "@type": "ProductSystem",
+            "@id": self._uid(),
+            "name": root["name"],
+            "refProcess": _ref(root),
+            "refExchange": {"@type": "Exchange", "internalId": reference["internalId"]},
+            "targetAmount": 1.0,
+            "targetFlowProperty": reference["flowProperty"],
+            "targetUnit": reference["unit"],
+            "processes": [_ref(processes[p]) for p in visited],
+            "processLinks": links
+        }
+        self.put(system)
+        return system
+
+    @staticmethod
+    def _linkable(exchange: dict) -> bool:
+        flow_type = exchange["flow"].get("flowType")
+        return (flow_type == "PRODUCT_FLOW" and exchange.get("isInput", False)) or (flow_type == "WASTE_FLOW" and not exchange.get("isInput", False))
+
+
+class SystemMatrices:
+    # Matrices de un sistema de producto y, por intercambio, su celda en A o B para
+    # aplicar las redefiniciones de parámetros
+    def __init__(self, database: SyntheticDatabase, system: dict, method: dict | None):
+        processes = database.entities["Process"]
+        members = [processes[r["@id"]] for r in system["processes"] if r["@id"] in processes]
+        links = {(l["process"]["@id"], l["exchange"]["internalId"]): l["provider"]["@id"] for l in system["processLinks"]}
+
+        tech_flows, column = [], {}
+        for process in members:
+            reference = next(e for e in process["exchanges"] if e.get("isQuantitativeReference"))
+            column[process["@id"]] = len(tech_flows)
+            tech_flows.append(o.TechFlow(provider=o.Ref.from_dict(_ref(process)), flow=o.Ref.from_dict(reference["flow"])))
+
+        envi_flows, envi_index = [], {}
+        a, b = ([], [], []), ([], [], [])
+        self.cells: dict[tuple[str, str], list[tuple[str, int, int, float]]] = {}
+        for process in members:
+            j = column[process["@id"]]
+            for e in process["exchanges"]:
+                sign = _sign(e) * database.conversion(e)
+                if e["flow"].get("flowType") == "ELEMENTARY_FLOW":
+                    key = e["flow"]["@id"]
+                    if key not in envi_index:
+                        envi_index[key] = len(envi_flows)
+                        envi_flows.append(o.EnviFlow(flow=o.Ref.from_dict(e["flow"]), is_input=e.get("isInput", False)))
+                    matrix, i = b, envi_index[key]
+                elif e.get("isQuantitativeReference"):
+                    matrix, i = a, j
+                else:
+                    provider = links.get((process["@id"], e["internalId"]))
+                    if provider not in column:
+                        continue
+                    matrix, i = a, column[provider]
+                matrix[0].append(i)
+                matrix[1].append(j)
+                matrix[2].append(sign * e["amount"])
+                if e.get("amountFormula"):
+                    self.cells.setdefault((process["@id"], e["amountFormula"]), []).append(
+                        ("A" if matrix is a else "B", i, j, sign)
+                    )
+
+        n, m = len(tech_flows), len(envi_flows)
+        # Sin método de impacto solo hay inventario
+        categories = [database.entities["ImpactCategory"][r["@id"]] for r in method["impactCategories"]] if method else []
+        c = ([], [], [])
+        for k, category in enumerate(categories):
+            for factor in category["impactFactors"]:
+                i = envi_index.get(factor["flow"]["@id"])
+                if i is None:
+                    continue
+                c[0].append(k)
+                c[1].append(i)
+                value = factor["value"] * database.factor_conversion(factor)
+                c[2].append(-value if envi_flows[i].is_input else value)
+
+        reference = column[system["refProcess"]["@id"]]
+        self.matrices = LCAMatrices(
+            tech_flows=tech_flows,
+            envi_flows=envi_flows,
+            impact_categories=[o.Ref.from_dict(_ref(c)) for c in categories],
+            technosphere=sp.csc_array((a[2], (a[0], a[1])), shape=(n, n)),
+            interventions=sp.csc_array((b[2], (b[0], b[1])), shape=(m, n)),
+            characterization=sp.csr_array((c[2], (c[0], c[1])), shape=(len(categories), m)),
+            demand_index=reference
+        )
+
+    def with_parameters(self, parameters: list[o.ParameterRedef]) -> LCAMatrices:
+        # Las celdas redefinidas se sustituyen sumando la diferencia con el valor actual
+        matrices = self.matrices
+        deltas = {"A": ([], [], []), "B": ([], [], [])}
+        for redef in parameters:
+            context = redef.context.id if redef.context else None
+            for kind, i, j, sign in self.cells.get((context, redef.name), []):
+                current = (matrices.technosphere if kind == "A" else matrices.interventions)[i, j]
+                deltas[kind][0].append(i)
+                deltas[kind][1].append(j)
+                deltas[kind][2].append(sign * redef.value - current)
+        if not deltas["A"][0] and not deltas["B"][0]:
+            return matrices
+        a, b = deltas["A"], deltas["B"]
+        return LCAMatrices(
+            tech_flows=matrices.tech_flows,
+            envi_flows=matrices.envi_flows,
+            impact_categories=matrices.impact_categories,
+            technosphere=sp.csc_array(matrices.technosphere + sp.csc_array((a[2], (a[0], a[1])), shape=matrices.technosphere.shape)),
+            interventions=sp.csc_array(matrices.interventions + sp.csc_array((b[2], (b[0], b[1])), shape=matrices.interventions.shape)),
+            characterization=matrices.characterization,
+            demand_index=matrices.demand_index
+        )
+
+
+class FakeIPCServer:
+    # Servidor JSON-RPC con el subconjunto del protocolo de openLCA que usa OLCAClient,
+    # resuelto con las matrices de una SyntheticDatabase. latency se añade a cada
+    # llamada y calculation_latency a cada cálculo, para imitar la JVM
+    def __init__(self, database: SyntheticDatabase, latency: float = 0.0, calculation_latency: float = 0.0, max_systems: int = 8):
+        self.database = database
+        self.latency = latency
+        self.calculation_latency = calculation_latency
+        self.max_systems = max_systems
+        self.results: dict[str, MatrixResult] = {}
+        self.calls = 0
+        self._systems: OrderedDict[tuple, SystemMatrices] = OrderedDict()
+        self._lock = threading.Lock()
+        self.methods: dict[str, Callable[[Any], Any]] = {
+            "data/get": self._get,
+            "data/get/all": lambda p: list(self.database.entities.get(p["@type"], {}).values()),
+            "data/get/descriptors": lambda p: [_ref(e) for e in self.database.entities.get(p["@type"], {}).values()],
+            "data/get/descriptor": lambda p: _ref(self._get(p)),
+            "data/put": self.database.put,
+            "data/delete": self.database.delete,
+            "data/create/system": lambda p: _ref(self.database.create_product_system(p["process"]["@id"])),
+            "result/calculate": self._calculate,
+            "result/state": lambda p: self._result(p) and {"@type": "ResultState", "@id": p["@id"], "isReady": True},
+            "result/dispose": self._dispose,
+            "result/demand": lambda p: self._result(p).get_demand().to_dict(),
+            "result/tech-flows": lambda p: [tf.to_dict() for tf in self._result(p).get_tech_flows()],
+            "result/envi-flows": lambda p: [ef.to_dict() for ef in self._result(p).get_envi_flows()],
+            "result/impact-categories": lambda p: [c.to_dict() for c in self._result(p).get_impact_categories()],
+            "result/scaling-factors": lambda p: [v.to_dict() for v in self._result(p).get_scaling_factors()],
+            "result/total-requirements": lambda p: [v.to_dict() for v in self._result(p).get_total_requirements()],
+            "result/total-flows": lambda p: [
+                o.EnviFlowValue(envi_flow=v.envi_flow, amount=_adopt(v.envi_flow, v.amount)).to_dict()
+                for v in self._result(p).get_total_flows()
+            ],
+            "result/total-impacts": lambda p: [v.to_dict() for v in self._result(p).get_total_impacts()],
+            "result/total-impacts-of": lambda p: [
+                v.to_dict() for v in self._result(p).get_total_impacts_of(o.TechFlow.from_dict(p["techFlow"]))
+            ],
+            "result/total-impacts-of-one": lambda p: [
+                v.to_dict() for v in self._result(p).get_impact_intensities_of(o.TechFlow.from_dict(p["techFlow"]))
+            ],
+            "result/unscaled-tech-flows-of": self._unscaled_tech_flows_of,
+            "result/direct-interventions-of": self._direct_interventions_of,
+            "result/flow-intensities-of": self._flow_intensities_of,
+            "result/impact-factors-of": self._impact_factors_of
+        }
+
+    def handle(self, request: dict) -> dict:
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        response = {"jsonrpc": "2.0", "id": request.get("id")}
+        method = self.methods.get(request.get("method"))
+        try:
+            if method is None:
+                raise RPCError(501, f"method {request.get('method')} is not supported by the fake server")
+            response["result"] = method(request.get("params"))
+        except RPCError as e:
+            response["error"] = {"code": e.code, "message": str(e)}
+        except (KeyError, ValueError, TypeError) as e:
+            response["error"] = {"code": 400, "message": f"invalid request: {e!r}"}
+        return response
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *_):
+                pass
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                body = json.dumps(server.handle(request)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        http_server = ThreadingHTTPServer((host, port), Handler)
+        http_server.daemon_threads = True
+        threading.Thread(target=http_server.serve_forever, name="fake-ipc-server", daemon=True).start()
+        return http_server
+
+    def _get(self, params: dict) -> dict:
+        return self.database.get(params["@type"], uid=params.get("@id"), name=params.get("name"))
+
+    def _system(self, system_uid: str, method_uid: str | None) -> SystemMatrices:
+        key = (system_uid, method_uid, self.database.revision, self.database.system_versions.get(system_uid))
+        with self._lock:
+            matrices = self._systems.get(key)
+            if matrices is not None:
+                self._systems.move_to_end(key)
+                return matrices
+        system = self.database.get("ProductSystem", uid=system_uid)
+        method = self.database.get("ImpactMethod", uid=method_uid) if method_uid else None
+        matrices = SystemMatrices(self.database, system, method)
+        with self._lock:
+            self._systems[key] = matrices
+            while len(self._systems) > self.max_systems:
+                self._systems.popitem(last=False)
+        return matrices
+
+    def _calculate(self, params: dict) -> dict:
+        setup = o.CalculationSetup.from_dict(params)
+        target = setup.target.id
+        if setup.target.ref_type == o.RefType.Process:
+            target = self.database.create_product_system(target)["@id"]
+        system = self._system(target, setup.impact_method.id if setup.impact_method else None)
+        matrices = system.with_parameters(setup.parameters or [])
+        if self.calculation_latency:
+            time.sleep(self.calculation_latency)
+        result = MatrixResult(matrices, setup.amount if setup.amount is not None else 1.0)
+        uid = str(uuid.uuid4())
+        with self._lock:
+            self.results[uid] = result
+        return {"@type": "ResultState", "@id": uid, "isReady": True}
+
+    def _result(self, params: dict) -> MatrixResult:
+        result = self.results.get(params["@id"])
+        if result is None:
+            raise RPCError(404, f"result {params['@id']} not found")
+        return result
+
+    def _dispose(self, params: dict) -> dict:
+        with self._lock:
+            self.results.pop(params["@id"], None)
+        return {"@type": "ResultState", "@id": params["@id"], "isReady": True}
+
+    def _unscaled_tech_flows_of(self, params: dict) -> list[dict]:
+        result = self._result(params)
+        matrices = result.matrices
+        j = matrices.tech_index[tech_key(o.TechFlow.from_dict(params["techFlow"]))]
+        column = matrices.technosphere[:, [j]].tocoo()
+        return [
+            o.TechFlowValue(tech_flow=matrices.tech_flows[i], amount=float(a)).to_dict()
+            for i, a in zip(column.row, column.data)
+        ]
+
+    def _direct_interventions_of(self, params: dict) -> list[dict]:
+        result = self._result(params)
+        matrices = result.matrices
+        j = matrices.tech_index[tech_key(o.TechFlow.from_dict(params["techFlow"]))]
+        column = matrices.interventions[:, [j]].tocoo()
+        return [
+            o.EnviFlowValue(envi_flow=matrices.envi_flows[i], amount=_adopt(matrices.envi_flows[i], float(a * result.scaling[j]))).to_dict()
+            for i, a in zip(column.row, column.data)
+        ]
+
+    def _flow_intensities_of(self, params: dict) -> list[dict]:
+        result = self._result(params)
+        matrices = result.matrices
+        j = matrices.tech_index[tech_key(o.TechFlow.from_dict(params["techFlow"]))]
+        unit = np.zeros(len(matrices.tech_flows))
+        unit[j] = 1
+        intensities = matrices.interventions @ matrices.solve(unit)
+        return [
+            o.EnviFlowValue(envi_flow=ef, amount=_adopt(ef, float(g))).to_dict()
+            for ef, g in zip(matrices.envi_flows, intensities) if g != 0
+        ]
+
+    def _impact_factors_of(self, params: dict) -> list[dict]:
+        result = self._result(params)
+        matrices = result.matrices
+        k = next(i for i, c in enumerate(matrices.impact_categories) if c.id == params["impactCategory"]["@id"])
+        row = matrices.characterization[[k], :].tocoo()
+        return [
+            o.EnviFlowValue(envi_flow=matrices.envi_flows[i], amount=_adopt(matrices.envi_flows[i], float(v))).to_dict()
+            for i, v in zip(row.col, row.data)
+        ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor IPC de openLCA falso con una base de datos sintética")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--processes", type=int, default=2000, help="procesos de fondo (ecoinvent: ~20000)")
+    parser.add_argument("--elementary-flows", type=int, default=1000)
+    parser.add_argument("--impact-categories", type=int, default=16)
+    parser.add_argument("--impact-methods", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="segundos añadidos a cada llamada")
+    parser.add_argument("--calculation-latency", type=float, default=0.0, help="segundos añadidos a cada cálculo")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    started = time.time()
+    database = SyntheticDatabase(
+        processes=args.processes,
+        elementary_flows=args.elementary_flows,
+        impact_categories=args.impact_categories,
+        impact_methods=args.impact_methods,
+        seed=args.seed
+    )
+    print(f"base de datos sintética generada en {time.time() - started:.1f} s")
+    http_server = FakeIPCServer(database, args.latency, args.calculation_latency).serve(args.port, host="0.0.0.0")
+    print(f"escuchando en el puerto {args.port}")
+    threading.Event().wait()
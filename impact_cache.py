@@ -0,0 +1,168 @@
+import hashlib
+import json
+import logging as log
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+import olca_schema as o
+
+
+class ImpactCache:
+    # Impactos por unidad de referencia. Los resultados ACV son lineales en la cantidad,
+    # así que cualquier cantidad se responde escalando el vector guardado. Con directory
+    # se guarda además una copia en disco que sobrevive a los reinicios y que comparten
+    # los workers que usan el mismo directorio
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: float = 3600,
+        directory: str | None = None,
+        max_disk_entries: int = 16384
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        # Cada entrada guarda la revisión con la que se calculó. Con directory la revisión
+        # es el tamaño del fichero "revision", al que cada escritura en la base de datos
+        # añade un byte: las de otro worker o de antes de un reinicio también cuentan
+        self._revision = 0
+        self._entries: OrderedDict[tuple, tuple[float, int, list[o.ImpactValue]]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def impacts(self, key: tuple, amount: float, compute: Callable[[], list[o.ImpactValue]]) -> list[o.ImpactValue]:
+        per_unit = self.get(key)
+        if per_unit is None:
+            # Un resultado calculado mientras había una escritura no se guarda como nuevo
+            revision = self.revision()
+            per_unit = compute()
+            self.put(key, per_unit, revision)
+        return [
+            o.ImpactValue(impact_category=v.impact_category, amount=v.amount * amount)
+            for v in per_unit
+        ]
+
+    def revision(self) -> int:
+        if not self.directory:
+            return self._revision
+        try:
+            return os.path.getsize(os.path.join(self.directory, "revision"))
+        except OSError:
+            return 0
+
+    def get(self, key: tuple) -> list[o.ImpactValue] | None:
+        now, revision = time.time(), self.revision()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._valid(entry, now, revision):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+
+        entry = self._read(key)
+        if entry is not None and self._valid(entry, now, revision):
+            with self._lock:
+                self.hits += 1
+                self._store(key, entry)
+            return entry[2]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: tuple, per_unit: list[o.ImpactValue], revision: int | None = None) -> None:
+        current = self.revision()
+        if revision is not None and revision != current:
+            return
+        entry = (time.time(), current, per_unit)
+        with self._lock:
+            self._store(key, entry)
+        self._write(key, entry)
+
+    def invalidate(self, *_) -> None:
+        # Listener de OLCAClient: cualquier escritura puede afectar a cualquier resultado.
+        # Las entradas en disco dejan de valer al cambiar la revisión
+        with self._lock:
+            self._entries.clear()
+            self._revision += 1
+        if self.directory:
+            try:
+                # O_APPEND es atómico entre procesos: nunca se pierde un incremento
+                fd = os.open(os.path.join(self.directory, "revision"), os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+                try:
+                    os.write(fd, b".")
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                log.warning("impact cache revision not updated: %s", e)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "revision": self.revision(), "hits": self.hits, "misses": self.misses}
+
+    def _valid(self, entry: tuple[float, int, list[o.ImpactValue]], now: float, revision: int) -> bool:
+        return now - entry[0] < self.ttl and entry[1] == revision
+
+    def _store(self, key: tuple, entry: tuple[float, int, list[o.ImpactValue]]) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _path(self, key: tuple) -> str:
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest() + ".json")
+
+    def _read(self, key: tuple) -> tuple[float, int, list[o.ImpactValue]] | None:
+        # Cualquier error del disco es un fallo de caché
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key)) as f:
+                data = json.load(f)
+            return data["created"], data["revision"], [o.ImpactValue.from_dict(d) for d in data["impacts"]]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write(self, key: tuple, entry: tuple[float, int, list[o.ImpactValue]]) -> None:
+        if not self.directory:
+            return
+        # Un fichero temporal propio por escritura: varios hilos o workers pueden
+        # guardar la misma clave a la vez
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump({"created": entry[0], "revision": entry[1], "impacts": [v.to_dict() for v in entry[2]]}, f)
+                os.replace(tmp, self._path(key))
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except OSError as e:
+            log.warning("impact cache entry not written: %s", e)
+            return
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % 64 == 0
+        if prune:
+            self._prune()
+
+    def _prune(self) -> None:
+        # Deja en disco las max_disk_entries entradas más recientes
+        try:
+            files = [e for e in os.scandir(self.directory) if e.name.endswith(".json")]
+            if len(files) <= self.max_disk_entries:
+                return
+            files.sort(key=lambda e: e.stat().st_mtime)
+            for e in files[:len(files) - self.max_disk_entries]:
+                os.unlink(e.path)
+        except OSError as e:
+            log.debug("impact cache prune stopped: %s", e)
@@ -0,0 +1,321 @@
+import itertools
+import json
+import logging as log
+import threading
+import time
+from typing import Any, Optional, Tuple
+
+import olca_ipc as ipc
+import requests
+
+from metrics import REGISTRY, record
+
+# Escrituras que se envían a todas las réplicas para que sus bases de datos no diverjan
+WRITES = ("data/put", "data/delete")
+CREATE_SYSTEM = ("data/create/system", "data/create-system")
+# Crean un resultado que vive en la memoria de la réplica que lo calcula
+CREATE_RESULT = ("result/calculate", "result/simulate")
+
+IPC_SECONDS = REGISTRY.histogram(
+    "olca_ipc_call_seconds", "Round trip of openLCA IPC calls", ("method", "endpoint")
+)
+IPC_CALLS = REGISTRY.counter(
+    "olca_ipc_calls_total", "openLCA IPC calls by outcome (ok, rpc_error, transport_error)", ("method", "endpoint", "outcome")
+)
+IPC_REQUEST_BYTES = REGISTRY.counter(
+    "olca_ipc_request_bytes_total", "JSON-RPC request bytes sent to openLCA", ("method", "endpoint")
+)
+IPC_RESPONSE_BYTES = REGISTRY.counter(
+    "olca_ipc_response_bytes_total", "JSON-RPC response bytes received from openLCA", ("method", "endpoint")
+)
+
+
+def endpoint_url(endpoint: int | str) -> str:
+    if isinstance(endpoint, int) or endpoint.isdigit():
+        return "http://localhost:%i" % int(endpoint)
+    return endpoint
+
+
+class Endpoint:
+    def __init__(self, url: str):
+        self.url = url
+        self.healthy = True
+        self.stale = False
+        self.outstanding = 0
+        self.failures = 0
+        self.successes = 0
+        self.requests = 0
+        self.errors = 0
+        # Escrituras que se ha perdido mientras estaba expulsada, en orden
+        self.missed: list[tuple[str, Any]] = []
+        self._local = threading.local()
+
+    def session(self) -> requests.Session:
+        # Una sesión HTTP por hilo y réplica
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+
+class IPCPool(ipc.Client):
+    # Cliente JSON-RPC sobre varias réplicas del servidor IPC de openLCA. Las lecturas y
+    # los cálculos van a la réplica sana con menos peticiones en curso; las llamadas
+    # result/* van a la réplica que tiene el resultado; put/delete se envían a todas.
+    # Una réplica se expulsa tras failures_to_eject errores seguidos y, cuando vuelve
+    # a responder a las sondas, se le reenvían las escrituras que se perdió. Con un solo
+    # endpoint se comporta como ipc.Client
+    def __init__(
+        self,
+        endpoints: list[int | str],
+        probe_interval: float = 5.0,
+        failures_to_eject: int = 3,
+        probes_to_readmit: int = 2,
+        timeout: float | None = None,
+        max_missed_writes: int = 10000
+    ):
+        self.endpoints = [Endpoint(endpoint_url(e)) for e in endpoints]
+        self.url = self.endpoints[0].url
+        self.next_id = 1
+        self.probe_interval = probe_interval
+        self.failures_to_eject = failures_to_eject
+        self.probes_to_readmit = probes_to_readmit
+        self.timeout = timeout
+        self.max_missed_writes = max_missed_writes
+        self._ids = itertools.count(1)
+        self._turn = itertools.count()
+        self._results: dict[str, Endpoint] = {}
+        self._lock = threading.Lock()
+        if len(self.endpoints) > 1 and probe_interval > 0:
+            threading.Thread(target=self._probe_loop, name="ipc-pool-probe", daemon=True).start()
+        REGISTRY.gauge(
+            "olca_ipc_endpoint_outstanding", "openLCA IPC calls in flight", ("endpoint",),
+            lambda: {(e.url,): e.outstanding for e in self.endpoints}
+        )
+        REGISTRY.gauge(
+            "olca_ipc_endpoint_healthy", "1 if the openLCA IPC endpoint receives calls", ("endpoint",),
+            lambda: {(e.url,): e.healthy for e in self.endpoints}
+        )
+
+    def rpc_call(self, method: str, params: Any = None) -> Tuple[Any, Optional[str]]:
+        if len(self.endpoints) == 1:
+            return self._call(self.endpoints[0], method, params)
+
+        if method in CREATE_RESULT:
+            endpoint = self._pick()
+            result, err = self._call(endpoint, method, params)
+            if err is None:
+                with self._lock:
+                    self._results[result["@id"]] = endpoint
+            return result, err
+
+        if method.startswith("result/"):
+            uid = (params or {}).get("@id")
+            with self._lock:
+                endpoint = self._results.get(uid)
+                if method == "result/dispose":
+                    self._results.pop(uid, None)
+            if endpoint is None:
+                return None, f"result {uid} was not created through this pool"
+            try:
+                return self._call(endpoint, method, params)
+            except requests.RequestException:
+                # Si la réplica no responde el resultado se da por perdido
+                with self._lock:
+                    self._results.pop(uid, None)
+                raise
+
+        if method in WRITES:
+            return self._broadcast(method, params)
+
+        if method in CREATE_SYSTEM:
+            # El UUID lo genera el servidor: se crea en una réplica y se copia a las demás
+            endpoint = self._pick()
+            ref, err = self._call(endpoint, method, params)
+            if err is None:
+                system, err = self._call(endpoint, "data/get", {"@type": "ProductSystem", "@id": ref["@id"]})
+                if err is None:
+                    self._broadcast("data/put", system, skip=endpoint)
+            return ref, err
+
+        return self._read(method, params)
+
+    def results(self) -> int:
+        with self._lock:
+            return len(self._results)
+
+    def stats(self) -> list[dict]:
+        with self._lock:
+            live = {}
+            for endpoint in self._results.values():
+                live[endpoint.url] = live.get(endpoint.url, 0) + 1
+            return [
+                {
+                    "url": e.url,
+                    "healthy": e.healthy,
+                    "stale": e.stale,
+                    "outstanding": e.outstanding,
+                    "requests": e.requests,
+                    "errors": e.errors,
+                    "results": live.get(e.url, 0)
+                } for e in self.endpoints
+            ]
+
+    def _pick(self, exclude: tuple[Endpoint, ...] = ()) -> Endpoint:
+        with self._lock:
+            candidates = [e for e in self.endpoints if e.healthy and e not in exclude]
+            if not candidates:
+                raise requests.ConnectionError("no healthy openLCA IPC endpoint")
+            # Menos peticiones en curso; los empates se reparten por turnos
+            turn = next(self._turn)
+            n = len(candidates)
+            return min(
+                (candidates[(turn + i) % n] for i in range(n)),
+                key=lambda e: e.outstanding
+            )
+
+    def _read(self, method: str, params: Any) -> Tuple[Any, Optional[str]]:
+        # Las lecturas son idempotentes: si una réplica no responde se prueba otra
+        tried: tuple[Endpoint, ...] = ()
+        while True:
+            endpoint = self._pick(tried)
+            try:
+                return self._call(endpoint, method, params)
+            except requests.RequestException:
+                tried += (endpoint,)
+                if len(tried) == len(self.endpoints):
+                    raise
+
+    def _broadcast(self, method: str, params: Any, skip: Endpoint | None = None) -> Tuple[Any, Optional[str]]:
+        with self._lock:
+            targets = [e for e in self.endpoints if e.healthy and e is not skip]
+            for endpoint in self.endpoints:
+                if not endpoint.healthy:
+                    self._queue(endpoint, method, params)
+        if not targets and skip is None:
+            raise requests.ConnectionError("no healthy openLCA IPC endpoint")
+
+        response: Tuple[Any, Optional[str]] | None = None
+        for endpoint in targets:
+            try:
+                r = self._call(endpoint, method, params)
+            except requests.RequestException:
+                # La réplica se queda fuera hasta que se le reenvíe esta escritura
+                with self._lock:
+                    self._eject(endpoint)
+                    self._queue(endpoint, method, params)
+                continue
+            if response is None or response[1] is not None:
+                response = r
+        if response is None:
+            if skip is not None:
+                return None, None
+            raise requests.ConnectionError(f"{method} failed on every openLCA IPC endpoint")
+        return response
+
+    def _queue(self, endpoint: Endpoint, method: str, params: Any) -> None:
+        # Se llama con self._lock
+        if endpoint.stale:
+            return
+        endpoint.missed.append((method, params))
+        if len(endpoint.missed) > self.max_missed_writes:
+            endpoint.stale = True
+            endpoint.missed = []
+            log.error("openLCA IPC endpoint %s missed more than %i writes; it has to be "
+                      "resynchronized by hand", endpoint.url, self.max_missed_writes)
+
+    def _call(self, endpoint: Endpoint, method: str, params: Any) -> Tuple[Any, Optional[str]]:
+        request = {"jsonrpc": "2.0", "id": next(self._ids), "method": method}
+        if params is not None:
+            request["params"] = params
+        body = json.dumps(request)
+        labels = (method, endpoint.url)
+        with self._lock:
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+        started = time.perf_counter()
+        try:
+            raw = endpoint.session().post(
+                endpoint.url, data=body, headers={"Content-Type": "application/json"}, timeout=self.timeout
+            )
+            response: dict = raw.json()
+            raw.close()
+        except (requests.RequestException, ValueError) as e:
+            with self._lock:
+                endpoint.errors += 1
+                endpoint.failures += 1
+                if endpoint.failures >= self.failures_to_eject:
+                    self._eject(endpoint)
+            if REGISTRY.enabled:
+                IPC_CALLS.inc(labels + ("transport_error",))
+            if isinstance(e, ValueError):
+                raise requests.RequestException(f"invalid response from {endpoint.url}: {e}") from e
+            raise
+        finally:
+            with self._lock:
+                endpoint.outstanding -= 1
+
+        with self._lock:
+            endpoint.failures = 0
+        err: dict | None = response.get("error")
+        if REGISTRY.enabled:
+            seconds = time.perf_counter() - started
+            IPC_SECONDS.observe(labels, seconds)
+            IPC_CALLS.inc(labels + ("ok" if err is None else "rpc_error",))
+            IPC_REQUEST_BYTES.inc(labels, len(body))
+            IPC_RESPONSE_BYTES.inc(labels, len(raw.content))
+            record(f"ipc.{method}", seconds)
+        if err is not None:
+            return None, "%i: %s" % (err.get("code"), err.get("message"))
+        result = response.get("result")
+        if result is None:
+            return None, "No error and no result: invalid JSON-RPC response"
+        return result, None
+
+    def _eject(self, endpoint: Endpoint) -> None:
+        # Se llama con self._lock
+        if not endpoint.healthy:
+            return
+        endpoint.healthy = False
+        endpoint.successes = 0
+        # Los resultados viven en la memoria de la réplica y no se van a recuperar
+        for uid in [uid for uid, e in self._results.items() if e is endpoint]:
+            del self._results[uid]
+        log.warning("openLCA IPC endpoint %s ejected", endpoint.url)
+
+    def _probe_loop(self) -> None:
+        while True:
+            time.sleep(self.probe_interval)
+            for endpoint in self.endpoints:
+                if not endpoint.stale:
+                    self._probe(endpoint)
+
+    def _probe(self, endpoint: Endpoint) -> None:
+        # Cualquier respuesta JSON-RPC, aunque sea un error de "no encontrado", vale
+        params = {"@type": "Currency", "@id": "00000000-0000-0000-0000-000000000000"}
+        try:
+            self._call(endpoint, "data/get/descriptor", params)
+        except requests.RequestException:
+            return
+        if endpoint.healthy:
+            return
+        endpoint.successes += 1
+        if endpoint.successes >= self.probes_to_readmit:
+            self._readmit(endpoint)
+
+    def _readmit(self, endpoint: Endpoint) -> None:
+        while True:
+            with self._lock:
+                if endpoint.stale:
+                    return
+                pending, endpoint.missed = endpoint.missed, []
+                if not pending:
+                    endpoint.healthy = True
+                    log.warning("openLCA IPC endpoint %s readmitted", endpoint.url)
+                    return
+            for i, (method, params) in enumerate(pending):
+                try:
+                    self._call(endpoint, method, params)
+                except requests.RequestException:
+                    with self._lock:
+                        endpoint.missed[:0] = pending[i:]
+                    return
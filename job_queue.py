@@ -0,0 +1,139 @@
+import logging as log
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable
+
+from metrics import REGISTRY
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, kind: str, backend: str, run: Callable[[], Any]):
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.backend = backend
+        self.run = run
+        self.state = QUEUED
+        self.result = None
+        self.error: str | None = None
+        self.created = time.time()
+        self.started: float | None = None
+        self.finished: float | None = None
+        # Se incrementa en cada cambio de estado: /jobs/{id}/events lo consulta para saber
+        # si hay algo nuevo que enviar
+        self.version = 0
+        self._lock = threading.Lock()
+
+    @property
+    def is_finished(self) -> bool:
+        return self.state in (DONE, FAILED)
+
+    def to_dict(self) -> dict:
+        data = {
+            "id": self.id,
+            "type": self.kind,
+            "state": self.state,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished
+        }
+        if self.state == DONE:
+            data["result"] = self.result
+        if self.state == FAILED:
+            data["error"] = self.error
+        return data
+
+    def _set(self, state: str, **changes) -> None:
+        with self._lock:
+            self.state = state
+            for name, value in changes.items():
+                setattr(self, name, value)
+            self.version += 1
+
+
+class JobQueue:
+    # Cola de cálculos en segundo plano con un número fijo de hilos por backend (servidor
+    # IPC, motor matricial...). Cada backend tiene su propia cola acotada: si está llena,
+    # submit lanza QueueFull. Se guardan como mucho max_results trabajos terminados
+    def __init__(self, concurrency: dict[str, int], max_queued: int = 100, max_results: int = 1000):
+        self.concurrency = concurrency
+        self.max_results = max_results
+        self._queues = {backend: queue.Queue(maxsize=max_queued) for backend in concurrency}
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.rejected = 0
+        for backend, workers in concurrency.items():
+            for i in range(workers):
+                threading.Thread(target=self._work, args=(backend,), name=f"job-{backend}-{i}", daemon=True).start()
+        REGISTRY.gauge(
+            "olca_jobs_queued", "Jobs waiting for a worker", ("backend",),
+            lambda: {(backend,): q.qsize() for backend, q in self._queues.items()}
+        )
+
+    def submit(self, kind: str, backend: str, run: Callable[[], Any]) -> Job:
+        job = Job(kind, backend, run)
+        with self._lock:
+            self._jobs[job.id] = job
+        try:
+            self._queues[backend].put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job.id]
+                self.rejected += 1
+            raise QueueFull(f"{backend} job queue is full")
+        with self._lock:
+            self.submitted += 1
+            self._evict()
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            states = {}
+            for job in self._jobs.values():
+                states[job.state] = states.get(job.state, 0) + 1
+            return {
+                "queued": {backend: q.qsize() for backend, q in self._queues.items()},
+                "workers": self.concurrency,
+                "jobs": states,
+                "submitted": self.submitted,
+                "rejected": self.rejected
+            }
+
+    def _work(self, backend: str) -> None:
+        jobs = self._queues[backend]
+        while True:
+            job = jobs.get()
+            job._set(RUNNING, started=time.time())
+            try:
+                result = job.run()
+            except Exception as e:
+                log.exception("job %s (%s) failed", job.id, job.kind)
+                job._set(FAILED, error=str(e) or type(e).__name__, finished=time.time(), run=None)
+            else:
+                job._set(DONE, result=result, finished=time.time(), run=None)
+            with self._lock:
+                self._evict()
+
+    def _evict(self) -> None:
+        # Solo se expulsan trabajos terminados, del más antiguo al más reciente
+        excess = len(self._jobs) - self.max_results
+        if excess <= 0:
+            return
+        for job_id in [i for i, j in self._jobs.items() if j.is_finished][:excess]:
+            del self._jobs[job_id]
@@ -0,0 +1,231 @@
+import logging as log
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import numpy as np
+import olca_schema as o
+import scipy.sparse as sp
+
+from metrics import in_context
+from olca_client import OLCAClient
+
+
+def _key(flow: o.Ref, location: o.Ref | None) -> tuple[str, str | None]:
+    return (flow.id, location.id if location else None)
+
+
+class Inventory:
+    # Flujos elementales totales por unidad de referencia (get_total_flows), con las
+    # entradas en positivo como las devuelve openLCA
+    def __init__(self, envi_flows: list[o.EnviFlow], amounts: np.ndarray):
+        self.envi_flows = envi_flows
+        self.amounts = amounts
+        # Por método: posiciones del inventario con factor y sus columnas en el método
+        self._columns: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+
+    @staticmethod
+    def of(values: list[o.EnviFlowValue]) -> "Inventory":
+        return Inventory([v.envi_flow for v in values], np.array([v.amount for v in values], dtype=float))
+
+
+class ImpactFactors:
+    # Factores de caracterización de un método: una matriz dispersa (categorías × flujos)
+    # sobre su propio índice de flujos (flujo, ubicación). Los factores se aplican a
+    # las cantidades en la unidad de referencia del flujo, como en el resto del servicio
+    # (los de otra unidad o propiedad se convierten al cargarlos)
+    def __init__(
+        self,
+        impact_method_uid: str,
+        impact_categories: list[o.Ref],
+        keys: list[tuple[str, str | None]],
+        matrix: sp.csr_array
+    ):
+        self.impact_method_uid = impact_method_uid
+        self.impact_categories = impact_categories
+        self.index = {key: i for i, key in enumerate(keys)}
+        self.matrix = matrix
+
+    def impacts(self, inventory: Inventory) -> np.ndarray:
+        columns = inventory._columns.get(self.impact_method_uid)
+        if columns is None:
+            positions, found = [], []
+            for p, ef in enumerate(inventory.envi_flows):
+                # Un flujo regionalizado sin factor propio usa el factor sin ubicación
+                i = self.index.get(_key(ef.flow, ef.location))
+                if i is None and ef.location:
+                    i = self.index.get((ef.flow.id, None))
+                if i is not None:
+                    positions.append(p)
+                    found.append(i)
+            columns = inventory._columns[self.impact_method_uid] = (np.array(positions, dtype=int), np.array(found, dtype=int))
+        positions, found = columns
+        return self.matrix[:, found] @ inventory.amounts[positions]
+
+
+def load_impact_factors(client: OLCAClient, impact_method_uid: str, workers: int = 8) -> ImpactFactors:
+    method = client.get_impact_method(impact_method_uid)
+    if method is None:
+        raise ValueError(f"impact method {impact_method_uid} not found")
+    refs = method.impact_categories or []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        categories = list(pool.map(in_context(lambda ref: client.get_impact_category(ref.id)), refs))
+
+    factors = [
+        (k, factor) for k, category in enumerate(categories)
+        for factor in category.impact_factors or []
+        if factor.flow is not None and factor.value
+    ]
+    # Solo se descargan los flujos de los factores que no están en su unidad de referencia
+    entities: dict[str, o.RootEntity | None] = {}
+    uids = sorted({factor.flow.id for _, factor in factors if not _in_ref_unit(client, factor)})
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        flows = list(pool.map(in_context(lambda uid: client.client.get(o.Flow, uid)), uids))
+    entities.update(zip(uids, flows))
+
+    index: dict[tuple[str, str | None], int] = {}
+    rows, cols, values, skipped = [], [], [], 0
+    for k, factor in factors:
+        conversion = 1.0 if _in_ref_unit(client, factor) else _conversion(client, factor, entities)
+        if conversion is None:
+            skipped += 1
+            continue
+        key = _key(factor.flow, factor.location)
+        rows.append(k)
+        cols.append(index.setdefault(key, len(index)))
+        values.append(factor.value * conversion)
+    if skipped:
+        log.warning("%i factors of impact method %s have an unknown unit and were ignored", skipped, impact_method_uid)
+    matrix = sp.csr_array((values, (rows, cols)), shape=(len(categories), len(index)))
+    impact_categories = [
+        o.Ref(ref_type=o.RefType.ImpactCategory, id=c.id, name=c.name, ref_unit=c.ref_unit)
+        for c in categories
+    ]
+    return ImpactFactors(impact_method_uid, impact_categories, list(index), matrix)
+
+
+def _in_ref_unit(client: OLCAClient, factor: o.ImpactFactor) -> bool:
+    if factor.unit is None and factor.flow_property is None:
+        return True
+    ref = client.index.get(o.Flow, uid=factor.flow.id)
+    return ref is not None and factor.unit is not None and factor.unit.name == ref.ref_unit
+
+
+def _conversion(client: OLCAClient, factor: o.ImpactFactor, entities: dict[str, o.RootEntity | None]) -> float | None:
+    # El factor es por unidad de factor.unit en factor.flow_property: al revés que en los
+    # intercambios, factor de la propiedad en el flujo / factor de la unidad en su grupo
+    def entity(model_type: type, uid: str) -> o.RootEntity | None:
+        if uid not in entities:
+            entities[uid] = client.client.get(model_type, uid)
+        return entities[uid]
+
+    flow = entity(o.Flow, factor.flow.id)
+    property_id = factor.flow_property.id if factor.flow_property else None
+    flow_property_factor = next((
+        f for f in (flow.flow_properties if flow else None) or []
+        if f.flow_property and (f.flow_property.id == property_id if property_id else f.is_ref_flow_property)
+    ), None)
+    if flow_property_factor is None or not flow_property_factor.conversion_factor:
+        return None
+    flow_property = entity(o.FlowProperty, flow_property_factor.flow_property.id)
+    group = entity(o.UnitGroup, flow_property.unit_group.id) if flow_property and flow_property.unit_group else None
+    unit_id = factor.unit.id if factor.unit else None
+    unit = next((
+        u for u in (group.units if group else None) or []
+        if (u.id == unit_id if unit_id else u.is_ref_unit)
+    ), None)
+    if unit is None or not unit.conversion_factor:
+        return None
+    return flow_property_factor.conversion_factor / unit.conversion_factor
+
+
+class LCIACache:
+    # Inventarios por objetivo (proceso o sistema de producto) y factores por método,
+    # para responder cualquier número de métodos con un único cálculo de inventario.
+    # Los inventarios se descartan con cualquier escritura y los factores solo cuando
+    # cambia un método o una categoría de impacto
+    def __init__(self, client: OLCAClient, max_inventories: int = 256):
+        self.client = client
+        self.max_inventories = max_inventories
+        self._inventories: OrderedDict[tuple, Inventory] = OrderedDict()
+        self._factors: dict[str, ImpactFactors] = {}
+        self._lock = threading.Lock()
+        # Un lock por método: cargar uno no bloquea a los demás
+        self._loading: dict[str, threading.Lock] = {}
+        # Cambia cada vez que se descartan los factores
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        client.on_change(self.invalidate)
+
+    def inventory(self, key: tuple, compute: Callable[[], list[o.EnviFlowValue]]) -> Inventory:
+        with self._lock:
+            inventory = self._inventories.get(key)
+            if inventory is not None:
+                self._inventories.move_to_end(key)
+                self.hits += 1
+                return inventory
+            self.misses += 1
+        revision = self.client.revision
+        inventory = Inventory.of(compute())
+        with self._lock:
+            # Un inventario calculado mientras había una escritura puede estar obsoleto
+            if revision == self.client.revision:
+                self._inventories[key] = inventory
+                while len(self._inventories) > self.max_inventories:
+                    self._inventories.popitem(last=False)
+        return inventory
+
+    def factors(self, impact_method_uid: str) -> ImpactFactors:
+        with self._lock:
+            factors = self._factors.get(impact_method_uid)
+            if factors is not None:
+                return factors
+            loading = self._loading.setdefault(impact_method_uid, threading.Lock())
+
+        # Un método se descarga una sola vez aunque lo pidan varias peticiones a la vez
+        with loading:
+            with self._lock:
+                factors = self._factors.get(impact_method_uid)
+                if factors is not None:
+                    return factors
+                generation = self._generation
+            factors = load_impact_factors(self.client, impact_method_uid)
+            with self._lock:
+                # Unos factores cargados mientras cambiaba un método pueden estar obsoletos
+                if self._generation == generation:
+                    self._factors[impact_method_uid] = factors
+                self._loading.pop(impact_method_uid, None)
+        return factors
+
+    def impacts(
+        self,
+        key: tuple,
+        compute: Callable[[], list[o.EnviFlowValue]],
+        impact_method_uids: list[str],
+        amount: float
+    ) -> list[tuple[ImpactFactors, np.ndarray]]:
+        # compute devuelve el inventario por unidad; cada método es un producto
+        # matriz-vector sobre él
+        methods = [self.factors(uid) for uid in impact_method_uids]
+        inventory = self.inventory(key, compute)
+        return [(factors, amount * factors.impacts(inventory)) for factors in methods]
+
+    def invalidate(self, model: o.RootEntity | o.Ref) -> None:
+        with self._lock:
+            self._inventories.clear()
+            if isinstance(model, (o.ImpactMethod, o.ImpactCategory)) or (
+                isinstance(model, o.Ref) and model.ref_type in (o.RefType.ImpactMethod, o.RefType.ImpactCategory)
+            ):
+                self._factors.clear()
+                self._generation += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "inventories": len(self._inventories),
+                "impact_methods": len(self._factors),
+                "hits": self.hits,
+                "misses": self.misses
+            }
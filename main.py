@@ -4,8 +4,6 @@ import pandas as pd
 import numpy as np
 import olca_client
 
-from typing import Callable
-
 technosphere = pd.DataFrame(
     data=[
         [1.0, -50.0, -1.0, 0.0],
@@ -45,56 +43,8 @@ interventions = pd.DataFrame(
 
 client = olca_client.OLCAClient()
 
-# Añadir unidades
-client.add_unit_group("Mass units", "kg")
-client.add_unit_group("Energy units", "MJ")
-client.add_unit_group("Counting units", "Item(s)")
-
-# Añadir propiedades de un flujo (flow)
-client.add_flow_property("Mass", "Mass units")
-client.add_flow_property("Energy", "Energy units")
-client.add_flow_property("Number of items", "Counting units")
-
-product_flows = []
-for index, name in enumerate(technosphere.index):
-    parts = name.split("[")
-    name = parts[0].strip()
-    unit = parts[1][0:-1].strip()
-    match unit:
-        case "kg":
-            prop = "Mass"
-        case "MJ":
-            prop = "Energy"
-        case "Item(s)":
-            prop = "Number of items"
-
-    product_flows.append(client.add_product_flow(name, prop))
-
-elementary_flows = []
-for index, name in enumerate(interventions.index):
-    parts = name.split("[")
-    name = parts[0].strip()
-    unit = parts[1][0:-1].strip()
-    match unit:
-        case "kg":
-            prop = "Mass"
-        case "MJ":
-            prop = "Energy"
-        case "Item(s)":
-            prop = "Number of items"
-
-    elementary_flows.append(client.add_elementary_flow(name, prop))
-
-for index, name in enumerate(technosphere.columns):
-    product_exchanges = {product_flow.name: technosphere.iat[i, index] for i, product_flow in enumerate(product_flows)}
-    elementary_exchanges = {elementary_flow.name: interventions.iat[i, index] for i, elementary_flow in enumerate(elementary_flows)}
-
-    client.add_process(
-        name=name,
-        product_exchanges=product_exchanges,
-        elementary_exchanges=elementary_exchanges,
-        quantitative_ref_name=technosphere.index[index]
-    )
+# Añade grupos de unidades, propiedades, flujos y procesos a partir de las matrices
+client.add_matrices(technosphere, interventions)
 
 setup = o.CalculationSetup(
     # "sandwitch package production"
@@ -0,0 +1,788 @@
+import hashlib
+import json
+import logging as log
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Callable
+
+import numpy as np
+import olca_schema as o
+import scipy.sparse as sp
+from scipy.linalg import lu_factor, lu_solve
+from scipy.sparse.linalg import splu
+
+from metrics import instrument
+from olca_client import OLCAClient
+
+# Columnas de A cambiadas (procesos editados) que se resuelven con la factorización
+# anterior antes de refactorizar
+MAX_UPDATE_RANK = 32
+# Versión del formato de las instantáneas en disco; otra versión no se carga
+SNAPSHOT_FORMAT = 2
+# Exportaciones que se conservan en el directorio de la instantánea: un worker que
+# acaba de leer el manifiesto anterior todavía puede abrir la suya
+SNAPSHOT_KEEP = 2
+
+
+def tech_key(tech_flow: o.TechFlow) -> tuple[str, str]:
+    return (tech_flow.provider.id, tech_flow.flow.id)
+
+
+def envi_key(envi_flow: o.EnviFlow) -> tuple[str, str | None]:
+    return (envi_flow.flow.id, envi_flow.location.id if envi_flow.location else None)
+
+
+class LCAMatrices:
+    # A (technosfera), B (intervenciones) y C (factores de caracterización) de
+    # un sistema de producto, con los índices de sus filas y columnas
+    def __init__(
+        self,
+        tech_flows: list[o.TechFlow],
+        envi_flows: list[o.EnviFlow],
+        impact_categories: list[o.Ref],
+        technosphere: sp.csc_array,
+        interventions: sp.csc_array,
+        characterization: sp.csr_array,
+        demand_index: int
+    ):
+        self.tech_flows = tech_flows
+        self.envi_flows = envi_flows
+        self.impact_categories = impact_categories
+        self.technosphere = technosphere
+        self.interventions = interventions
+        self.characterization = characterization
+        self.demand_index = demand_index
+
+        self.tech_index = {tech_key(tf): i for i, tf in enumerate(tech_flows)}
+        self.envi_index = {envi_key(ef): i for i, ef in enumerate(envi_flows)}
+        self._lu = None
+        # Tras with_columns: (factorización, A factorizada, columnas cambiadas desde entonces)
+        self._origin = None
+        self._lock = threading.Lock()
+
+    def lu(self):
+        # La factorización se calcula una única vez y se reutiliza en cada solve
+        if self._lu is None:
+            with self._lock:
+                if self._lu is None:
+                    if self._origin is not None:
+                        lu, factorized, columns = self._origin
+                        try:
+                            self._lu = LowRankLU(lu, factorized, self.technosphere, sorted(columns))
+                        except np.linalg.LinAlgError:
+                            log.warning("low-rank update of %i columns is ill-conditioned, refactorizing", len(columns))
+                            self._origin = None
+                    if self._lu is None:
+                        self._lu = splu(sp.csc_matrix(self.technosphere))
+        return self._lu
+
+    def with_columns(self, columns: dict[int, tuple[np.ndarray, np.ndarray]], max_rank: int = MAX_UPDATE_RANK) -> "LCAMatrices":
+        # Copia con las columnas j de A y B sustituidas por columns[j] = (a, b). Si ya
+        # hay una factorización, la nueva A se resuelve con ella y una corrección de
+        # rango bajo mientras las columnas cambiadas desde que se hizo no pasen de max_rank
+        updated = LCAMatrices(
+            tech_flows=self.tech_flows,
+            envi_flows=self.envi_flows,
+            impact_categories=self.impact_categories,
+            technosphere=_replace_columns(self.technosphere, {j: a for j, (a, _) in columns.items()}),
+            interventions=_replace_columns(self.interventions, {j: b for j, (_, b) in columns.items()}),
+            characterization=self.characterization,
+            demand_index=self.demand_index
+        )
+        origin = self._origin
+        if origin is None and self._lu is not None:
+            origin = (self._lu, self.technosphere, frozenset())
+        if origin is not None and len(origin[2] | columns.keys()) <= max_rank:
+            updated._origin = (origin[0], origin[1], origin[2] | columns.keys())
+        return updated
+
+    def save(self, directory: str) -> None:
+        # Un .npy por array de A y B (CSC) y C (CSR) y los índices en index.json. Cada
+        # fichero se sustituye con un rename, así que los procesos que tienen mapeada
+        # una versión anterior la siguen viendo entera
+        os.makedirs(directory, exist_ok=True)
+        shapes = {}
+        for name, matrix in (
+            ("technosphere", self.technosphere),
+            ("interventions", self.interventions),
+            ("characterization", self.characterization)
+        ):
+            # En formato canónico scipy no reordena (no escribe) los arrays mapeados
+            matrix = matrix.copy()
+            matrix.sum_duplicates()
+            matrix.sort_indices()
+            shapes[name] = matrix.shape
+            for part in ("data", "indices", "indptr"):
+                _replace(os.path.join(directory, f"{name}.{part}.npy"), lambda f: np.save(f, getattr(matrix, part)))
+        index = {
+            "format": SNAPSHOT_FORMAT,
+            "shapes": shapes,
+            "demand_index": self.demand_index,
+            "tech_flows": [tf.to_dict() for tf in self.tech_flows],
+            "envi_flows": [ef.to_dict() for ef in self.envi_flows],
+            "impact_categories": [c.to_dict() for c in self.impact_categories]
+        }
+        _replace(os.path.join(directory, "index.json"), lambda f: f.write(json.dumps(index).encode()))
+
+    @staticmethod
+    def load(directory: str, mmap: bool = True) -> "LCAMatrices":
+        # Con mmap los arrays se leen del disco bajo demanda y los procesos que abren
+        # la misma instantánea comparten las páginas
+        with open(os.path.join(directory, "index.json")) as f:
+            index = json.load(f)
+        if index.get("format") != SNAPSHOT_FORMAT:
+            raise ValueError(f"{directory} has snapshot format {index.get('format')}, expected {SNAPSHOT_FORMAT}")
+
+        def matrix(name: str, cls: type) -> sp.sparray:
+            parts = [
+                np.load(os.path.join(directory, f"{name}.{part}.npy"), mmap_mode="r" if mmap else None)
+                for part in ("data", "indices", "indptr")
+            ]
+            return cls(tuple(parts), shape=tuple(index["shapes"][name]))
+
+        return LCAMatrices(
+            tech_flows=[o.TechFlow.from_dict(d) for d in index["tech_flows"]],
+            envi_flows=[o.EnviFlow.from_dict(d) for d in index["envi_flows"]],
+            impact_categories=[o.Ref.from_dict(d) for d in index["impact_categories"]],
+            technosphere=matrix("technosphere", sp.csc_array),
+            interventions=matrix("interventions", sp.csc_array),
+            characterization=matrix("characterization", sp.csr_array),
+            demand_index=index["demand_index"]
+        )
+
+    def __getstate__(self) -> dict:
+        # Para enviarlas a otros procesos: la factorización se rehace allí
+        state = self.__dict__.copy()
+        state["_lu"] = None
+        state["_origin"] = None
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def demand(self, amount: float) -> np.ndarray:
+        f = np.zeros(len(self.tech_flows))
+        # Los tratamientos de residuos tienen la referencia como entrada (negativa)
+        d = self.demand_index
+        f[d] = amount if self.technosphere[d, d] >= 0 else -amount
+        return f
+
+    def solve(self, demand: np.ndarray) -> np.ndarray:
+        return self.lu().solve(demand)
+
+    def impacts_of(self, scaling: np.ndarray) -> np.ndarray:
+        return self.characterization @ (self.interventions @ scaling)
+
+
+class LowRankLU:
+    # Resuelve A·x = b para A = A0 + U·E_Jᵀ, que solo difiere de A0 en las columnas J,
+    # con la factorización de A0 (Sherman–Morrison–Woodbury):
+    # x = y - Z·(I + Z_J)⁻¹·y_J, con y = A0⁻¹·b y Z = A0⁻¹·U
+    def __init__(self, lu, factorized: sp.csc_array, technosphere: sp.csc_array, columns: list[int]):
+        self.lu = lu
+        self.columns = np.array(columns, dtype=int)
+        delta = (technosphere[:, self.columns] - factorized[:, self.columns]).toarray()
+        self.z = lu.solve(delta)
+        small = np.eye(len(columns)) + self.z[self.columns]
+        if len(columns) and np.linalg.cond(small) > 1e12:
+            raise np.linalg.LinAlgError("singular low-rank update")
+        self.small = lu_factor(small) if len(columns) else None
+
+    def solve(self, b: np.ndarray) -> np.ndarray:
+        y = self.lu.solve(b)
+        if self.small is None:
+            return y
+        return y - self.z @ lu_solve(self.small, y[self.columns])
+
+
+def _replace(path: str, write) -> None:
+    with open(path + ".tmp", "wb") as f:
+        write(f)
+    os.replace(path + ".tmp", path)
+
+
+def _replace_columns(matrix: sp.csc_array, columns: dict[int, np.ndarray]) -> sp.csc_array:
+    # Suma la diferencia con las columnas actuales
+    js = np.array(sorted(columns), dtype=int)
+    delta = np.column_stack([columns[j] for j in js]) - matrix[:, js].toarray()
+    rows, k = np.nonzero(delta)
+    replaced = sp.csc_array(matrix + sp.csc_array((delta[rows, k], (rows, js[k])), shape=matrix.shape))
+    replaced.eliminate_zeros()
+    return replaced
+
+
+def exchange_sign(exchange: o.Exchange) -> float:
+    # Convenio de openLCA: salidas en positivo y entradas en negativo; los flujos de
+    # residuo y los productos (o residuos) evitados cambian de lado
+    sign = -1.0 if exchange.is_input else 1.0
+    if exchange.flow.flow_type == o.FlowType.WASTE_FLOW:
+        sign = -sign
+    if exchange.is_avoided_product:
+        sign = -sign
+    return sign
+
+
+def exchange_rows(
+    matrices: LCAMatrices,
+    process: o.Process,
+    linked_only: bool = False
+) -> tuple[int, list[tuple[str, int, float] | None]]:
+    # Columna del proceso en A y, para cada intercambio (en el orden de process.exchanges),
+    # su celda en esa columna: matriz ("A" o "B"), fila y el signo con el que entra la
+    # cantidad según su dirección. En B, como en los resultados de openLCA, el signo es
+    # relativo a la dirección del flujo elemental del índice. None si no está en las
+    # matrices (coproductos incluidos); con linked_only, también los intercambios
+    # técnicos sin proveedor en la columna
+    reference = next(e for e in process.exchanges if e.is_quantitative_reference)
+    j = matrices.tech_index[(process.id, reference.flow.id)]
+    # Proveedores enlazados a los intercambios técnicos del proceso
+    column = matrices.technosphere[:, [j]].tocoo()
+    linked = {matrices.tech_flows[i].flow.id: i for i in column.row}
+    rows = []
+    for e in process.exchanges:
+        if e.is_quantitative_reference:
+            kind, i = "A", j
+        elif e.flow.flow_type == o.FlowType.ELEMENTARY_FLOW:
+            location = e.location.id if e.location else None
+            i = matrices.envi_index.get((e.flow.id, location))
+            if i is None:
+                i = matrices.envi_index.get((e.flow.id, None))
+            kind = "B"
+        elif exchange_sign(e) > 0:
+            # Salidas de producto o entradas de residuo que no son la referencia
+            i = None
+        else:
+            i = linked.get(e.flow.id)
+            if i is None and not linked_only:
+                i = next((i for i, tf in enumerate(matrices.tech_flows) if tf.flow.id == e.flow.id), None)
+            kind = "A"
+        if i is None:
+            rows.append(None)
+        elif kind == "B":
+            rows.append((kind, i, 1.0 if bool(e.is_input) == bool(matrices.envi_flows[i].is_input) else -1.0))
+        else:
+            rows.append((kind, i, exchange_sign(e)))
+    return j, rows
+
+
+def export_matrices(client: OLCAClient, product_system_uid: str, impact_method_uid: str) -> LCAMatrices:
+    result = client.calculate_product_system_impact(
+        product_system_uid=product_system_uid,
+        impact_method_uid=impact_method_uid,
+        amount=1
+    )
+
+    try:
+        # Si el cálculo falla, el resultado no tiene matrices ni demanda
+        state = result.get_state()
+        if state.error:
+            raise RuntimeError(
+                f"calculation of product system {product_system_uid} with impact method {impact_method_uid} failed: {state.error}"
+            )
+        tech_flows = result.get_tech_flows()
+        envi_flows = result.get_envi_flows()
+        impact_categories = result.get_impact_categories()
+        tech_index = {tech_key(tf): i for i, tf in enumerate(tech_flows)}
+        envi_index = {envi_key(ef): i for i, ef in enumerate(envi_flows)}
+        n, m, k = len(tech_flows), len(envi_flows), len(impact_categories)
+
+        scaling = np.zeros(n)
+        for v in result.get_scaling_factors():
+            scaling[tech_index[tech_key(v.tech_flow)]] = v.amount
+
+        rows, cols, values = [], [], []
+        for j, tech_flow in enumerate(tech_flows):
+            # La exportación de un sistema grande puede durar más que el plazo del resultado
+            result.renew()
+            for v in result.get_unscaled_tech_flows_of(tech_flow):
+                rows.append(tech_index[tech_key(v.tech_flow)])
+                cols.append(j)
+                values.append(v.amount)
+        technosphere = sp.csc_array((values, (rows, cols)), shape=(n, n))
+
+        # Las intervenciones directas vienen escaladas, así que se dividen por el
+        # factor de escala. Las columnas con escala cero se reconstruyen como
+        # B[:, j] = sum_i G[:, i] * A[i, j], con G las intensidades de flujo
+        rows, cols, values = [], [], []
+        unscaled = []
+        for j, tech_flow in enumerate(tech_flows):
+            if scaling[j] == 0:
+                unscaled.append(j)
+                continue
+            for v in result.get_direct_interventions_of(tech_flow):
+                rows.append(envi_index[envi_key(v.envi_flow)])
+                cols.append(j)
+                values.append(v.amount / scaling[j])
+
+        intensities: dict[int, list[o.EnviFlowValue]] = {}
+        for j in unscaled:
+            column = technosphere[:, [j]].tocoo()
+            for i, a in zip(column.row, column.data):
+                if i not in intensities:
+                    intensities[i] = result.get_flow_intensities_of(tech_flows[i])
+                for v in intensities[i]:
+                    rows.append(envi_index[envi_key(v.envi_flow)])
+                    cols.append(j)
+                    values.append(v.amount * a)
+        interventions = sp.csc_array((values, (rows, cols)), shape=(m, n))
+
+        rows, cols, values = [], [], []
+        for i, impact_category in enumerate(impact_categories):
+            for v in result.get_impact_factors_of(impact_category):
+                key = envi_key(v.envi_flow)
+                if key not in envi_index:
+                    continue
+                rows.append(i)
+                cols.append(envi_index[key])
+                values.append(v.amount)
+        characterization = sp.csr_array((values, (rows, cols)), shape=(k, m))
+
+        demand = result.get_demand()
+        if demand is None:
+            raise RuntimeError(f"product system {product_system_uid} has no demand in its result")
+        matrices = LCAMatrices(
+            tech_flows=tech_flows,
+            envi_flows=envi_flows,
+            impact_categories=impact_categories,
+            technosphere=technosphere,
+            interventions=interventions,
+            characterization=characterization,
+            demand_index=tech_index[tech_key(demand.tech_flow)]
+        )
+
+        expected = {i.impact_category.id: i.amount for i in result.get_total_impacts()}
+        expected = np.array([expected.get(c.id, 0.0) for c in impact_categories])
+        computed = matrices.impacts_of(matrices.solve(matrices.demand(demand.amount)))
+        if not np.allclose(computed, expected, rtol=1e-6, atol=1e-12):
+            log.warning("exported matrices of product system %s do not reproduce the IPC result", product_system_uid)
+    finally:
+        result.dispose()
+
+    return matrices
+
+
+class MatrixResult:
+    # Implementa el subconjunto de ipc.Result que usa el servicio, calculado en
+    # memoria a partir de las matrices exportadas
+    def __init__(self, matrices: LCAMatrices, amount: float):
+        self.matrices = matrices
+        self.amount = amount
+        self.scaling = matrices.solve(matrices.demand(amount))
+        self._impacts = None
+
+    def __enter__(self) -> "MatrixResult":
+        return self
+
+    def __exit__(self, *_) -> None:
+        pass
+
+    def wait_until_ready(self) -> o.ResultState:
+        return o.ResultState(is_ready=True)
+
+    def dispose(self):
+        pass
+
+    def get_tech_flows(self) -> list[o.TechFlow]:
+        return self.matrices.tech_flows
+
+    def get_envi_flows(self) -> list[o.EnviFlow]:
+        return self.matrices.envi_flows
+
+    def get_impact_categories(self) -> list[o.Ref]:
+        return self.matrices.impact_categories
+
+    def get_demand(self) -> o.TechFlowValue:
+        tech_flow = self.matrices.tech_flows[self.matrices.demand_index]
+        return o.TechFlowValue(tech_flow=tech_flow, amount=self.amount)
+
+    def get_scaling_factors(self) -> list[o.TechFlowValue]:
+        return [
+            o.TechFlowValue(tech_flow=tf, amount=float(s))
+            for tf, s in zip(self.matrices.tech_flows, self.scaling)
+        ]
+
+    def get_total_requirements(self) -> list[o.TechFlowValue]:
+        requirements = self.scaling * self.matrices.technosphere.diagonal()
+        return [
+            o.TechFlowValue(tech_flow=tf, amount=float(r))
+            for tf, r in zip(self.matrices.tech_flows, requirements)
+        ]
+
+    def get_total_flows(self) -> list[o.EnviFlowValue]:
+        inventory = self.matrices.interventions @ self.scaling
+        return [
+            o.EnviFlowValue(envi_flow=ef, amount=float(g))
+            for ef, g in zip(self.matrices.envi_flows, inventory)
+        ]
+
+    def get_total_impacts(self) -> list[o.ImpactValue]:
+        if self._impacts is None:
+            self._impacts = self.matrices.impacts_of(self.scaling)
+        return self._impact_values(self._impacts)
+
+    def get_impact_intensities_of(self, tech_flow: o.TechFlow) -> list[o.ImpactValue]:
+        return self._impact_values(self._intensities_of(tech_flow))
+
+    def get_total_impacts_of(self, tech_flow: o.TechFlow) -> list[o.ImpactValue]:
+        j = self.matrices.tech_index[tech_key(tech_flow)]
+        column = self._inverse_column(j)
+        a_jj = self.matrices.technosphere[j, j]
+        # Igual que openLCA: el factor de bucle evita contar dos veces los ciclos
+        loop_factor = 1 / (a_jj * column[j]) if column[j] != 0 else 1
+        requirement = self.scaling[j] * a_jj
+        return self._impact_values(self.matrices.impacts_of(column) * requirement * loop_factor)
+
+    def _inverse_column(self, j: int) -> np.ndarray:
+        unit = np.zeros(len(self.matrices.tech_flows))
+        unit[j] = 1
+        return self.matrices.solve(unit)
+
+    def _intensities_of(self, tech_flow: o.TechFlow) -> np.ndarray:
+        j = self.matrices.tech_index[tech_key(tech_flow)]
+        return self.matrices.impacts_of(self._inverse_column(j))
+
+    def _impact_values(self, amounts: np.ndarray) -> list[o.ImpactValue]:
+        return [
+            o.ImpactValue(impact_category=c, amount=float(a))
+            for c, a in zip(self.matrices.impact_categories, amounts)
+        ]
+
+
+@instrument
+class MatrixEngine:
+    # Alternativa al cálculo por IPC: exporta las matrices una vez por sistema de
+    # producto y método, y resuelve h = C·B·A⁻¹·f en el propio proceso
+    def __init__(self, client: OLCAClient, max_update_rank: int = MAX_UPDATE_RANK, record_fingerprints: bool = False):
+        self.client = client
+        self.max_update_rank = max_update_rank
+        self._matrices: dict[tuple[str, str], LCAMatrices] = {}
+        # Con record_fingerprints (snapshot.py) se toma la huella de cada sistema justo
+        # antes de exportarlo; es la que se guarda en la instantánea
+        self.record_fingerprints = record_fingerprints
+        self._fingerprints: dict[tuple[str, str | None], str] = {}
+        # Matrices de la instantánea que aún no se han comprobado contra la base de datos
+        self._unverified: set[tuple[str, str | None]] = set()
+        # Flujos, propiedades y grupos de unidades para convertir las cantidades editadas
+        self._entities: dict[str, o.RootEntity | None] = {}
+        # _lock solo protege los diccionarios. Cada exportación tiene su propio lock, así
+        # que las de otros sistemas y los listeners de escritura no la esperan; _generation
+        # cambia con cada escritura y lo exportado mientras tanto no se guarda
+        self._lock = threading.Lock()
+        self._loading: dict[tuple[str, str | None], threading.Lock] = {}
+        self._generation = 0
+        client.on_change(self.changed)
+
+    def get_matrices(self, product_system_uid: str, impact_method_uid: str | None) -> LCAMatrices:
+        key = (product_system_uid, impact_method_uid)
+        return self._load(key, lambda: self._export(key, product_system_uid))
+
+    def get_process_matrices(self, process_uid: str, impact_method_uid: str | None) -> LCAMatrices:
+        key = (process_uid, impact_method_uid)
+
+        def export() -> tuple[LCAMatrices, str | None]:
+            with self.client.product_systems.lease(process_uid) as product_system:
+                return self._export(key, product_system.id)
+
+        return self._load(key, export)
+
+    def _load(self, key: tuple[str, str | None], export: Callable[[], tuple[LCAMatrices, str | None]]) -> LCAMatrices:
+        with self._lock:
+            matrices = self._lookup(key)
+            if matrices is not None:
+                return matrices
+            loading = self._loading.setdefault(key, threading.Lock())
+
+        # Una sola exportación por clave aunque la pidan varias peticiones a la vez
+        with loading:
+            with self._lock:
+                matrices = self._lookup(key)
+                if matrices is not None:
+                    return matrices
+                generation = self._generation
+            matrices, fingerprint = export()
+            with self._lock:
+                if self._generation == generation:
+                    self._matrices[key] = matrices
+                    self._set_fingerprint(key, fingerprint)
+                self._loading.pop(key, None)
+        return matrices
+
+    def _export(self, key: tuple[str, str | None], product_system_uid: str) -> tuple[LCAMatrices, str | None]:
+        fingerprint = self._export_fingerprint(key, product_system_uid)
+        return export_matrices(self.client, product_system_uid, key[1]), fingerprint
+
+    def fingerprint(self, key: tuple[str, str | None], providers: list[o.Ref], impact_categories: list[o.Ref]) -> str:
+        # Huella de lo que determina las matrices: los procesos (o subsistemas) del
+        # sistema, el propio sistema de producto y el método con sus categorías
+        refs = sorted({ref.id: ref for ref in providers}.values(), key=lambda ref: ref.id)
+        if not any(ref.id == key[0] for ref in refs):
+            refs.append(o.Ref(ref_type=o.RefType.ProductSystem, id=key[0]))
+        if key[1]:
+            refs.append(o.Ref(ref_type=o.RefType.ImpactMethod, id=key[1]))
+        refs.extend(o.Ref(ref_type=o.RefType.ImpactCategory, id=uid) for uid in sorted({c.id for c in impact_categories}))
+        return self.client.fingerprint(refs)
+
+    def _export_fingerprint(self, key: tuple[str, str | None], product_system_uid: str) -> str | None:
+        # Antes de exportar: una edición que llegue durante la exportación deja la huella
+        # vieja y la instantánea se descarta al abrirla, nunca al revés
+        if not self.record_fingerprints:
+            return None
+        system = self.client.get_product_system(uid=product_system_uid)
+        method = self.client.get_impact_method(key[1]) if key[1] else None
+        providers = [
+            o.Ref(ref_type=ref.ref_type or o.RefType.Process, id=ref.id)
+            for ref in (system.processes if system else None) or []
+        ]
+        return self.fingerprint(key, providers, (method.impact_categories if method else None) or [])
+
+    def _set_fingerprint(self, key: tuple[str, str | None], fingerprint: str | None) -> None:
+        if fingerprint is None:
+            self._fingerprints.pop(key, None)
+        else:
+            self._fingerprints[key] = fingerprint
+
+    def save_snapshot(self, directory: str) -> int:
+        # Cada exportación va a su propia carpeta (una subcarpeta por sistema y método) y
+        # el manifiesto pasa a apuntarla con un rename: quien abre la instantánea ve la
+        # exportación anterior o la nueva completas, nunca una mezcla
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            items = [(key, matrices, self._fingerprints.get(key)) for key, matrices in self._matrices.items()]
+        export = tempfile.mkdtemp(dir=directory, prefix=time.strftime("export-%Y%m%d-%H%M%S-"))
+        os.chmod(export, 0o755)
+        entries = []
+        for key, matrices, fingerprint in items:
+            # Solo las exportadas con record_fingerprints: la huella es de antes de exportarlas
+            if fingerprint is None:
+                log.warning("matrices of %s / %s have no export fingerprint, not saved", *key)
+                continue
+            name = hashlib.sha1(f"{key[0]}/{key[1]}".encode()).hexdigest()[:16]
+            matrices.save(os.path.join(export, name))
+            entries.append({
+                "key": list(key),
+                "path": os.path.join(os.path.basename(export), name),
+                "fingerprint": fingerprint
+            })
+        manifest = {"format": SNAPSHOT_FORMAT, "created": time.time(), "matrices": entries}
+        _replace(os.path.join(directory, "manifest.json"), lambda f: f.write(json.dumps(manifest, indent=2).encode()))
+
+        exports = sorted(
+            (e for e in os.scandir(directory) if e.is_dir() and e.name.startswith("export-")),
+            key=lambda e: e.stat().st_mtime
+        )
+        for old in exports[:-SNAPSHOT_KEEP]:
+            shutil.rmtree(old.path, ignore_errors=True)
+        return len(entries)
+
+    def load_snapshot(self, directory: str, verify: bool = True) -> int:
+        # Las matrices de la instantánea se tratan como exportadas: las escrituras
+        # posteriores las actualizan o descartan igual que al resto. Se sirven en cuanto
+        # se abren; con verify, un hilo comprueba después las huellas (descarga cada
+        # proceso) y descarta las de sistemas o métodos que han cambiado
+        with open(os.path.join(directory, "manifest.json")) as f:
+            manifest = json.load(f)
+        if manifest.get("format") != SNAPSHOT_FORMAT:
+            raise ValueError(f"{directory} has snapshot format {manifest.get('format')}, expected {SNAPSHOT_FORMAT}")
+        loaded = []
+        for entry in manifest["matrices"]:
+            key = tuple(entry["key"])
+            loaded.append((key, LCAMatrices.load(os.path.join(directory, entry["path"])), entry["fingerprint"]))
+        with self._lock:
+            for key, matrices, _ in loaded:
+                if key not in self._matrices:
+                    self._matrices[key] = matrices
+                    if verify:
+                        self._unverified.add(key)
+        log.info("loaded %i matrices from snapshot %s (%.0f s old)", len(loaded), directory, time.time() - manifest["created"])
+        if verify:
+            threading.Thread(target=self.verify_snapshot, args=(loaded,), name="snapshot-check", daemon=True).start()
+        return len(loaded)
+
+    def verify_snapshot(self, loaded: list[tuple[tuple[str, str | None], LCAMatrices, str]]) -> int:
+        # Devuelve cuántas se han descartado
+        stale = 0
+        for key, matrices, fingerprint in loaded:
+            with self._lock:
+                if key not in self._unverified:
+                    continue
+            try:
+                current = self.fingerprint(key, [tf.provider for tf in matrices.tech_flows], matrices.impact_categories)
+            except Exception as e:
+                log.warning("snapshot matrices of %s / %s not verified: %s", *key, e)
+                continue
+            with self._lock:
+                if key not in self._unverified:
+                    continue
+                self._unverified.discard(key)
+                if current != fingerprint:
+                    # También las que ya se han actualizado con ediciones locales: partían de matrices viejas
+                    self._matrices.pop(key, None)
+                    stale += 1
+            if current != fingerprint:
+                log.warning("snapshot matrices of %s / %s are out of date, they will be exported again", *key)
+        return stale
+
+    def _lookup(self, key: tuple[str, str | None]) -> LCAMatrices | None:
+        # Para el inventario (sin método) sirven A y B exportadas con cualquier método
+        matrices = self._matrices.get(key)
+        if matrices is None and key[1] is None:
+            matrices = next((m for k, m in list(self._matrices.items()) if k[0] == key[0]), None)
+        return matrices
+
+    def invalidate(self, uid: str | None = None) -> None:
+        # Sin uid se descarta todo; con uid, las matrices de ese sistema/proceso
+        # y las de cualquier sistema que lo contenga como proveedor
+        with self._lock:
+            self._generation += 1
+            if uid is None:
+                self._matrices.clear()
+                self._entities.clear()
+                self._fingerprints.clear()
+                self._unverified.clear()
+                return
+            for key, matrices in list(self._matrices.items()):
+                if key[0] == uid or any(tf.provider.id == uid for tf in matrices.tech_flows):
+                    del self._matrices[key]
+                    self._fingerprints.pop(key, None)
+                    self._unverified.discard(key)
+
+    def changed(self, model: o.RootEntity | o.Ref) -> None:
+        # Un proceso editado se aplica sobre las matrices en memoria; un sistema de
+        # producto o un proceso borrado descartan las suyas, y el resto de cambios
+        # (flujos, unidades, métodos) todas
+        if isinstance(model, o.Process):
+            self.update_process(model)
+        elif isinstance(model, o.ProductSystem):
+            self.invalidate(model.id)
+        elif isinstance(model, o.Ref) and model.ref_type in (o.RefType.Process, o.RefType.ProductSystem):
+            self.invalidate(model.id)
+        else:
+            self.invalidate()
+
+    def update_process(self, process: o.Process) -> None:
+        # Sustituye la columna del proceso en las matrices que lo contienen; las que no
+        # se pueden actualizar así (flujos o enlaces nuevos, fórmulas, asignación) se
+        # descartan y se exportarán de nuevo
+        factors = self._conversions(process)
+        dropped = set()
+        with self._lock:
+            self._generation += 1
+            for key, matrices in list(self._matrices.items()):
+                if not any(tf.provider.id == process.id for tf in matrices.tech_flows):
+                    continue
+                updated = self._updated(matrices, process, factors)
+                if updated is None:
+                    dropped.add(key[0])
+                else:
+                    self._matrices[key] = updated
+                    # Ya no son las exportadas: su huella no vale para una instantánea
+                    self._fingerprints.pop(key, None)
+        for uid in dropped:
+            log.info("process %s cannot be applied to the matrices of %s, dropping them", process.id, uid)
+            self.invalidate(uid)
+
+    def preview_process(
+        self,
+        process: o.Process,
+        impact_method_uid: str,
+        amount: float,
+        product_system_uid: str | None = None
+    ) -> tuple[MatrixResult, MatrixResult]:
+        # Resultados actual y con el proceso editado, sin guardarlo: en el sistema
+        # product_system_uid o, sin él, en el del propio proceso
+        if product_system_uid:
+            matrices = self.get_matrices(product_system_uid, impact_method_uid)
+        else:
+            matrices = self.get_process_matrices(process.id, impact_method_uid)
+        if not any(tf.provider.id == process.id for tf in matrices.tech_flows):
+            raise ValueError(f"process {process.id} is not part of the product system")
+        updated = self._updated(matrices, process, self._conversions(process))
+        if updated is None:
+            raise ValueError(
+                "the edit cannot be applied to the product system matrices "
+                "(new flows or links, amount formulas, allocation or units without conversion)"
+            )
+        return MatrixResult(matrices, amount), MatrixResult(updated, amount)
+
+    def _conversions(self, process: o.Process) -> list[float] | None:
+        # Factor de cada intercambio a la unidad de referencia de su flujo, o None si el
+        # proceso no se puede llevar a las matrices columna a columna: cantidades con
+        # fórmula, asignación entre coproductos o unidades que no se pueden convertir
+        if not process.exchanges or process.allocation_factors:
+            return None
+        outputs = [
+            e for e in process.exchanges
+            if e.flow.flow_type != o.FlowType.ELEMENTARY_FLOW and exchange_sign(e) > 0 and e.amount
+        ]
+        if len(outputs) > 1:
+            return None
+        factors = []
+        for e in process.exchanges:
+            if e.amount_formula:
+                return None
+            factor = self._conversion(e) if e.amount else 1.0
+            if factor is None:
+                return None
+            factors.append(factor)
+        return factors
+
+    def _conversion(self, exchange: o.Exchange) -> float | None:
+        # Como openLCA: factor de la unidad en su grupo / factor de la propiedad en el flujo
+        flow = self._entity(o.Flow, exchange.flow.id)
+        property_id = exchange.flow_property.id if exchange.flow_property else None
+        factor = next((
+            f for f in (flow.flow_properties if flow else None) or []
+            if f.flow_property and (f.flow_property.id == property_id if property_id else f.is_ref_flow_property)
+        ), None)
+        if factor is None or not factor.conversion_factor:
+            return None
+        flow_property = self._entity(o.FlowProperty, factor.flow_property.id)
+        group = self._entity(o.UnitGroup, flow_property.unit_group.id) if flow_property and flow_property.unit_group else None
+        unit_id = exchange.unit.id if exchange.unit else None
+        unit = next((
+            u for u in (group.units if group else None) or []
+            if (u.id == unit_id if unit_id else u.is_ref_unit)
+        ), None)
+        if unit is None or not unit.conversion_factor:
+            return None
+        return unit.conversion_factor / factor.conversion_factor
+
+    def _entity(self, model_type: type, uid: str) -> o.RootEntity | None:
+        if uid not in self._entities:
+            self._entities[uid] = self.client.client.get(model_type, uid)
+        return self._entities[uid]
+
+    def _updated(self, matrices: LCAMatrices, process: o.Process, factors: list[float] | None) -> LCAMatrices | None:
+        # Nuevas columnas de A y B a partir de las cantidades de los intercambios en la
+        # unidad de referencia de cada flujo
+        if factors is None:
+            return None
+        try:
+            j, rows = exchange_rows(matrices, process, linked_only=True)
+        except (KeyError, StopIteration):
+            return None
+        a, b = np.zeros(len(matrices.tech_flows)), np.zeros(len(matrices.envi_flows))
+        for e, row, factor in zip(process.exchanges, rows, factors):
+            if not e.amount:
+                continue
+            if row is None:
+                return None
+            kind, i, sign = row
+            # openLCA toma la dirección del flujo elemental de su primer intercambio: uno en
+            # sentido contrario puede cambiar el índice al exportar de nuevo
+            if kind == "B" and sign < 0:
+                return None
+            (a if kind == "A" else b)[i] += sign * e.amount * factor
+        return matrices.with_columns({j: (a, b)}, self.max_update_rank)
+
+    # Calculations
+    def calculate_process_impact(self, process_uid: str, impact_method_uid: str | None, amount: int) -> MatrixResult:
+        return MatrixResult(self.get_process_matrices(process_uid, impact_method_uid), amount)
+
+    def calculate_product_system_impact(self, product_system_uid: str, impact_method_uid: str | None, amount: int) -> MatrixResult:
+        return MatrixResult(self.get_matrices(product_system_uid, impact_method_uid), amount)
@@ -0,0 +1,243 @@
+import bisect
+import contextvars
+import functools
+import inspect
+import os
+import re
+import threading
+import time
+from typing import Callable, Iterator
+
+# Latencias en segundos, de 1 ms a 1 min
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple = (), amount: float = 1.0) -> None:
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def samples(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # Por etiquetas: cuentas por bucket (la última es +Inf), suma
+        self.values: dict[tuple, tuple[list[int], list[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self.values.setdefault(labels, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[i] += 1
+            total[0] += value
+
+    def samples(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = [(labels, list(counts), total[0]) for labels, (counts, total) in self.values.items()]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                yield f"{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {cumulative}"
+
+
+class Gauge:
+    # El valor se lee al exportar, de collect(): {etiquetas: valor}
+    def __init__(self, name: str, help: str, labels: tuple[str, ...], collect: Callable[[], dict[tuple, float]]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+
+    def samples(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in self.collect().items():
+            yield f"{self.name}{_labels(self.labels, labels)} {float(value)}"
+
+
+class Registry:
+    # Métricas en formato de texto de Prometheus. Con enabled=False no se mide nada:
+    # cada punto instrumentado se queda en una comprobación de un atributo
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.metrics: dict[str, Counter | Histogram | Gauge] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, labels: tuple[str, ...], collect: Callable[[], dict[tuple, float]]) -> Gauge:
+        # Una gauge con el mismo nombre sustituye a la anterior (p. ej. al recrear el cliente)
+        with self._lock:
+            self.metrics[name] = Gauge(name, help, labels, collect)
+            return self.metrics[name]
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.samples()) + "\n"
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labels != metric.labels:
+                    raise ValueError(f"metric {metric.name} is already registered with another type or labels")
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+
+# OLCA_METRICS=0 desactiva las métricas y las trazas
+REGISTRY = Registry(enabled=os.getenv("OLCA_METRICS", "1") != "0")
+
+CLIENT_SECONDS = REGISTRY.histogram(
+    "olca_client_method_seconds", "Duration of OLCAClient methods", ("method",)
+)
+
+
+class Trace:
+    # Tiempo acumulado y número de llamadas por tramo (métodos del cliente, llamadas
+    # IPC) durante una petición HTTP. Los tramos anidados se solapan
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans: dict[str, list[float]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float) -> None:
+        with self._lock:
+            span = self.spans.setdefault(name, [0.0, 0])
+            span[0] += seconds
+            span[1] += 1
+
+    def server_timing(self) -> str:
+        # Cabecera Server-Timing: los nombres solo admiten caracteres de token
+        with self._lock:
+            spans = sorted(self.spans.items(), key=lambda s: -s[1][0])
+        total = time.perf_counter() - self.started
+        entries = [f"total;dur={total * 1000:.2f}"]
+        for name, (seconds, calls) in spans:
+            entries.append(f'{re.sub(r"[^A-Za-z0-9_.-]", ".", name)};dur={seconds * 1000:.2f};desc="{calls:.0f}"')
+        return ", ".join(entries)
+
+
+_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("trace", default=None)
+
+
+def start_trace() -> Trace:
+    trace = Trace()
+    _trace.set(trace)
+    return trace
+
+
+def record(name: str, seconds: float) -> None:
+    trace = _trace.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+def in_context(f: Callable) -> Callable:
+    # Para ThreadPoolExecutor: ejecuta f con el contexto (y la traza) del hilo que la
+    # envuelve. Cada llamada usa su propia copia porque un contexto no se puede usar
+    # en dos hilos a la vez
+    context = contextvars.copy_context()
+
+    @functools.wraps(f)
+    def run(*args, **kwargs):
+        return context.copy().run(f, *args, **kwargs)
+    return run
+
+
+def instrument(cls: type) -> type:
+    # Mide cada método público de cls en CLIENT_SECONDS y en la traza de la petición
+    for name, f in list(vars(cls).items()):
+        if name.startswith("_") or not callable(f):
+            continue
+        timed = _timed_generator if inspect.isgeneratorfunction(f) else _timed
+        setattr(cls, name, timed(f"{cls.__name__}.{name}", f))
+    return cls
+
+
+def _timed(name: str, f: Callable) -> Callable:
+    labels = (name,)
+
+    @functools.wraps(f)
+    def timed(*args, **kwargs):
+        if not REGISTRY.enabled:
+            return f(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - started
+            CLIENT_SECONDS.observe(labels, seconds)
+            record(name, seconds)
+    return timed
+
+
+def _timed_generator(name: str, f: Callable) -> Callable:
+    # Llamar a un generador no ejecuta nada: se suma el tiempo de cada paso de la
+    # iteración, sin contar lo que tarda quien lo consume
+    labels = (name,)
+
+    @functools.wraps(f)
+    def timed(*args, **kwargs):
+        if not REGISTRY.enabled:
+            yield from f(*args, **kwargs)
+            return
+        iterator = f(*args, **kwargs)
+        seconds = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += time.perf_counter() - started
+                yield item
+        finally:
+            iterator.close()
+            CLIENT_SECONDS.observe(labels, seconds)
+            record(name, seconds)
+    return timed
@@ -0,0 +1,13 @@
+from olca_client import OLCAClient
+from ventum_flows import load_mappings, parameter_name
+
+# Migración única: convierte las cantidades fijas de los procesos de primer plano de cada
+# cultivo de ventum_flows.yaml en parámetros de proceso, para que /ventum-acv pueda
+# redefinirlos por cálculo
+
+client = OLCAClient(port=8080)
+
+for mapping in load_mappings().values():
+    for name in mapping.stages.values():
+        process = client.parameterize_process(name, lambda exchange: parameter_name(name, exchange))
+        print(f"{name}: {len(process.parameters)} parámetros")
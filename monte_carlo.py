@@ -0,0 +1,486 @@
+import logging as log
+import math
+import multiprocessing
+import pickle
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import olca_schema as o
+import scipy.sparse as sp
+from scipy.sparse.linalg import splu
+
+from matrix_engine import LCAMatrices, exchange_rows
+from metrics import in_context
+from olca_client import OLCAClient
+from ventum_flows import CompiledMapping, CompiledStage
+
+PERCENTILES = (2.5, 5.0, 25.0, 50.0, 75.0, 95.0, 97.5)
+# Elementos de X (filas de A × iteraciones × lados derechos) por bloque, ~160 MB
+CHUNK_ELEMENTS = 20_000_000
+MAX_CHUNK_SIZE = 1000
+# Refinamientos con la factorización nominal antes de factorizar A_k por separado
+MAX_REFINEMENTS = 30
+TOLERANCE = 1e-10
+
+LOG_NORMAL, NORMAL, UNIFORM, TRIANGLE = range(1, 5)
+_CODES = {
+    o.UncertaintyType.LOG_NORMAL_DISTRIBUTION: LOG_NORMAL,
+    o.UncertaintyType.NORMAL_DISTRIBUTION: NORMAL,
+    o.UncertaintyType.UNIFORM_DISTRIBUTION: UNIFORM,
+    o.UncertaintyType.TRIANGLE_DISTRIBUTION: TRIANGLE
+}
+
+
+_NUMBER_FIELDS = (
+    ("geomMean", "geom_mean"), ("geomSd", "geom_sd"), ("mean", "mean"), ("sd", "sd"),
+    ("minimum", "minimum"), ("mode", "mode"), ("maximum", "maximum")
+)
+
+
+def _number(value) -> bool:
+    # from_dict no comprueba tipos: "1.2" o true llegan tal cual
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def check_uncertainty(uncertainty: o.Uncertainty, center: float) -> str | None:
+    # Devuelve el motivo por el que no se puede muestrear, o None. Los campos con un
+    # valor que no es un número se señalan antes que el resto de problemas
+    for name, field in _NUMBER_FIELDS:
+        value = getattr(uncertainty, field)
+        if value is not None and not _number(value):
+            return f"{name} must be a number, got {value!r}"
+    code = _CODES.get(uncertainty.distribution_type)
+    if code is None:
+        return "distributionType is required"
+    if code == LOG_NORMAL and not (_number(uncertainty.geom_sd) and uncertainty.geom_sd > 0):
+        return "LOG_NORMAL_DISTRIBUTION needs a number geomSd > 0"
+    if code == NORMAL and not (_number(uncertainty.sd) and uncertainty.sd >= 0):
+        return "NORMAL_DISTRIBUTION needs a number sd >= 0"
+    if code in (UNIFORM, TRIANGLE):
+        bounds = _number(uncertainty.minimum) and _number(uncertainty.maximum)
+        if not bounds or uncertainty.minimum > uncertainty.maximum:
+            return f"{uncertainty.distribution_type.value} needs minimum <= maximum"
+        if code == TRIANGLE and not uncertainty.minimum <= center <= uncertainty.maximum:
+            return f"TRIANGLE_DISTRIBUTION needs minimum <= {center} <= maximum"
+    return None
+
+
+class Distributions:
+    # Distribuciones de varias cantidades que se muestrean juntas. Se centran en center
+    # (media, media geométrica o moda, según el tipo); mínimo y máximo son absolutos
+    def __init__(self, uncertainties: list[o.Uncertainty], centers: list[float]):
+        for uncertainty, center in zip(uncertainties, centers):
+            error = check_uncertainty(uncertainty, center)
+            if error is not None:
+                raise ValueError(error)
+        self.codes = np.array([_CODES[u.distribution_type] for u in uncertainties], dtype=int)
+        self.centers = np.array(centers, dtype=float)
+        self.spread = np.array([
+            abs(math.log(u.geom_sd)) if u.distribution_type == o.UncertaintyType.LOG_NORMAL_DISTRIBUTION else (u.sd or 0.0)
+            for u in uncertainties
+        ])
+        self.minimum = np.array([u.minimum if u.minimum is not None else np.nan for u in uncertainties])
+        self.maximum = np.array([u.maximum if u.maximum is not None else np.nan for u in uncertainties])
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def sample(self, size: int, rng: np.random.Generator) -> np.ndarray:
+        # Una fila por cantidad y una columna por iteración
+        values = np.empty((len(self.codes), size))
+        for code in np.unique(self.codes):
+            rows = self.codes == code
+            center = self.centers[rows, None]
+            shape = (int(rows.sum()), size)
+            if code == LOG_NORMAL:
+                values[rows] = center * np.exp(self.spread[rows, None] * rng.standard_normal(shape))
+            elif code == NORMAL:
+                values[rows] = center + self.spread[rows, None] * rng.standard_normal(shape)
+            elif code == UNIFORM:
+                values[rows] = rng.uniform(self.minimum[rows, None], self.maximum[rows, None], shape)
+            else:
+                # Inversa de la función de distribución: admite mínimo == máximo
+                low, high = self.minimum[rows, None], self.maximum[rows, None]
+                u = rng.random(shape)
+                width = high - low
+                split = np.divide(center - low, width, out=np.zeros_like(width), where=width > 0)
+                values[rows] = np.where(
+                    u < split,
+                    low + np.sqrt(u * width * (center - low)),
+                    high - np.sqrt((1 - u) * width * (high - center))
+                )
+        return values
+
+
+class MonteCarloResult:
+    def __init__(self, totals: np.ndarray, stages: dict[str, np.ndarray], seed: int, exact_solves: int):
+        # totals: (categorías, iteraciones); stages: lo mismo por etapa de primer plano
+        self.totals = totals
+        self.stages = stages
+        self.seed = seed
+        self.exact_solves = exact_solves
+
+    @property
+    def iterations(self) -> int:
+        return self.totals.shape[1]
+
+
+class MonteCarloModel:
+    # A, B y C de un sistema de producto preparados para muestrear en bloques: cada bloque
+    # resuelve todas sus iteraciones a la vez con la factorización de A nominal.
+    # background: intercambios de fondo con incertidumbre como (matriz, fila, columna,
+    # peso en la celda, incertidumbre, cantidad); stages: columnas de los procesos de
+    # primer plano como (columna, celdas de exchange_rows, CompiledStage), que se
+    # reconstruyen en cada iteración a partir de los campos de VentumACVOutput. Con pool
+    # los bloques se reparten entre sus procesos
+    def __init__(
+        self,
+        matrices: LCAMatrices,
+        background: list[tuple[str, int, int, float, o.Uncertainty, float]],
+        stages: dict[str, tuple[int, list[tuple[str, int, float] | None], CompiledStage]] | None = None,
+        pool: "WorkerPool | None" = None
+    ):
+        self.matrices = matrices
+        self.impact_categories = matrices.impact_categories
+        self.stages = stages or {}
+        self.pool = pool
+        self.token = uuid.uuid4().hex
+
+        # Celdas de fondo: cada intercambio cambia su celda en peso·(factor - 1)
+        cells: dict[tuple[str, int, int], int] = {}
+        exchange_cells = [cells.setdefault((kind, i, j), len(cells)) for kind, i, j, *_ in background]
+        self.cell_kinds = np.array([kind == "B" for kind, _, _ in cells], dtype=bool)
+        self.cell_rows = np.array([i for _, i, _ in cells], dtype=int)
+        self.cell_cols = np.array([j for _, _, j in cells], dtype=int)
+        a, b = matrices.technosphere.tocsr(), matrices.interventions.tocsr()
+        self.cell_values = np.array([(b if kind == "B" else a)[i, j] for kind, i, j in cells], dtype=float)
+        self.weights = sp.csr_array(
+            ([w for _, _, _, w, _, _ in background], (exchange_cells, range(len(background)))),
+            shape=(len(cells), len(background))
+        )
+        self.distributions = Distributions([u for *_, u, _ in background], [amount for *_, amount in background])
+
+        # Por etapa y matriz: posiciones de los intercambios y filas y signos de sus celdas
+        self._columns: dict[str, dict[str, tuple[np.ndarray, np.ndarray, np.ndarray]]] = {}
+        for name, (j, rows, _) in self.stages.items():
+            self._columns[name] = {}
+            for kind in ("A", "B"):
+                cells = [(p, row[1], row[2]) for p, row in enumerate(rows) if row is not None and row[0] == kind]
+                self._columns[name][kind] = (
+                    np.array([p for p, _, _ in cells], dtype=int),
+                    np.array([i for _, i, _ in cells], dtype=int),
+                    np.array([sign for _, _, sign in cells], dtype=float)
+                )
+
+        self._payload: bytes | None = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        # Se envía a los procesos del pool sin el propio pool
+        state = self.__dict__.copy()
+        state["pool"] = None
+        state["_payload"] = None
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def payload(self) -> bytes:
+        # Serializado una sola vez aunque se envíe a varios procesos
+        with self._lock:
+            if self._payload is None:
+                self._payload = pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL)
+            return self._payload
+
+    def chunk_size(self) -> int:
+        n = len(self.matrices.tech_flows)
+        return int(max(1, min(MAX_CHUNK_SIZE, CHUNK_ELEMENTS // (n * (1 + len(self.stages))))))
+
+    def run(
+        self,
+        iterations: int,
+        seed: int | None = None,
+        amount: float = 1.0,
+        values: np.ndarray | None = None,
+        uncertainty: dict[int, o.Uncertainty] | None = None
+    ) -> MonteCarloResult:
+        # values: campos de VentumACVOutput (CompiledMapping.values); uncertainty: índice
+        # de campo -> distribución centrada en su valor. Con la misma semilla el resultado
+        # es el mismo, se reparta entre los procesos que se reparta
+        fields = None
+        if uncertainty:
+            indexes = sorted(uncertainty)
+            fields = (np.array(indexes), Distributions([uncertainty[i] for i in indexes], [values[i] for i in indexes]))
+
+        # Las columnas de primer plano de la petición cambian A mucho más que las
+        # incertidumbres: se factoriza una vez con ellas y se refina solo la desviación
+        base = self._centered(values) if self.stages else None
+
+        root = np.random.SeedSequence(seed)
+        size = self.chunk_size()
+        sizes = [min(size, iterations - start) for start in range(0, iterations, size)]
+        tasks = [(base, s, child, amount, values, fields) for s, child in zip(sizes, root.spawn(len(sizes)))]
+        if self.pool is not None and self.pool.workers > 1 and len(tasks) > 1:
+            chunks = self.pool.map(self, tasks)
+        else:
+            chunks = [self._chunk(*task) for task in tasks]
+
+        return MonteCarloResult(
+            totals=np.concatenate([c[0] for c in chunks], axis=1),
+            stages={name: np.concatenate([c[1][name] for c in chunks], axis=1) for name in self.stages},
+            seed=root.entropy,
+            exact_solves=sum(c[2] for c in chunks)
+        )
+
+    def _centered(self, values: np.ndarray) -> LCAMatrices:
+        (a_rows, a_cols, a_values), (b_rows, b_cols, b_values), _ = self._foreground(self.matrices, values[:, None])
+        shape_a, shape_b = self.matrices.technosphere.shape, self.matrices.interventions.shape
+        return LCAMatrices(
+            tech_flows=self.matrices.tech_flows,
+            envi_flows=self.matrices.envi_flows,
+            impact_categories=self.matrices.impact_categories,
+            technosphere=sp.csc_array(self.matrices.technosphere + sp.csc_array((a_values[:, 0], (a_rows, a_cols)), shape=shape_a)),
+            interventions=sp.csc_array(self.matrices.interventions + sp.csc_array((b_values[:, 0], (b_rows, b_cols)), shape=shape_b)),
+            characterization=self.matrices.characterization,
+            demand_index=self.matrices.demand_index
+        )
+
+    def _foreground(self, base: LCAMatrices, values: np.ndarray) -> tuple[tuple, tuple, dict[str, np.ndarray]]:
+        # Cambios en A y B al sustituir las columnas de las etapas de base por las que
+        # salen de values (campos × iteraciones), y la celda diagonal de cada etapa
+        size = values.shape[1]
+        a, b = ([], [], []), ([], [], [])
+        diagonals = {}
+        for name, (j, _, stage) in self.stages.items():
+            amounts = stage.amounts(values)
+            for target, kind, matrix in ((a, "A", base.technosphere), (b, "B", base.interventions)):
+                positions, rows, signs = self._columns[name][kind]
+                cells = signs[:, None] * amounts[positions]
+                current = matrix[:, [j]].tocoo()
+                target[0].extend([current.row, rows])
+                target[1].extend([np.full(len(current.row), j), np.full(len(rows), j)])
+                target[2].extend([np.repeat(-current.data[:, None], size, axis=1), cells])
+                if kind == "A":
+                    diagonals[name] = cells[rows == j].sum(axis=0)
+        return _triplets(a, size), _triplets(b, size), diagonals
+
+    def _chunk(
+        self,
+        base: LCAMatrices | None,
+        size: int,
+        seed: np.random.SeedSequence,
+        amount: float,
+        values: np.ndarray | None,
+        fields: tuple[np.ndarray, Distributions] | None
+    ) -> tuple[np.ndarray, dict[str, np.ndarray], int]:
+        base = base or self.matrices
+        rng = np.random.default_rng(seed)
+        parts = []
+
+        if len(self.distributions):
+            factors = self.distributions.sample(size, rng) / self.distributions.centers[:, None]
+            delta = self.cell_values[:, None] * (self.weights @ (factors - 1))
+            for kinds in (~self.cell_kinds, self.cell_kinds):
+                parts.append((self.cell_rows[kinds], self.cell_cols[kinds], delta[kinds]))
+        else:
+            parts.extend([_triplets(([], [], []), size)] * 2)
+
+        diagonals = {}
+        if self.stages:
+            sampled = np.repeat(values[:, None], size, axis=1)
+            if fields is not None:
+                sampled[fields[0]] = fields[1].sample(size, rng)
+            delta_a, delta_b, diagonals = self._foreground(base, sampled)
+            parts[0] = tuple(np.concatenate([p, q]) for p, q in zip(parts[0], delta_a))
+            parts[1] = tuple(np.concatenate([p, q]) for p, q in zip(parts[1], delta_b))
+
+        n = len(base.tech_flows)
+        columns = [base.demand_index] + [j for j, _, _ in self.stages.values()]
+        demand = np.zeros((n, len(columns)))
+        demand[:, 0] = base.demand(amount)
+        demand[columns[1:], range(1, len(columns))] = 1
+
+        x, exact = self._solve(base, parts[0], demand)
+        g = _apply(base.interventions, parts[1], x)
+        h = (base.characterization @ g.reshape(g.shape[0], -1)).reshape(-1, size, len(columns))
+
+        stages = {}
+        for r, (name, (j, _, _)) in enumerate(self.stages.items(), start=1):
+            # Impactos de la etapa con su cadena de suministro: s_j · A_jj por intensidad
+            stages[name] = h[:, :, r] * (x[j, :, 0] * diagonals[name])[None, :]
+        return h[:, :, 0], stages, exact
+
+    def _solve(self, base: LCAMatrices, delta: tuple[np.ndarray, np.ndarray, np.ndarray], demand: np.ndarray) -> tuple[np.ndarray, int]:
+        # Resuelve (A + ΔA_k)·X_k = F para todas las iteraciones k a la vez: refinamiento
+        # iterativo con la factorización de A; las que dejan de mejorar antes de llegar
+        # a TOLERANCE se factorizan por separado
+        rows, cols, values = delta
+        lu = base.lu()
+        n, r = demand.shape
+        size = values.shape[1]
+        x = np.repeat(lu.solve(demand)[:, None, :], size, axis=1)
+        if len(rows) == 0:
+            return x, 0
+
+        norm = np.linalg.norm(demand)
+        pending = np.ones(size, dtype=bool)
+        previous = np.full(size, np.inf)
+        for _ in range(MAX_REFINEMENTS):
+            residual = demand[:, None, :] - _apply(base.technosphere, delta, x)
+            error = np.sqrt((residual ** 2).sum(axis=(0, 2))) / norm
+            pending = ~(error <= TOLERANCE)
+            refine = pending & (error < previous)
+            if not refine.any():
+                break
+            previous = np.where(refine, error, 0.0)
+            x[:, refine] += lu.solve(residual[:, refine].reshape(n, -1)).reshape(n, -1, r)
+
+        exact = np.flatnonzero(pending)
+        for k in exact:
+            a = base.technosphere + sp.csc_array((values[:, k], (rows, cols)), shape=(n, n))
+            x[:, k] = splu(sp.csc_matrix(a)).solve(demand)
+        return x, len(exact)
+
+
+def _triplets(parts: tuple[list, list, list], size: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    if not parts[0]:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros((0, size))
+    return np.concatenate(parts[0]).astype(int), np.concatenate(parts[1]).astype(int), np.vstack(parts[2])
+
+
+def _apply(matrix: sp.sparray, delta: tuple[np.ndarray, np.ndarray, np.ndarray], x: np.ndarray) -> np.ndarray:
+    # (M + ΔM_k)·X_k para cada iteración k; x: (columnas de M, iteraciones, lados derechos)
+    rows, cols, values = delta
+    n, size, r = x.shape
+    y = (matrix @ x.reshape(n, -1)).reshape(matrix.shape[0], size, r)
+    if len(rows):
+        scatter = sp.csr_array((np.ones(len(rows)), (rows, np.arange(len(rows)))), shape=(matrix.shape[0], len(rows)))
+        y += (scatter @ (values[:, :, None] * x[cols]).reshape(len(rows), -1)).reshape(-1, size, r)
+    return y
+
+
+class WorkerPool:
+    # Un único pool de procesos para todos los modelos. Cada proceso guarda los últimos
+    # models modelos que ha recibido: los bloques llevan solo el identificador del modelo
+    # y se reenvían con el modelo a los procesos que aún no lo tienen
+    def __init__(self, workers: int, models: int = 8):
+        self.workers = workers
+        self.models = models
+        self._executor: ProcessPoolExecutor | None = None
+        self._lock = threading.Lock()
+
+    def map(self, model: MonteCarloModel, tasks: list[tuple]) -> list[tuple[np.ndarray, dict[str, np.ndarray], int]]:
+        executor = self._pool()
+        futures = [executor.submit(_run_chunk, model.token, None, task, self.models) for task in tasks]
+        chunks = [f.result() for f in futures]
+        missing = [k for k, chunk in enumerate(chunks) if chunk is None]
+        if missing:
+            payload = model.payload()
+            futures = {k: executor.submit(_run_chunk, model.token, payload, tasks[k], self.models) for k in missing}
+            for k, f in futures.items():
+                chunks[k] = f.result()
+        return chunks
+
+    def close(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # spawn y no fork: el proceso de la API tiene hilos
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+
+_worker_models: OrderedDict[str, MonteCarloModel] = OrderedDict()
+
+
+def _run_chunk(
+    token: str,
+    payload: bytes | None,
+    task: tuple,
+    capacity: int
+) -> tuple[np.ndarray, dict[str, np.ndarray], int] | None:
+    # None si este proceso no tiene el modelo y no se ha enviado
+    model = _worker_models.get(token)
+    if model is None:
+        if payload is None:
+            return None
+        model = _worker_models[token] = pickle.loads(payload)
+        while len(_worker_models) > capacity:
+            _worker_models.popitem(last=False)
+    _worker_models.move_to_end(token)
+    return model._chunk(*task)
+
+
+def background_uncertainties(
+    client: OLCAClient,
+    matrices: LCAMatrices,
+    exclude: set[str] = frozenset(),
+    workers: int = 8
+) -> list[tuple[str, int, int, float, o.Uncertainty, float]]:
+    # Descarga los procesos del sistema y devuelve sus intercambios con incertidumbre,
+    # con el peso de cada uno en su celda de A o B (varias entradas del mismo flujo
+    # comparten celda). Las distribuciones que no se pueden muestrear se ignoran
+    uids = sorted({tf.provider.id for tf in matrices.tech_flows} - set(exclude))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        processes = list(pool.map(in_context(lambda uid: client.get_process(uid=uid)), uids))
+
+    uncertain, skipped = [], 0
+    for process in processes:
+        if process is None or not process.exchanges:
+            continue
+        try:
+            j, rows = exchange_rows(matrices, process)
+        except (KeyError, StopIteration):
+            continue
+        totals: dict[tuple[str, int], float] = {}
+        items = []
+        for e, row in zip(process.exchanges, rows):
+            if row is None or not e.amount:
+                continue
+            kind, i, sign = row
+            totals[(kind, i)] = totals.get((kind, i), 0.0) + sign * e.amount
+            if e.uncertainty is not None and e.uncertainty.distribution_type is not None:
+                if check_uncertainty(e.uncertainty, e.amount) is not None:
+                    skipped += 1
+                    continue
+                items.append((kind, i, sign * e.amount, e.uncertainty, e.amount))
+        for kind, i, signed, uncertainty, amount in items:
+            total = totals[(kind, i)]
+            if total != 0:
+                uncertain.append((kind, i, j, signed / total, uncertainty, amount))
+    if skipped:
+        log.warning("%i exchange uncertainties cannot be sampled and were ignored", skipped)
+    return uncertain
+
+
+def build_ventum_model(
+    client: OLCAClient,
+    matrices: LCAMatrices,
+    mapping: CompiledMapping,
+    background: bool = True,
+    pool: WorkerPool | None = None
+) -> MonteCarloModel:
+    # Las columnas de las etapas se reconstruyen con el mapeo compilado en cada iteración
+    stages, processes = {}, []
+    for name, stage in mapping.stages.items():
+        process = client.get_process(name=name)
+        j, rows = exchange_rows(matrices, process)
+        if len(rows) != len(stage.exchanges):
+            raise ValueError(f"process {name!r} changed since the mapping was compiled")
+        stages[name] = (j, rows, stage)
+        processes.append(process.id)
+    uncertain = background_uncertainties(client, matrices, exclude=set(processes)) if background else []
+    return MonteCarloModel(matrices, uncertain, stages, pool)
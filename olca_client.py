@@ -1,9 +1,143 @@
+import hashlib
 import olca_ipc as ipc
 import olca_schema as o
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
 
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Callable, Iterator, Type
+
+from descriptor_index import DescriptorIndex
+from ipc_pool import IPCPool
+from metrics import in_context, instrument
+from product_system_pool import DEFAULT_LINKING, ProductSystemPool
+from result_manager import ManagedResult, ResultManager
+
+# Unidad -> (propiedad de flujo, grupo de unidades) para las etiquetas "nombre [unidad]"
+UNIT_PROPERTIES = {
+    "kg": ("Mass", "Mass units"),
+    "MJ": ("Energy", "Energy units"),
+    "Item(s)": ("Number of items", "Counting units")
+}
+
+def _parse_labels(labels: pd.Index) -> tuple[np.ndarray, np.ndarray]:
+    parts = labels.str.extract(r"^\s*(.*?)\s*\[(.*?)\]\s*$")
+    return parts[0].to_numpy(), parts[1].to_numpy()
+
+def _to_csc(df: pd.DataFrame) -> sp.csc_array:
+    # Solo se guardan las celdas distintas de cero, tanto si el DataFrame es denso como disperso
+    if all(isinstance(t, pd.SparseDtype) for t in df.dtypes):
+        matrix = sp.csc_array(df.sparse.to_coo())
+    else:
+        matrix = sp.csc_array(df.to_numpy(dtype=float))
+    matrix.eliminate_zeros()
+    return matrix
+
+@instrument
 class OLCAClient:
-    def __init__(self, port=3000):
-        self.client = ipc.Client(port)
+    def __init__(
+        self,
+        port=3000,
+        product_system_pool_size: int = 32,
+        endpoints: list[int | str] | None = None,
+        max_results: int = 64,
+        result_ttl: float = 300
+    ):
+        # Con varios endpoints las llamadas se reparten entre réplicas del servidor IPC
+        self.client = IPCPool(endpoints or [port])
+        # Resultados abiertos en los servidores IPC: como mucho max_results a la vez
+        self.results = ResultManager(max_live=max_results, ttl=result_ttl)
+        # Se incrementa con cada escritura para que las cachés sepan cuándo recalcular
+        self.revision = 0
+        # Los nombres de flujos, propiedades y procesos se resuelven en memoria
+        self.index = DescriptorIndex(self.client, (o.FlowProperty, o.Flow, o.Process))
+        self.listeners: list[Callable[[o.RootEntity | o.Ref], None]] = []
+        self.product_systems = ProductSystemPool(self, capacity=product_system_pool_size)
+        self.on_change(self.product_systems.invalidate)
+
+    # Writes
+    def on_change(self, listener: Callable[[o.RootEntity | o.Ref], None]) -> None:
+        # Se llama con la entidad (o la referencia borrada) tras cada put/delete
+        self.listeners.append(listener)
+
+    def _changed(self, model: o.RootEntity | o.Ref) -> None:
+        for listener in self.listeners:
+            listener(model)
+
+    def put(self, model: o.RootEntity) -> o.Ref:
+        # Como la aplicación de escritorio al guardar: last_change delata la edición a
+        # otros workers y a las huellas guardadas en disco (fingerprint)
+        model.last_change = datetime.now(timezone.utc).isoformat()
+        ref = self.client.put(model)
+        self.revision += 1
+        self.index.put(model)
+        self._changed(model)
+        return ref
+
+    def delete(self, model: o.RootEntity | o.Ref) -> o.Ref:
+        ref = self.client.delete(model)
+        self.revision += 1
+        self.index.delete(model)
+        self._changed(model)
+        return ref
+
+    def fingerprint(self, refs: list[o.Ref], workers: int = 8) -> str:
+        # Huella de version y last_change de las entidades: cambia con cualquier edición
+        # guardada, aunque la haga otro proceso, y si alguna se borra
+        def stamp(ref: o.Ref) -> str:
+            entity = self.client.get(getattr(o, ref.ref_type.value), ref.id)
+            return f"{ref.id}:{entity.version}:{entity.last_change}" if entity else f"{ref.id}:-"
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            stamps = list(pool.map(in_context(stamp), refs))
+        return hashlib.sha256("\n".join(stamps).encode()).hexdigest()
+
+    def put_all(self, models: list[o.RootEntity], workers: int = 4, batch_size: int = 100) -> None:
+        # Los lotes se envían en paralelo; IPCPool usa una conexión por hilo. El servidor
+        # rechaza una entidad devolviendo None: se avisa a las cachés de las guardadas y
+        # después se falla con las rechazadas
+        def put_batch(batch: list[o.RootEntity]) -> list[o.RootEntity]:
+            failed = []
+            for model in batch:
+                model.last_change = datetime.now(timezone.utc).isoformat()
+                if self.client.put(model) is None:
+                    failed.append(model)
+            return failed
+
+        batches = [models[i:i + batch_size] for i in range(0, len(models), batch_size)]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            failed = [model for batch in pool.map(in_context(put_batch), batches) for model in batch]
+
+        rejected = {id(model) for model in failed}
+        self.revision += 1
+        for model in models:
+            if id(model) not in rejected:
+                self.index.put(model)
+                self._changed(model)
+        if failed:
+            names = [f"{type(m).__name__} {m.name or m.id}" for m in failed[:10]]
+            raise RuntimeError(f"{len(failed)} of {len(models)} entities were not saved: {names}")
+
+    # Descriptors
+    def find(self, model_type: Type[o.RootEntity], name: str | None = None, uid: str | None = None) -> o.Ref | None:
+        if self.index.indexes(model_type):
+            return self.index.get(model_type, uid=uid, name=name)
+        return self.client.get_descriptor(model_type, uid=uid, name=name)
+
+    def iter_descriptors(
+        self,
+        model_type: Type[o.RootEntity],
+        after: tuple[str, str] | None = None,
+        flow_type: o.FlowType | None = None,
+        category: str | None = None,
+        name_prefix: str | None = None
+    ) -> Iterator[o.Ref]:
+        return self.index.iter(model_type, after=after, flow_type=flow_type, category=category, name_prefix=name_prefix)
+
+    def refresh_index(self, model_type: Type[o.RootEntity] | None = None) -> None:
+        self.index.refresh(model_type)
     
     # Group unit
     def get_all_unit_groups(self) -> list[o.UnitGroup]:
@@ -14,7 +148,7 @@ class OLCAClient:
 
     def add_unit_group(self, name: str, ref_unit: str) -> o.UnitGroup:
         unit_group = o.new_unit_group(name, ref_unit)
-        self.client.put(unit_group)
+        self.put(unit_group)
         return unit_group
     
     # Flow property
@@ -29,7 +163,7 @@ class OLCAClient:
             unit_group = self.get_unit_group(unit_group)
 
         flow_property = o.new_flow_property(name, unit_group)
-        self.client.put(flow_property)
+        self.put(flow_property)
         return flow_property
     
     # Flow
@@ -44,9 +178,9 @@ class OLCAClient:
         return [f for f in self.get_all_flows() if f.flow_type == o.FlowType.PRODUCT_FLOW]
 
     def add_product_flow(self, name: str, flow_property_name: str) -> o.Flow:
-        flow_property = self.get_flow_property(flow_property_name)
+        flow_property = self.find(o.FlowProperty, name=flow_property_name)
         product_flow = o.new_product(name, flow_property)
-        self.client.put(product_flow)
+        self.put(product_flow)
         return product_flow
 
     # Elementary flow
@@ -54,9 +188,9 @@ class OLCAClient:
         return [f for f in self.get_all_flows() if f.flow_type == o.FlowType.ELEMENTARY_FLOW]
 
     def add_elementary_flow(self, name: str, flow_property_name: str) -> o.Flow:
-        flow_property = self.get_flow_property(flow_property_name)
+        flow_property = self.find(o.FlowProperty, name=flow_property_name)
         elementary_flow = o.new_elementary_flow(name, flow_property)
-        self.client.put(elementary_flow)
+        self.put(elementary_flow)
         return elementary_flow
 
     # Waste flow
@@ -64,9 +198,9 @@ class OLCAClient:
         return [f for f in self.get_all_flows() if f.flow_type == o.FlowType.WASTE_FLOW]
 
     def add_waste_flow(self, name: str, flow_property_name: str) -> o.Flow:
-        flow_property = self.get_flow_property(flow_property_name)
+        flow_property = self.find(o.FlowProperty, name=flow_property_name)
         waste_flow = o.new_waste(name, flow_property)
-        self.client.put(waste_flow)
+        self.put(waste_flow)
         return waste_flow
     
     # Process
@@ -102,78 +236,222 @@ class OLCAClient:
         
         if product_exchanges:
             for flow_name, amount in product_exchanges.items():
-                flow = self.get_flow(flow_name)
+                flow = self.find(o.Flow, name=flow_name)
                 add_exchange(flow, amount, is_product_exchange=True)
         
         if elementary_exchanges:
             for flow_name, amount in elementary_exchanges.items():
-                flow = self.get_flow(flow_name)
+                flow = self.find(o.Flow, name=flow_name)
                 add_exchange(flow, amount, is_product_exchange=False)
 
         if waste_exchanges:
             for flow_name, amount in waste_exchanges.items():
-                flow = self.get_flow(flow_name)
+                flow = self.find(o.Flow, name=flow_name)
                 add_exchange(flow, amount, is_product_exchange=True) # Un waste exchange puede ser referencia cuantitativa
         
-        self.client.put(process)
+        self.put(process)
         return process
     
     def update_process(self, process: o.Process) -> None:
-        self.client.put(process)
+        self.put(process)
+
+    def parameterize_process(self, process: o.Process | str, parameter_name: Callable[[o.Exchange], str]) -> o.Process:
+        # Migración: cada cantidad fija pasa a ser un parámetro de proceso con el mismo
+        # valor, para poder redefinirla por cálculo sin modificar el proceso. La
+        # referencia cuantitativa y las cantidades que ya tienen fórmula no se tocan
+        if isinstance(process, str):
+            process = self.get_process(name=process)
+
+        parameters = {p.name: p for p in process.parameters or []}
+        for exchange in process.exchanges:
+            if exchange.is_quantitative_reference or exchange.amount_formula:
+                continue
+            name = parameter_name(exchange)
+            if name not in parameters:
+                parameters[name] = o.new_parameter(name, exchange.amount, o.ParameterScope.PROCESS_SCOPE)
+            exchange.amount_formula = name
+
+        process.parameters = list(parameters.values())
+        self.put(process)
+        return process
     
+    # Bulk loading
+    def add_matrices(
+        self,
+        technosphere: pd.DataFrame,
+        interventions: pd.DataFrame,
+        unit_properties: dict[str, tuple[str, str]] = UNIT_PROPERTIES,
+        workers: int = 4
+    ) -> list[o.Process]:
+        # Filas "nombre [unidad]": productos en la tecnosfera y flujos elementales en las
+        # intervenciones. Columnas: procesos, con la diagonal como referencia cuantitativa
+        product_names, product_units = _parse_labels(technosphere.index)
+        elementary_names, elementary_units = _parse_labels(interventions.index)
+
+        labels = np.concatenate([technosphere.index.to_numpy(), interventions.index.to_numpy()])
+        units = np.concatenate([product_units, elementary_units])
+        bad = [str(label) for label, unit in zip(labels, units) if not isinstance(unit, str) or unit not in unit_properties]
+        if bad:
+            raise ValueError(
+                f"labels must be \"name [unit]\" with a unit in {sorted(unit_properties)}: {bad[:20]}"
+                + (f" and {len(bad) - 20} more" if len(bad) > 20 else "")
+            )
+
+        unit_groups, flow_properties, properties = [], [], {}
+        for unit in pd.unique(units):
+            property_name, unit_group_name = unit_properties[unit]
+            flow_property = self.find(o.FlowProperty, name=property_name)
+            if flow_property is None:
+                unit_group = o.new_unit_group(unit_group_name, unit)
+                flow_property = o.new_flow_property(property_name, unit_group)
+                unit_groups.append(unit_group)
+                flow_properties.append(flow_property)
+            properties[unit] = flow_property
+        self.put_all(unit_groups, workers)
+        self.put_all(flow_properties, workers)
+
+        new_flows = []
+        def resolve_flows(names: np.ndarray, units: np.ndarray, new_flow: Callable) -> list[o.Ref | o.Flow]:
+            flows = []
+            for name, unit in zip(names, units):
+                flow = self.find(o.Flow, name=name)
+                if flow is None:
+                    flow = new_flow(name, properties[unit])
+                    new_flows.append(flow)
+                flows.append(flow)
+            return flows
+
+        product_flows = resolve_flows(product_names, product_units, o.new_product)
+        elementary_flows = resolve_flows(elementary_names, elementary_units, o.new_elementary_flow)
+        self.put_all(new_flows, workers)
+
+        technosphere_matrix = _to_csc(technosphere)
+        interventions_matrix = _to_csc(interventions)
+
+        def add_column(process: o.Process, matrix: sp.csc_array, j: int, flows: list, reference: int | None) -> None:
+            start, end = matrix.indptr[j], matrix.indptr[j + 1]
+            for i, value in zip(matrix.indices[start:end], matrix.data[start:end]):
+                if value < 0:
+                    exchange = o.new_input(process, flows[i], float(-value))
+                else:
+                    exchange = o.new_output(process, flows[i], float(value))
+                if i == reference:
+                    exchange.is_quantitative_reference = True
+
+        processes = []
+        for j, name in enumerate(technosphere.columns):
+            process = o.new_process(name)
+            add_column(process, technosphere_matrix, j, product_flows, reference=j)
+            add_column(process, interventions_matrix, j, elementary_flows, reference=None)
+            processes.append(process)
+        self.put_all(processes, workers)
+        return processes
+
     # Product system
 
-    def add_product_system(self, process_uid: str) -> o.Ref:
+    def add_product_system(self, process_uid: str, config: o.LinkingConfig = DEFAULT_LINKING) -> o.Ref:
         process = self.get_process(uid=process_uid)
-        config = o.LinkingConfig(
-            prefer_unit_processes=True,
-            provider_linking=o.ProviderLinking.PREFER_DEFAULTS
-        )
-
         return self.client.create_product_system(process=process, config=config)
     
     def get_product_system(self, uid: str | None = None, name: str | None = None) -> o.ProductSystem:
         return self.client.get(o.ProductSystem, uid=uid, name=name)
     
     def remove_product_system(self, uid: str) -> None:
+        # Borrar un sistema de producto no modifica procesos ni flujos, no cuenta como revisión
         self.client.delete(o.Ref(ref_type=o.RefType.ProductSystem, id=uid))
     
     # Impact assesment methods
 
     def get_impact_method(self, uid: str) -> o.ImpactMethod:
         return self.client.get(o.ImpactMethod, uid=uid)
+
+    def get_impact_category(self, uid: str) -> o.ImpactCategory:
+        return self.client.get(o.ImpactCategory, uid=uid)
     
     # Calculations
-    def calculate_process_impact(self, process_uid: str, impact_method_uid: str, amount: int) -> ipc.Result:
-        product_system = self.add_product_system(process_uid=process_uid)
+    def calculate_process_impact(self, process_uid: str, impact_method_uid: str | None, amount: int) -> ManagedResult:
+        # El sistema enlazado se reutiliza entre peticiones del mismo proceso. Sin
+        # método de impacto solo se calcula el inventario
+        with self.product_systems.lease(process_uid) as product_system:
+            setup = o.CalculationSetup(
+                target=o.Ref(
+                    ref_type=o.RefType.ProductSystem,
+                    id=product_system.id
+                ),
+                impact_method=o.Ref(id=impact_method_uid) if impact_method_uid else None,
+                amount=amount
+            )
 
+            return self._calculate(setup)
+    
+    def calculate_product_system_impact(
+        self,
+        product_system_uid: str,
+        impact_method_uid: str | None,
+        amount: int,
+        parameters: list[o.ParameterRedef] | None = None
+    ) -> ManagedResult:
         setup = o.CalculationSetup(
             target=o.Ref(
                 ref_type=o.RefType.ProductSystem,
-                id=product_system.id
+                id=product_system_uid
             ),
-            impact_method=o.Ref(id=impact_method_uid),
-            amount=amount
+            impact_method=o.Ref(id=impact_method_uid) if impact_method_uid else None,
+            amount=amount,
+            parameters=parameters
         )
 
-        result = self.client.calculate(setup)
-        result.wait_until_ready()
-        #result.dispose()
-        self.remove_product_system(product_system.id)
+        return self._calculate(setup)
+
+    def _calculate(self, setup: o.CalculationSetup) -> ManagedResult:
+        result = self.results.open(self.client.calculate, setup)
+        try:
+            result.wait_until_ready()
+        except BaseException:
+            result.dispose()
+            raise
         return result
-    
-    def calculate_product_system_impact(self, product_system_uid: str, impact_method_uid: str, amount: int) -> ipc.Result:
-        product_system = self.get_product_system(uid=product_system_uid)
 
-        setup = o.CalculationSetup(
-            target=o.Ref(
-                ref_type=o.RefType.ProductSystem,
-                id=product_system.id
-            ),
-            impact_method=o.Ref(id=impact_method_uid),
-            amount=amount
-        )
+    # Contributions
+    def get_stage_contributions(self, result: ipc.Result, stages: list[str], workers: int = 4) -> "StageContributions":
+        # Las etapas (nombre o UUID del flujo o del proceso) se resuelven con un único
+        # get_tech_flows; después, el total y las contribuciones de todas las etapas se
+        # piden a la vez, cada hilo con su propia conexión a la réplica del resultado
+        tech_flows: dict[str, o.TechFlow] = {}
+        for tf in result.get_tech_flows():
+            for key in (tf.flow.name, tf.flow.id, tf.provider.name, tf.provider.id):
+                tech_flows.setdefault(key, tf)
+        missing = [stage for stage in stages if stage not in tech_flows]
+        if missing:
+            raise KeyError(f"stages not found in result: {missing}")
+        targets = [tech_flows[stage] for stage in stages]
 
-        result = self.client.calculate(setup)
-        result.wait_until_ready()
-        return result
+        def fetch(target: o.TechFlow | None) -> list[o.ImpactValue]:
+            if target is None:
+                return result.get_total_impacts()
+            return result.get_total_impacts_of(tech_flow=target)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            values = list(pool.map(in_context(fetch), [None] + targets))
+
+        impact_categories = [v.impact_category for v in values[0]]
+        column = {c.id: i for i, c in enumerate(impact_categories)}
+        amounts = np.zeros((len(values), len(impact_categories)))
+        for row, impacts in enumerate(values):
+            for v in impacts:
+                amounts[row, column[v.impact_category.id]] = v.amount
+
+        return StageContributions(impact_categories, stages, amounts[1:], amounts[0])
+
+
+class StageContributions:
+    # Una fila por etapa y una columna por categoría de impacto, con metadatos comunes
+    def __init__(self, impact_categories: list[o.Ref], stages: list[str], amounts: np.ndarray, total: np.ndarray):
+        self.impact_categories = impact_categories
+        self.stages = stages
+        self.amounts = amounts
+        self.total = total
+        self._rows = {stage: i for i, stage in enumerate(stages)}
+
+    def of(self, stage: str) -> np.ndarray:
+        return self.amounts[self._rows[stage]]
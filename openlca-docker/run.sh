@@ -1,2 +1,31 @@
 #!/bin/bash
-java -Xmx4096M -cp "/app/lib/*" org.openlca.ipc.Server -timeout 30 -data /app/data "$@"
\ No newline at end of file
+set -e
+# run.sh seed: copia /app/data en /app/seed/current para las réplicas. Derby solo deja
+# los ficheros coherentes con la base de datos cerrada, así que el servidor principal
+# tiene que estar parado (sin db.lck)
+if [ "$1" = "seed" ]; then
+    if compgen -G "/app/data/databases/*/db.lck" > /dev/null; then
+        echo "database is open (db.lck found): stop the primary server before seeding" >&2
+        exit 1
+    fi
+    rm -rf /app/seed/.partial
+    mkdir -p /app/seed/.partial
+    cp -r /app/data/. /app/seed/.partial/
+    rm -rf /app/seed/current
+    mv /app/seed/.partial /app/seed/current
+    exit 0
+fi
+
+# Las réplicas copian la semilla la primera vez que arrancan; .seeded marca una copia
+# completa, una interrumpida se repite
+if [ -n "$OLCA_SEED_DATA" ] && [ ! -f /app/data/.seeded ]; then
+    if [ ! -d "$OLCA_SEED_DATA/databases" ]; then
+        echo "no seed in $OLCA_SEED_DATA: run the openlca-seed service first" >&2
+        exit 1
+    fi
+    rm -rf /app/data/databases
+    mkdir -p /app/data
+    cp -r "$OLCA_SEED_DATA"/. /app/data/
+    touch /app/data/.seeded
+fi
+exec java -Xmx${OLCA_HEAP:-4096M} -cp "/app/lib/*" org.openlca.ipc.Server -timeout 30 -data /app/data "$@"
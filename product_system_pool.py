@@ -0,0 +1,135 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator
+
+import olca_schema as o
+
+DEFAULT_LINKING = o.LinkingConfig(
+    prefer_unit_processes=True,
+    provider_linking=o.ProviderLinking.PREFER_DEFAULTS
+)
+
+
+def linking_key(config: o.LinkingConfig) -> tuple:
+    return (
+        config.prefer_unit_processes,
+        config.provider_linking.value if config.provider_linking else None,
+        config.cutoff
+    )
+
+
+class PooledSystem:
+    def __init__(self, ref: o.Ref, processes: set[str]):
+        self.ref = ref
+        self.processes = processes
+        self.leases = 0
+        self.evicted = False
+
+
+class ProductSystemPool:
+    # Sistemas de producto ya enlazados por (proceso, LinkingConfig), en un LRU acotado.
+    # Al expulsar una entrada se borra su sistema de la base de datos, esperando a
+    # que terminen los cálculos que lo estén usando
+    def __init__(self, client, capacity: int = 32):
+        self.client = client
+        self.capacity = capacity
+        self._entries: OrderedDict[tuple, PooledSystem] = OrderedDict()
+        self._creating: dict[tuple, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @contextmanager
+    def lease(self, process_uid: str, config: o.LinkingConfig = DEFAULT_LINKING) -> Iterator[o.Ref]:
+        entry = self._acquire(process_uid, config)
+        try:
+            yield entry.ref
+        finally:
+            self._release(entry)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+    def invalidate(self, model: o.RootEntity | o.Ref) -> None:
+        # Listener de OLCAClient: un cambio en un proceso expulsa los sistemas que lo contienen
+        if isinstance(model, o.Ref):
+            if model.ref_type not in (None, o.RefType.Process):
+                return
+        elif not isinstance(model, o.Process):
+            return
+        with self._lock:
+            keys = [k for k, e in self._entries.items() if model.id in e.processes]
+            removed = [self._pop(k) for k in keys]
+        self._dispose(removed)
+
+    def clear(self) -> None:
+        with self._lock:
+            removed = [self._pop(k) for k in list(self._entries)]
+        self._dispose(removed)
+
+    def _acquire(self, process_uid: str, config: o.LinkingConfig) -> PooledSystem:
+        key = (process_uid, linking_key(config))
+        with self._lock:
+            entry = self._get(key)
+            if entry is not None:
+                return entry
+            creating = self._creating.setdefault(key, threading.Lock())
+
+        # Un único enlazado por clave aunque lleguen varias peticiones a la vez
+        with creating:
+            with self._lock:
+                entry = self._get(key)
+                if entry is not None:
+                    return entry
+                self.misses += 1
+
+            ref = self.client.add_product_system(process_uid=process_uid, config=config)
+            product_system = self.client.get_product_system(uid=ref.id)
+            processes = {p.id for p in product_system.processes or []}
+            entry = PooledSystem(ref, processes | {process_uid})
+            entry.leases += 1
+
+            with self._lock:
+                self._entries[key] = entry
+                self._creating.pop(key, None)
+                removed = []
+                while len(self._entries) > self.capacity:
+                    removed.append(self._pop(next(iter(self._entries))))
+        self._dispose(removed)
+        return entry
+
+    def _get(self, key: tuple) -> PooledSystem | None:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            entry.leases += 1
+            self.hits += 1
+        return entry
+
+    def _pop(self, key: tuple) -> PooledSystem:
+        entry = self._entries.pop(key)
+        entry.evicted = True
+        self.evictions += 1
+        return entry
+
+    def _release(self, entry: PooledSystem) -> None:
+        with self._lock:
+            entry.leases -= 1
+        self._dispose([entry])
+
+    def _dispose(self, entries: list[PooledSystem]) -> None:
+        for entry in entries:
+            with self._lock:
+                if not entry.evicted or entry.leases > 0 or entry.ref is None:
+                    continue
+                ref, entry.ref = entry.ref, None
+            self.client.remove_product_system(ref.id)
@@ -0,0 +1,134 @@
+import logging as log
+import threading
+import time
+import weakref
+from typing import Any, Callable
+
+import olca_ipc as ipc
+
+from metrics import REGISTRY
+
+
+class TooManyResults(Exception):
+    pass
+
+
+class _Lease:
+    def __init__(self, result: ipc.Result, expires: float):
+        self.result = result
+        self.expires = expires
+        self.disposed = False
+        self.reason: str | None = None
+
+
+class ManagedResult:
+    # ipc.Result con fecha de caducidad. Se usa como context manager; si se olvida el
+    # dispose, el resultado se libera al caducar o cuando el objeto deja de usarse
+    def __init__(self, manager: "ResultManager", lease: _Lease):
+        self._manager = manager
+        self._lease = lease
+        self.uid = lease.result.uid
+        self.error = lease.result.error
+        weakref.finalize(self, manager._release, lease, "abandoned").atexit = False
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if self._lease.disposed:
+            raise RuntimeError(f"result {self.uid} was {self._lease.reason}")
+        return getattr(self._lease.result, name)
+
+    def __enter__(self) -> "ManagedResult":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.dispose()
+
+    def renew(self, ttl: float | None = None) -> None:
+        self._lease.expires = time.time() + (ttl if ttl is not None else self._manager.ttl)
+
+    def dispose(self) -> None:
+        self._manager._release(self._lease, "disposed")
+
+
+class ResultManager:
+    # Limita los resultados vivos en los servidores IPC a max_live: open espera hasta
+    # wait segundos a que se libere uno y si no lanza TooManyResults. Un hilo libera
+    # los resultados cuyo plazo (ttl) ha vencido sin llegar a hacer dispose
+    def __init__(self, max_live: int = 64, ttl: float = 300, wait: float = 30, reap_interval: float = 10):
+        self.max_live = max_live
+        self.ttl = ttl
+        self.wait = wait
+        self._slots = threading.BoundedSemaphore(max_live)
+        self._leases: set[_Lease] = set()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.disposed = 0
+        self.expired = 0
+        self.abandoned = 0
+        self.rejected = 0
+        threading.Thread(target=self._reap_loop, args=(reap_interval,), name="result-reaper", daemon=True).start()
+        REGISTRY.gauge("olca_results_live", "Calculation results open on the openLCA IPC servers", (), lambda: {(): len(self._leases)})
+
+    def open(self, calculate: Callable[..., ipc.Result], *args, ttl: float | None = None) -> ManagedResult:
+        if not self._slots.acquire(timeout=self.wait):
+            with self._lock:
+                self.rejected += 1
+            raise TooManyResults(f"{self.max_live} calculation results are already open")
+        try:
+            result = calculate(*args)
+        except BaseException:
+            self._slots.release()
+            raise
+        lease = _Lease(result, time.time() + (ttl if ttl is not None else self.ttl))
+        with self._lock:
+            self._leases.add(lease)
+            self.created += 1
+        return ManagedResult(self, lease)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "live": len(self._leases),
+                "max_live": self.max_live,
+                "created": self.created,
+                "disposed": self.disposed,
+                "leaked": self.expired + self.abandoned,
+                "expired": self.expired,
+                "abandoned": self.abandoned,
+                "rejected": self.rejected
+            }
+
+    def reap(self) -> None:
+        now = time.time()
+        with self._lock:
+            expired = [lease for lease in self._leases if lease.expires <= now]
+        for lease in expired:
+            self._release(lease, "expired")
+
+    def _reap_loop(self, interval: float) -> None:
+        while True:
+            time.sleep(interval)
+            self.reap()
+
+    def _release(self, lease: _Lease, reason: str) -> None:
+        with self._lock:
+            if lease.disposed:
+                return
+            lease.disposed = True
+            lease.reason = reason
+            self._leases.discard(lease)
+            setattr(self, reason, getattr(self, reason) + 1)
+        if reason != "disposed":
+            log.warning("calculation result %s %s without dispose", lease.result.uid, reason)
+        try:
+            # Un resultado con error no hace dispose por sí mismo; si llegó a tener
+            # identificador se libera igualmente para que el pool lo olvide
+            if lease.result.error is None:
+                lease.result.dispose()
+            elif lease.result.uid:
+                lease.result.client.rpc_call("result/dispose", {"@id": lease.result.uid})
+        except Exception:
+            log.exception("failed to dispose calculation result %s", lease.result.uid)
+        finally:
+            self._slots.release()
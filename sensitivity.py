@@ -0,0 +1,57 @@
+import numpy as np
+import olca_schema as o
+
+from background_vectors import BackgroundVectors
+from ventum_flows import CompiledMapping
+
+
+class VentumJacobian:
+    # Derivadas de los impactos de cada etapa respecto a los campos de VentumACVOutput
+    # del mapeo: una matriz (categorías × campos) por etapa. Las etapas son lineales en
+    # las cantidades de sus intercambios y estas en los campos, así que el jacobiano no
+    # depende de la parcela y vale mientras no cambie la revisión
+    def __init__(
+        self,
+        revision: int,
+        impact_categories: list[o.Ref],
+        fields: list[str],
+        stages: dict[str, np.ndarray]
+    ):
+        self.revision = revision
+        self.impact_categories = impact_categories
+        self.fields = fields
+        self.stages = stages
+        self.total = sum(stages.values())
+
+    def sweep(
+        self,
+        columns: np.ndarray,
+        delta: np.ndarray,
+        impacts: dict[str, np.ndarray],
+        total: np.ndarray
+    ) -> tuple[dict[str, np.ndarray], np.ndarray]:
+        # Impactos en cada punto a partir de los de una parcela (impacts, total):
+        # delta es el cambio de los campos columns, con una columna por punto
+        stages = {
+            name: impacts[name][:, None] + jacobian[:, columns] @ delta
+            for name, jacobian in self.stages.items()
+        }
+        return stages, total[:, None] + self.total[:, columns] @ delta
+
+
+def build_jacobian(mapping: CompiledMapping, vectors: BackgroundVectors, amount: float) -> VentumJacobian:
+    k, fields = len(vectors.impact_categories), mapping.crop.fields
+    stages = {}
+    for name, stage in mapping.stages.items():
+        background = vectors.stages[name]
+        reference = background.reference
+        # StageVectors.impacts divide por la cantidad de referencia: si dependiera de un
+        # campo los impactos ya no serían lineales en él
+        if reference in stage.positions or stage.constants[reference] == 0:
+            raise ValueError(f"{name}: the reference exchange must be a non-zero constant to linearize its impacts")
+        scale = amount * background.requirement / stage.constants[reference]
+        jacobian = np.zeros((k, len(fields)))
+        # Varios intercambios pueden leer el mismo campo
+        np.add.at(jacobian.T, stage.fields, scale * background.vectors[:, stage.positions].T)
+        stages[name] = jacobian
+    return VentumJacobian(vectors.revision, vectors.impact_categories, fields, stages)
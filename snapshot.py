@@ -0,0 +1,47 @@
+import argparse
+import logging as log
+import os
+import time
+
+import olca_schema as o
+
+from matrix_engine import MatrixEngine
+from olca_client import OLCAClient
+from ventum_flows import CONFIG_PATH, load_mappings
+
+
+# Exporta las matrices A, B y C de los sistemas de producto a una instantánea en disco
+# que la API abre con OLCA_MATRIX_SNAPSHOT
+def export_snapshot(client: OLCAClient, directory: str, product_systems: list[str], impact_methods: list[str]) -> int:
+    engine = MatrixEngine(client, record_fingerprints=True)
+    for name in product_systems:
+        ref = client.find(o.ProductSystem, name=name) or client.find(o.ProductSystem, uid=name)
+        if ref is None:
+            raise ValueError(f"product system {name} not found")
+        for uid in impact_methods:
+            start = time.perf_counter()
+            matrices = engine.get_matrices(ref.id, uid)
+            log.info(
+                "%s / %s: %i processes, %i flows in %.1f s",
+                ref.name, uid, len(matrices.tech_flows), len(matrices.envi_flows), time.perf_counter() - start
+            )
+    return engine.save_snapshot(directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Instantánea en disco de las matrices de openLCA para arrancar la API sin exportarlas")
+    parser.add_argument("directory")
+    parser.add_argument("--impact-method", action="append", required=True, help="uid del método (se puede repetir)")
+    parser.add_argument(
+        "--product-system", action="append",
+        help="nombre o uid (se puede repetir); por defecto los sistemas de producto de VENTUM_FLOWS_CONFIG"
+    )
+    args = parser.parse_args()
+    log.basicConfig(level=log.INFO)
+
+    client = OLCAClient(endpoints=os.getenv("OLCA_IPC_ENDPOINTS", "8080").split(","))
+    product_systems = args.product_system or sorted({
+        mapping.product_system for mapping in load_mappings(os.getenv("VENTUM_FLOWS_CONFIG", CONFIG_PATH)).values()
+    })
+    count = export_snapshot(client, args.directory, product_systems, args.impact_method)
+    print(f"{count} matrices written to {args.directory}")
@@ -0,0 +1,221 @@
+import logging as log
+import os
+import re
+import typing
+from typing import Callable
+
+import numpy as np
+import olca_schema as o
+import yaml
+from pydantic import BaseModel
+
+from VentumACVOutput import VentumACVOutput
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ventum_flows.yaml")
+
+# fertilizantes.kg_N o fitosanitarios[clave], donde la clave puede tener espacios, comas o |
+FIELD_PATH = re.compile(r"^(\w+(?:\.\w+)*)(?:\[(.+)\])?$")
+
+
+class _UniqueKeyLoader(yaml.SafeLoader):
+    # PyYAML se queda en silencio con el último valor de una clave repetida
+    def construct_mapping(self, node, deep=False):
+        seen = set()
+        for key_node, _ in node.value:
+            key = self.construct_object(key_node, deep=deep)
+            if key in seen:
+                raise ValueError(f"duplicate key {key!r} at line {key_node.start_mark.line + 1}")
+            seen.add(key)
+        return super().construct_mapping(node, deep)
+
+
+def _is_model(annotation) -> bool:
+    return isinstance(annotation, type) and issubclass(annotation, BaseModel)
+
+
+def field_getter(path: str) -> Callable[[VentumACVOutput], float]:
+    # Valida la ruta contra el modelo al cargar, no en cada petición
+    match = FIELD_PATH.match(path)
+    if match is None:
+        raise ValueError(f"invalid field path {path!r}")
+    attributes, key = match.group(1).split("."), match.group(2)
+
+    annotation = VentumACVOutput
+    for name in attributes:
+        if not _is_model(annotation) or name not in annotation.model_fields:
+            raise ValueError(f"unknown field {name!r} in {path!r}")
+        annotation = annotation.model_fields[name].annotation
+    if key is None and (_is_model(annotation) or typing.get_origin(annotation) is dict):
+        raise ValueError(f"{path!r} is not a numeric field")
+    if key is not None and typing.get_origin(annotation) is not dict:
+        raise ValueError(f"{path!r} is not a dict field")
+
+    def get(output: VentumACVOutput) -> float:
+        value = output
+        for name in attributes:
+            value = getattr(value, name)
+        return value[key] if key is not None else value
+    return get
+
+
+def parameter_name(process_name: str, exchange: o.Exchange) -> str:
+    # "Fertilizantes T", intercambio 3 -> fertilizantes_t_3
+    slug = re.sub(r"\W+", "_", process_name.lower()).strip("_")
+    return f"{slug}_{exchange.internal_id}"
+
+
+class CompiledStage:
+    # Cantidades de los intercambios de un proceso, en el orden de process.exchanges:
+    # constantes y, en las posiciones positions, los campos fields del vector de entrada
+    def __init__(self, process: o.Process, constants: np.ndarray, positions: np.ndarray, fields: np.ndarray):
+        self.name = process.name
+        self.context = o.Ref(ref_type=o.RefType.Process, id=process.id, name=process.name)
+        self.exchanges = [(e.flow.name, bool(e.is_input)) for e in process.exchanges]
+        self.parameters = [parameter_name(process.name, e) for e in process.exchanges]
+        self.constants = constants
+        self.positions = positions
+        self.fields = fields
+
+    def amounts(self, values: np.ndarray) -> np.ndarray:
+        # values: (campos,) para una parcela o (campos, parcelas) para un lote
+        shape = (len(self.constants),) + values.shape[1:]
+        amounts = np.broadcast_to(self.constants.reshape((-1,) + (1,) * (values.ndim - 1)), shape).copy()
+        amounts[self.positions] = values[self.fields]
+        return amounts
+
+
+class CompiledMapping:
+    def __init__(self, crop: "CropMapping", stages: dict[str, CompiledStage], revision: int, product_system: o.Ref | None = None):
+        self.crop = crop
+        self.stages = stages
+        self.revision = revision
+        # Referencia al sistema de producto del cultivo, resuelta al compilar
+        self.product_system = product_system
+
+    def values(self, outputs: list[VentumACVOutput]) -> np.ndarray:
+        # Una fila por campo y una columna por parcela
+        rows = [[get(output) for output in outputs] for get in self.crop.getters]
+        return np.array(rows, dtype=float).reshape(len(rows), len(outputs))
+
+    def amounts(self, output: VentumACVOutput) -> dict[str, np.ndarray]:
+        values = self.values([output])[:, 0]
+        return {name: stage.amounts(values) for name, stage in self.stages.items()}
+
+    def amounts_batch(self, outputs: list[VentumACVOutput]) -> dict[str, np.ndarray]:
+        values = self.values(outputs)
+        return {name: stage.amounts(values) for name, stage in self.stages.items()}
+
+    def parameter_redefs(self, output: VentumACVOutput) -> list[o.ParameterRedef]:
+        redefs = []
+        for name, amounts in self.amounts(output).items():
+            stage = self.stages[name]
+            redefs.extend(
+                o.ParameterRedef(name=parameter, value=float(value), context=stage.context)
+                for parameter, value in zip(stage.parameters, amounts)
+            )
+        return redefs
+
+
+class CropMapping:
+    # Mapeo declarativo de un cultivo tal y como está en ventum_flows.yaml
+    def __init__(
+        self,
+        name: str,
+        product_system: str,
+        stages: dict[str, str],
+        sources: dict[str, dict[tuple[str, bool], list[str | float]]]
+    ):
+        self.name = name
+        self.product_system = product_system
+        # Clave de la respuesta -> proceso de primer plano
+        self.stages = stages
+        # Proceso -> (flujo, es entrada) -> un valor por intercambio, o uno para todos
+        self.sources = sources
+        self.fields = sorted({
+            v for exchanges in sources.values() for values in exchanges.values()
+            for v in values if isinstance(v, str)
+        })
+        self.field_index = {path: i for i, path in enumerate(self.fields)}
+        self.getters = [field_getter(path) for path in self.fields]
+
+    def missing(self, output: VentumACVOutput) -> list[str]:
+        # Campos del mapeo con clave (fitosanitarios[...]) que no vienen en la parcela
+        missing = []
+        for path, get in zip(self.fields, self.getters):
+            try:
+                get(output)
+            except KeyError:
+                missing.append(path)
+        return missing
+
+    def compile(self, processes: dict[str, o.Process], revision: int, product_system: o.Ref | None = None) -> CompiledMapping:
+        errors, stages = [], {}
+        for name in self.stages.values():
+            process = processes[name]
+            occurrences: dict[tuple[str, bool], list[int]] = {}
+            for position, e in enumerate(process.exchanges):
+                occurrences.setdefault((e.flow.name, bool(e.is_input)), []).append(position)
+
+            constants = np.zeros(len(process.exchanges))
+            positions, fields = [], []
+            for (flow, is_input), values in self.sources[name].items():
+                direction = "input" if is_input else "output"
+                found = occurrences.get((flow, is_input))
+                if not found:
+                    errors.append(f"{name}: there is no {direction} {flow!r}")
+                    continue
+                if len(values) == 1:
+                    if len(found) > 1 and isinstance(values[0], str):
+                        log.warning("%s: %s is used by %i %s exchanges %r", name, values[0], len(found), direction, flow)
+                    values = values * len(found)
+                elif len(values) != len(found):
+                    errors.append(f"{name}: {len(values)} values for {len(found)} {direction} exchanges {flow!r}")
+                    continue
+                for position, value in zip(found, values):
+                    if isinstance(value, str):
+                        positions.append(position)
+                        fields.append(self.field_index[value])
+                    else:
+                        constants[position] = value
+
+            for flow, is_input in occurrences.keys() - self.sources[name].keys():
+                errors.append(f"{name}: unmapped {'input' if is_input else 'output'} {flow!r}")
+
+            stages[name] = CompiledStage(
+                process=process,
+                constants=constants,
+                positions=np.array(positions, dtype=int),
+                fields=np.array(fields, dtype=int)
+            )
+
+        if errors:
+            raise ValueError(f"flow mapping {self.name!r} does not match its processes:\n  " + "\n  ".join(errors))
+        return CompiledMapping(self, stages, revision, product_system)
+
+
+def _sources(stage: dict, where: str) -> dict[tuple[str, bool], list[str | float]]:
+    sources = {}
+    for direction, is_input in (("inputs", True), ("outputs", False)):
+        for flow, value in (stage.get(direction) or {}).items():
+            values = value if isinstance(value, list) else [value]
+            if not values or any(isinstance(v, bool) or not isinstance(v, (str, int, float)) for v in values):
+                raise ValueError(f"{where}: invalid value for {direction} {flow!r}: {value!r}")
+            sources[(flow, is_input)] = [v if isinstance(v, str) else float(v) for v in values]
+    return sources
+
+
+def load_mappings(path: str = CONFIG_PATH) -> dict[str, CropMapping]:
+    with open(path) as f:
+        config = yaml.load(f, Loader=_UniqueKeyLoader)
+
+    mappings = {}
+    for crop, spec in config.items():
+        stages, sources = {}, {}
+        for key, stage in spec["stages"].items():
+            process = stage["process"]
+            if process in sources:
+                raise ValueError(f"{crop}: process {process!r} is mapped twice")
+            stages[key] = process
+            sources[process] = _sources(stage, f"{crop}/{key}")
+        mappings[crop] = CropMapping(crop, spec.get("product_system", crop), stages, sources)
+    return mappings